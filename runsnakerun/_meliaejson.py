@@ -1,13 +1,20 @@
 #! /usr/bin/env python
-"""Horrible hack to attempt to load meliae dumps a bit faster
-
-Makes meliae loading about 4.25x faster on python 2.6 compared to the 
-json + C speedups.  This is *not* however, a full json decoder, it is 
-*just* a parser for the flat records meliae produces (i.e. no recursive 
-structures, no floats, just ints, strings and lists-of-ints)
+"""Decoders for the (json) lines of meliae dumps
+
+loads is a horrible hack which made meliae loading about 4.25x faster on
+python 2.6 compared to the json + C speedups.  This is *not* however, a
+full json decoder, it is *just* a parser for the flat records meliae
+produces (i.e. no recursive structures, no floats, just ints, strings and
+lists-of-ints).  On current pythons the C json decoder is several times
+faster than loads.
+
+The batch decoders take a sequence of (bytes) lines and return their
+records, a json module decodes a whole batch (joined into one json array)
+in a single call, which saves most of the per-line overhead.  fastest()
+chooses the quickest of the available decoders.
 """
 from __future__ import absolute_import
-import re, unittest, json
+import re, unittest, json, time
 from six import unichr
 
 try:
@@ -31,7 +38,13 @@ attr = (
 )
 
 escape = re.compile(escape, re.U)
-simple_escape = re.compile(r'\\([^uU])', re.U)
+# a surrogate pair, any other \u escape, or a single-character escape
+escapes = re.compile(
+    r'\\[uU]([dD][89abAB][0-9a-fA-F]{2})\\[uU]([dD][c-fC-F][0-9a-fA-F]{2})'
+    r'|\\[uU]([0-9a-fA-F]{4})|\\(.)',
+    re.U,
+)
+SIMPLE_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
 
 assert escape.match(u"\\u0000")
 attr = re.compile(attr)
@@ -53,6 +66,16 @@ assert (
 )
 
 
+def deescape(match):
+    high, low, code, simple = match.groups()
+    if simple is not None:
+        return SIMPLE_ESCAPES.get(simple, simple)
+    if code is not None:
+        return unichr(int(code, 16))
+    high, low = int(high, 16), int(low, 16)
+    return unichr(0x10000 + ((high - 0xD800) << 10) + (low - 0xDC00))
+
+
 def loads(source):
     """Load json structure from meliae from source
     
@@ -72,15 +95,10 @@ def loads(source):
         elif match.group('int') is not None:
             value = int(match.group('int'))
         elif match.group('string') is not None:
-
-            def deescape(match):
-                return unichr(int(match.group(0)[2:], 16))
-
             value = match.group('string')
             if isinstance(value, bytes):
                 value = value.decode('utf-8')
-            value = escape.sub(deescape, value,)
-            value = simple_escape.sub(lambda x: x.group(1), value,)
+            value = escapes.sub(deescape, value)
         else:
             raise RuntimeError(
                 "Matched something we don't know how to process:", match.groupdict()
@@ -89,8 +107,84 @@ def loads(source):
     return result
 
 
-if __name__ == "__main__":
-    import sys, pprint
+def json_decoder(loads):
+    """Batch decoder using a json module's loads (one call per batch)"""
+
+    def decode(lines):
+        if not lines:
+            return []
+        try:
+            return loads((b'[' + b','.join(lines) + b']').decode('utf-8'))
+        except ValueError:
+            # decode line-by-line to report the line which is broken
+            return [loads(line.decode('utf-8')) for line in lines]
+
+    return decode
+
+
+def regex_decoder(lines):
+    """Batch decoder using loads"""
+    return [loads(line.decode('utf-8')) for line in lines]
+
 
-    for line in open(sys.argv[1]):
-        official = json.loads(line)
+def decoders():
+    """The available batch decoders as [(name, decode),...]"""
+    result = [('json', json_decoder(json.loads))]
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        result.append(('simplejson', json_decoder(simplejson.loads)))
+    result.append(('meliaejson', regex_decoder))
+    return result
+
+
+# representative records (escapes, names, values and long reference lists)
+SAMPLE = [
+    b'{"address": 42229520, "type": "tuple", "size": 64, "len": 1, "refs": [8554592]}',
+    b'{"address": 8554592, "type": "NoneType", "size": 16, "refs": []}',
+    b'{"address": 140030826, "type": "str", "size": 53, "len": 16, '
+    b'"value": "a \\"quoted\\"\\n\\ud83d\\ude00 \\u00e9", "refs": []}',
+    b'{"address": 139828625, "type": "module", "size": 56, "name": "os", '
+    b'"refs": [139828625414688, 70572696, 52870672, 40989336]}',
+    b'{"address": 7351872, "type": "dict", "size": 3352, "len": 72, "refs": ['
+    + b', '.join([str(7351872 + i * 48).encode('ascii') for i in range(144)])
+    + b']}',
+] * 40
+
+_fastest = None
+
+
+def fastest():
+    """(name, decode) of the batch decoder which decodes SAMPLE quickest
+
+    The choice is made once (per process).
+    """
+    global _fastest
+    if _fastest is None:
+        timings = []
+        for name, decode in decoders():
+            best = None
+            for i in range(3):
+                start = time.time()
+                decode(SAMPLE)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min((best, elapsed))
+            timings.append((best, len(timings), name, decode))
+        best, position, name, decode = min(timings)
+        _fastest = (name, decode)
+    return _fastest
+
+
+if __name__ == "__main__":
+    import sys
+
+    with open(sys.argv[1], 'rb') as fh:
+        lines = [line.strip() for line in fh if line.strip()]
+    expected = json_decoder(json.loads)(lines)
+    for name, decode in decoders():
+        start = time.time()
+        result = decode(lines)
+        assert result == expected, name
+        print('%-12s %0.3fs' % (name, time.time() - start))
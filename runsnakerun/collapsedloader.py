@@ -0,0 +1,310 @@
+"""Load collapsed-stack sampling profiles (py-spy, austin, flamegraph tools)
+
+Low-overhead sampling profilers emit one line per distinct stack, the
+frames outermost-first separated by semicolons, then the number of
+samples in which the stack was seen:
+
+    main (app.py:10);handle (app.py:42);query (db.py:7) 123
+
+The files are streamed in a single pass into two models:
+
+* a calling-context tree (the 'calls' root) in which every node is a
+  function *at a particular call path*, so the square map shows exactly
+  where the time went rather than the averaged call graph of pstats
+* per-function totals folded into a regular pstats dictionary, which is
+  loaded by the PStatsLoader machinery for the 'functions' and 'location'
+  roots and the list views
+
+Times are sample counts multiplied by the interval (seconds per sample).
+"""
+from __future__ import absolute_import
+import os, io, re, logging
+from array import array
+import six
+from six.moves import range
+from gettext import gettext as _
+from runsnakerun import pstatsloader
+from runsnakerun.progress import as_progress, STEP
+
+log = logging.getLogger(__name__)
+
+# function (path/to/file.py:123) as written by py-spy
+FRAME = re.compile(r'^(?P<name>.*) \((?P<file>[^()]*?)(?::(?P<line>\d+))?\)$')
+# a stack line, frames then a sample count
+SAMPLE = re.compile(r'^(?P<stack>\S.*) (?P<count>\d+)\s*$')
+
+
+def parse_frame(frame):
+    """Produce a pstats-style (filename, lineno, name) key for a frame
+
+    Frames which do not record a file (native code, kernel frames from
+    stackcollapse-perf) are treated like built-ins, with filename '~'.
+    """
+    match = FRAME.match(frame)
+    if match:
+        return (match.group('file'), int(match.group('line') or 0), match.group('name'))
+    return ('~', 0, frame)
+
+
+def frame_info(key, index):
+    """Produce the (key, directory, filename, index) shared by a function's contexts"""
+    return (key, os.path.dirname(key[0]), os.path.basename(key[0]), index)
+
+
+def is_collapsed(filename):
+    """Does filename look like a collapsed-stack file (rather than a pstats dump)"""
+    try:
+        with open(filename, 'rb') as fh:
+            head = fh.read(4096)
+    except (IOError, OSError):
+        return False
+    try:
+        text = head.decode('utf-8')
+    except UnicodeDecodeError:
+        # possibly a character split at the end of the block
+        try:
+            text = head[:-4].decode('utf-8')
+        except UnicodeDecodeError:
+            return False
+    for line in text.splitlines():
+        if line.strip():
+            return bool(SAMPLE.match(line))
+    return False
+
+
+class CollapsedNode(pstatsloader.BaseStat):
+    """A function at a particular calling context (path from the root)
+
+    frame -- (key, directory, filename, index) shared by all contexts of a
+        function, index is the function's dense id
+    cumulative -- time of the samples which passed through this context
+    local -- time of the samples in which this context was the leaf
+    calls -- number of samples which passed through this context
+    """
+
+    __slots__ = ('frame', 'children', 'parents', 'calls', 'local', 'cumulative', 'id')
+
+    key = property(lambda self: self.frame[0])
+    filename = property(lambda self: self.frame[2])
+    directory = property(lambda self: self.frame[1])
+    lineno = property(lambda self: self.frame[0][1])
+    name = property(lambda self: self.frame[0][2])
+    recursive = property(lambda self: self.calls)
+    localPer = property(lambda self: self.local / (self.calls or 0.00000000000001))
+    cumulativePer = property(
+        lambda self: self.cumulative / (self.calls or 0.00000000000001)
+    )
+
+    def __init__(self, frame, parent=None):
+        self.frame = frame
+        self.children = []
+        self.parents = [parent] if parent is not None else []
+        self.calls = 0
+        self.local = 0
+        self.cumulative = 0
+        self.id = None
+
+    def __repr__(self):
+        return 'CollapsedNode( %r,%r,%r,%r, %s )' % (
+            self.directory,
+            self.filename,
+            self.lineno,
+            self.name,
+            len(self.children),
+        )
+
+    def child_cumulative_time(self, child):
+        if self.cumulative:
+            return child.cumulative / float(self.cumulative)
+        return 0
+
+
+class Loader(pstatsloader.PStatsLoader):
+    """Load one or more collapsed-stack sampling profiles
+
+    filenames -- collapsed-stack files to merge into a single model
+    interval -- seconds per sample (default 1.0, i.e. times are counts)
+    threshold -- prune the function totals (see pstatsloader.prune_stats),
+        the calling-context tree is kept whole
+    progress -- progress.Progress instance to report the load to
+    """
+
+    ROOTS = ['calls', 'functions', 'location']
+
+    # watch mode (in-place updates) is not supported for samples
+    update = None
+
+    def __init__(self, *filenames, **named):
+        self.filename = filenames
+        self.rows = {}
+        self.roots = {}
+        self.location_rows = {}
+        self.processes = None
+        self.columnar = False
+        self.table = None
+        self.reachability = None
+        self.interval = named.get('interval') or 1.0
+        self.threshold = named.get('threshold')
+        self.progress = as_progress(named.get('progress'))
+        self.progress.start(_('read'))
+        self.contexts = 0
+        stats = self.load_samples(self.filename)
+        self.tree = self.load(stats)
+        self.progress = as_progress(None)
+
+    def get_rows(self, key):
+        if key == 'calls':
+            # the list views show the per-function totals
+            key = 'functions'
+        return super(Loader, self).get_rows(key)
+
+    def get_adapter(self, key):
+        from runsnakerun import pstatsadapter
+
+        if key == 'calls':
+            return pstatsadapter.PStatsAdapter()
+        return super(Loader, self).get_adapter(key)
+
+    def load_samples(self, filenames):
+        """Stream the files into the calling-context tree, fold function totals
+
+        returns pstats dictionary of the per-function totals
+        """
+        interval = self.interval
+        root = CollapsedNode(frame_info(('*', 0, _('<all samples>')), -1))
+        root.id = 0
+        # (parent id, key): context, one dictionary rather than one per node
+        contexts = {}
+        created = 1
+        frames = {}
+        functions = []
+        skipped = 0
+        count = 0
+        # sampler output is usually sorted, so consecutive stacks share a
+        # prefix whose contexts need not be looked up again
+        previous, path = [], [root]
+        for filename in filenames:
+            with io.open(filename, 'r', encoding='utf-8', errors='replace') as fh:
+                for line in fh:
+                    stack, _sep, samples = line.rstrip().rpartition(' ')
+                    if not stack or not samples.isdigit():
+                        if line.strip():
+                            skipped += 1
+                        continue
+                    samples = int(samples)
+                    time = samples * interval
+                    stack = stack.split(';')
+                    shared = 0
+                    for frame, last in zip(stack, previous):
+                        if frame != last:
+                            break
+                        shared += 1
+                    del path[shared + 1 :]
+                    for node in path:
+                        node.calls += samples
+                        node.cumulative += time
+                    for frame in stack[shared:]:
+                        info = frames.get(frame)
+                        if info is None:
+                            key = parse_frame(frame)
+                            info = frames[frame] = frame_info(key, len(functions))
+                            functions.append(key)
+                        context = (node.id, info[3])
+                        child = contexts.get(context)
+                        if child is None:
+                            child = contexts[context] = CollapsedNode(info, node)
+                            child.id = created
+                            created += 1
+                            node.children.append(child)
+                        node = child
+                        node.calls += samples
+                        node.cumulative += time
+                        path.append(node)
+                    node.local += time
+                    previous = stack
+                    count += 1
+                    if not count % STEP:
+                        self.progress.update(count)
+        if skipped:
+            log.warning('Skipped %s malformed line(s) in %s', skipped, filenames)
+        if not count:
+            raise ValueError('No samples found in %s' % (filenames,))
+        self.contexts = created
+        self.roots['calls'] = root
+        self.progress.start(_('fold'), created)
+        return self.fold(root, functions)
+
+    def fold(self, root, functions):
+        """Fold the calling-context tree into per-function (and per-edge) totals
+
+        A recursive function is only counted once per path (as cProfile
+        counts cumulative time only for the outermost call), as is an edge
+        which appears more than once on a path.
+
+        returns pstats dictionary
+        """
+        count = len(functions)
+        samples = [0] * count
+        local = [0] * count
+        cumulative = [0] * count
+        # callee: {caller: [samples, local, cumulative]}
+        callers = [{} for i in range(count)]
+        # number of times each function/edge is on the current path
+        active = array('i', [0]) * count
+        edges = {}
+        visited = 0
+        stack = [(child, -1) for child in root.children]
+        while stack:
+            node, caller = stack.pop()
+            if node is None:
+                # leaving a context, caller is (function, edge)...
+                index, edge = caller
+                active[index] -= 1
+                if edge is not None:
+                    edges[edge] -= 1
+                continue
+            index = node.frame[3]
+            if not active[index]:
+                samples[index] += node.calls
+                cumulative[index] += node.cumulative
+            local[index] += node.local
+            active[index] += 1
+            edge = None
+            if caller != -1:
+                stat = callers[index].get(caller)
+                if stat is None:
+                    stat = callers[index][caller] = [0, 0, 0]
+                edge = caller * count + index
+                if not edges.get(edge):
+                    stat[0] += node.calls
+                    stat[2] += node.cumulative
+                stat[1] += node.local
+                edges[edge] = edges.get(edge, 0) + 1
+            stack.append((None, (index, edge)))
+            stack.extend([(child, index) for child in node.children])
+            visited += 1
+            if not visited % STEP:
+                self.progress.update(visited)
+        return dict(
+            [
+                (
+                    functions[index],
+                    (
+                        samples[index],
+                        samples[index],
+                        local[index],
+                        cumulative[index],
+                        dict(
+                            [
+                                (functions[caller], (n, n, tt, ct))
+                                for caller, (n, tt, ct) in six.iteritems(callers[index])
+                            ]
+                        ),
+                    ),
+                )
+                for index in range(count)
+            ]
+        )
+
+    def load_calls(self):
+        return self.roots['calls']
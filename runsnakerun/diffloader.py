@@ -0,0 +1,157 @@
+"""Differential model comparing a baseline and a candidate set of pstats dumps
+
+Rows of the two profiles are aligned by function key with a single hash join
+(dictionary lookups, no scans), each row carries the candidate's statistics
+plus the baseline's and the deltas between them, as does each caller edge.
+The call graph is the union of the two call graphs.
+"""
+from __future__ import absolute_import
+import logging
+import six
+from gettext import gettext as _
+from runsnakerun import pstatsloader
+from runsnakerun.pstatsloader import as_edge
+from runsnakerun.progress import as_progress, STEP
+
+log = logging.getLogger(__name__)
+
+NULL_STATS = (0, 0, 0, 0, {})
+NULL_EDGE = (0, 0, 0, 0)
+
+
+class PStatDiffRow(pstatsloader.PStatRow):
+    """A function's statistics in the candidate profile, with baseline deltas
+
+    The regular statistics (calls, local, cumulative, ...) are those of the
+    candidate, baseline_<field> those of the baseline, and <field>_delta
+    the change (candidate - baseline).  Functions only present in one of
+    the profiles have zero statistics in the other.  Caller edges are
+    compared on demand (see edge_delta).
+    """
+
+    def __init__(self, key, baseline, candidate):
+        try:
+            super(PStatDiffRow, self).__init__(key, candidate or baseline)
+        except ValueError:
+            # null in the candidate, raises if also null in the baseline
+            super(PStatDiffRow, self).__init__(key, baseline or NULL_STATS)
+        baseline, candidate = baseline or NULL_STATS, candidate or NULL_STATS
+        self.set_stats(candidate)
+        (
+            self.baseline_calls,
+            self.baseline_recursive,
+            self.baseline_local,
+            self.baseline_cumulative,
+            baseline_callers,
+        ) = baseline
+        self.calls_delta = self.calls - self.baseline_calls
+        self.recursive_delta = self.recursive - self.baseline_recursive
+        self.local_delta = self.local - self.baseline_local
+        self.cumulative_delta = self.cumulative - self.baseline_cumulative
+        self.baseline_callers = baseline_callers
+        for caller in baseline_callers:
+            if caller not in self.callers:
+                # weave the union of the two call graphs...
+                self.callers = callers = dict.fromkeys(baseline_callers, NULL_EDGE)
+                callers.update(candidate[4])
+                break
+
+    def edge_delta(self, caller):
+        """Change in (nc, cc, tt, ct) of the edge from caller (key) to us"""
+        baseline = as_edge(self.baseline_callers.get(caller, NULL_EDGE))
+        candidate = as_edge(self.callers.get(caller, NULL_EDGE))
+        return tuple([c - b for b, c in zip(baseline, candidate)])
+
+    @property
+    def relative_delta(self):
+        """Change in cumulative time relative to the larger of the two"""
+        scale = max(abs(self.cumulative), abs(self.baseline_cumulative))
+        if scale:
+            return self.cumulative_delta / float(scale)
+        return 0.0
+
+    def __repr__(self):
+        return 'PStatDiffRow( %r,%r,%r,%r, %+0.5f )' % (
+            self.directory,
+            self.filename,
+            self.lineno,
+            self.name,
+            self.cumulative_delta,
+        )
+
+
+class DiffLoader(pstatsloader.PStatsLoader):
+    """Load a differential model of two sets of pstats dumps
+
+    baseline -- pstats dump file(s) for the "before" profile
+    candidate -- pstats dump file(s) for the "after" profile
+    processes -- see pstatsloader.load_pstats
+    progress -- progress.Progress instance to report the load to
+    """
+
+    ROOTS = ['diff']
+
+    # watch mode (in-place updates) is not supported for diffs
+    update = None
+
+    def __init__(self, baseline, candidate, **named):
+        self.baseline = list(baseline)
+        self.candidate = list(candidate)
+        self.filename = tuple(self.baseline + self.candidate)
+        self.rows = {}
+        self.roots = {}
+        self.location_rows = {}
+        self.processes = named.get('processes')
+        self.columnar = False
+        self.table = None
+        self.reachability = None
+        self.progress = as_progress(named.get('progress'))
+        self.progress.start(_('read'))
+        self.tree = self.load_diff(
+            pstatsloader.load_pstats(self.baseline, self.processes),
+            pstatsloader.load_pstats(self.candidate, self.processes),
+        )
+        self.progress = as_progress(None)
+
+    def get_adapter(self, key):
+        from runsnakerun import pstatsadapter
+
+        if key == 'diff':
+            return pstatsadapter.DiffAdapter()
+        raise KeyError("""Unknown root type %s""" % (key,))
+
+    def is_live(self, row):
+        # functions which disappeared are still part of the diff
+        return True
+
+    def load_diff(self, baseline, candidate):
+        """Build the differential model from two pstats dictionaries"""
+        rows = self.rows
+        self.progress.start(_('join'), len(candidate))
+        # hash join, every key of either profile is looked up once in the other
+        for i, (func, raw) in enumerate(six.iteritems(candidate)):
+            try:
+                row = PStatDiffRow(func, baseline.get(func), raw)
+            except ValueError as err:
+                log.info('Null row: %s', func)
+                continue
+            rows[func] = row
+            row.id = len(rows) - 1
+            if not i % STEP:
+                self.progress.update(i, len(candidate))
+        for func, raw in six.iteritems(baseline):
+            if func not in candidate:
+                try:
+                    row = PStatDiffRow(func, raw, None)
+                except ValueError as err:
+                    continue
+                rows[func] = row
+                row.id = len(rows) - 1
+        self.progress.start(_('weave'), len(rows))
+        for i, row in enumerate(six.itervalues(rows)):
+            row.weave(rows)
+            if not i % STEP:
+                self.progress.update(i, len(rows))
+        root = self.find_root(rows)
+        self.roots['diff'] = root
+        return root
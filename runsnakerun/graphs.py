@@ -0,0 +1,610 @@
+"""Iterative graph algorithms shared by the loaders
+
+The profile and memory graphs can be very large and very deep, so nothing
+in here recurses (deep graphs would overflow the interpreter's recursion
+limit).  Nodes are identified by dense integer ids where the loader
+provides them, so that visited-sets are flat byte-maps rather than hash
+sets.
+"""
+from __future__ import absolute_import
+import logging
+from array import array
+from bisect import bisect_right
+from six.moves import range
+
+log = logging.getLogger(__name__)
+
+
+class Visited(object):
+    """Visited-set for graph traversals
+
+    Nodes with a dense integer id (an `id` attribute) are tracked in a
+    byte-map (grown on demand), nodes without one (synthetic records) fall
+    back to a set of object identities.
+
+    size -- expected number of dense ids
+    """
+
+    def __init__(self, size=0):
+        self.map = bytearray(size)
+        self.others = set()
+
+    def add(self, node):
+        """Add node to the set, returns False if it was already present"""
+        index = getattr(node, 'id', None)
+        if index is None:
+            key = id(node)
+            if key in self.others:
+                return False
+            self.others.add(key)
+            return True
+        if index >= len(self.map):
+            self.map.extend(bytearray(max((index + 1 - len(self.map), len(self.map)))))
+        elif self.map[index]:
+            return False
+        self.map[index] = 1
+        return True
+
+    def __contains__(self, node):
+        index = getattr(node, 'id', None)
+        if index is None:
+            return id(node) in self.others
+        return index < len(self.map) and bool(self.map[index])
+
+
+def reachable(node, successors, visited=None):
+    """Iterate (depth-first, pre-order) over all nodes reachable from node
+
+    node -- starting node (not itself yielded unless reachable via a cycle)
+    successors -- callable returning the successor nodes of a node
+    visited -- optional Visited instance (shared across calls to exclude
+        nodes already produced)
+
+    Produces the same order as a recursive pre-order traversal, but uses
+    an explicit stack of iterators.
+    """
+    if visited is None:
+        visited = Visited()
+    seen, add = visited.map, visited.add
+    stack = [iter(successors(node))]
+    push, pop = stack.append, stack.pop
+    while stack:
+        for child in stack[-1]:
+            # inlined fast-path of visited.add for dense ids
+            try:
+                if seen[child.id]:
+                    continue
+                seen[child.id] = 1
+            except (AttributeError, IndexError, TypeError):
+                if not add(child):
+                    continue
+            yield child
+            push(iter(successors(child)))
+            break
+        else:
+            pop()
+
+
+def postorder(node, successors, seen):
+    """Iterate (depth-first, post-order) over node and the nodes reachable from it
+
+    node -- starting node (a dense integer id)
+    successors -- callable returning the successor ids of a node id
+    seen -- bytearray visited-map indexed by id, nodes marked in it are
+        skipped, every node produced is marked (share it across calls to
+        exclude nodes already produced)
+
+    Every node is produced after all of its (unseen) successors, in the
+    order of the equivalent recursive traversal.
+    """
+    if seen[node]:
+        return
+    seen[node] = 1
+    # parallel stacks rather than (node, iterator) pairs, deep graphs would
+    # otherwise allocate (and garbage-collect) a tuple per level
+    nodes, stack = [node], [iter(successors(node))]
+    push_node, pop_node, push, pop = nodes.append, nodes.pop, stack.append, stack.pop
+    while stack:
+        for child in stack[-1]:
+            if not seen[child]:
+                seen[child] = 1
+                push_node(child)
+                push(iter(successors(child)))
+                break
+        else:
+            pop()
+            yield pop_node()
+
+
+def strongly_connected_components(count, successors):
+    """Find the strongly connected components of a graph (iterative Tarjan)
+
+    count -- number of nodes, nodes are the dense ids 0 .. count-1
+    successors -- callable returning the successor ids of a node id
+
+    returns (component, components) where component is an array mapping
+    node id to component id and components is the number of components.
+    Component ids are assigned in reverse topological order, that is,
+    every edge between two components runs from a higher component id to
+    a lower one.
+    """
+    index = array('i', [-1]) * count
+    low = array('i', [0]) * count
+    component = array('i', [-1]) * count
+    on_stack = bytearray(count)
+    stack = []
+    counter = 0
+    components = 0
+    for root in range(count):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if index[child] == -1:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack[child] = 1
+                    work.append((child, iter(successors(child))))
+                    break
+                elif on_stack[child] and index[child] < low[node]:
+                    low[node] = index[child]
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low[node] < low[parent]:
+                        low[parent] = low[node]
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component[member] = components
+                        if member == node:
+                            break
+                    components += 1
+    return component, components
+
+
+def cyclic_components(roots, successors):
+    """Find the cyclic strongly connected components reachable from roots
+
+    roots -- nodes to start from (any hashable node ids)
+    successors -- callable returning the successors of a node
+
+    An iterative Tarjan traversal whose state is kept in mappings over the
+    nodes actually reached, so the cost is linear in the size of the
+    reachable subgraph (not of the whole graph).
+
+    returns a list of the members (a list) of each component which holds
+    a cycle, that is, has more than one node or a node which is its own
+    successor, in reverse topological order
+    """
+    index, low = {}, {}
+    on_stack = set()
+    stack, result = [], []
+    counter = 0
+    for root in roots:
+        if root in index:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        self_loops = set()
+        nodes, work = [root], [iter(successors(root))]
+        while work:
+            node = nodes[-1]
+            for child in work[-1]:
+                if child not in index:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    nodes.append(child)
+                    work.append(iter(successors(child)))
+                    break
+                elif child in on_stack:
+                    if child == node:
+                        self_loops.add(node)
+                    elif index[child] < low[node]:
+                        low[node] = index[child]
+            else:
+                work.pop()
+                nodes.pop()
+                if nodes:
+                    parent = nodes[-1]
+                    if low[node] < low[parent]:
+                        low[parent] = low[node]
+                if low[node] == index[node]:
+                    members = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        members.append(member)
+                        if member == node:
+                            break
+                    if len(members) > 1 or node in self_loops:
+                        result.append(members)
+    return result
+
+
+def dominators(count, successors, root):
+    """Find the immediate dominators of the nodes reachable from root
+
+    count -- number of nodes, nodes are the dense ids 0 .. count-1
+    successors -- callable returning the successor ids of a node id
+    root -- the node id to start from
+
+    Lengauer-Tarjan with path compression (O(e log n)), iterative
+    throughout.  The depth-first numbering is the index into the working
+    arrays, the edges are kept in arrays rather than per-node lists.
+
+    returns (idom, order) where idom is an array mapping node id to its
+    immediate dominator's id (-1 for root and unreachable nodes) and order
+    lists the reachable node ids in depth-first pre-order, so every node
+    comes after its dominator
+    """
+    number = array('i', [-1]) * count
+    order = array('i')
+    parent = array('i')
+    # edges (between depth-first numbers), to be sorted by target
+    sources, targets = array('i'), array('i')
+    number[root] = 0
+    order.append(root)
+    parent.append(-1)
+    nodes, stack = [0], [iter(successors(root))]
+    while stack:
+        for child in stack[-1]:
+            current = nodes[-1]
+            if number[child] == -1:
+                number[child] = len(order)
+                order.append(child)
+                parent.append(current)
+                nodes.append(number[child])
+                stack.append(iter(successors(child)))
+                sources.append(current)
+                targets.append(number[child])
+                break
+            sources.append(current)
+            targets.append(number[child])
+        else:
+            stack.pop()
+            nodes.pop()
+    reached = len(order)
+    # predecessors of each depth-first number (CSR)
+    offsets = array('i', [0]) * (reached + 1)
+    for target in targets:
+        offsets[target + 1] += 1
+    for i in range(reached):
+        offsets[i + 1] += offsets[i]
+    fill = array('i', offsets[:-1])
+    predecessors = array('i', [0]) * len(targets)
+    for source, target in zip(sources, targets):
+        predecessors[fill[target]] = source
+        fill[target] += 1
+    del sources, targets, fill
+    semi = array('i', range(reached))
+    label = array('i', range(reached))
+    ancestor = array('i', [-1]) * reached
+    dom = array('i', [0]) * reached
+    # buckets as linked lists (head per node, next per member)
+    bucket = array('i', [-1]) * reached
+    next_member = array('i', [-1]) * reached
+
+    def evaluate(node):
+        if ancestor[node] == -1:
+            return node
+        path = []
+        while ancestor[ancestor[node]] != -1:
+            path.append(node)
+            node = ancestor[node]
+        for member in reversed(path):
+            above = ancestor[member]
+            if semi[label[above]] < semi[label[member]]:
+                label[member] = label[above]
+            ancestor[member] = ancestor[above]
+        return label[path[0]] if path else label[node]
+
+    for node in range(reached - 1, 0, -1):
+        for predecessor in predecessors[offsets[node] : offsets[node + 1]]:
+            candidate = semi[evaluate(predecessor)]
+            if candidate < semi[node]:
+                semi[node] = candidate
+        next_member[node] = bucket[semi[node]]
+        bucket[semi[node]] = node
+        above = parent[node]
+        ancestor[node] = above
+        member = bucket[above]
+        while member != -1:
+            best = evaluate(member)
+            dom[member] = best if semi[best] < semi[member] else above
+            member = next_member[member]
+        bucket[above] = -1
+    idom = array('i', [-1]) * count
+    for node in range(1, reached):
+        if dom[node] != semi[node]:
+            dom[node] = dom[dom[node]]
+        idom[order[node]] = order[dom[node]]
+    return idom, order
+
+
+def condense(count, successors, component, components):
+    """Produce the condensation (DAG of components) of a graph
+
+    returns (successors, predecessors, cyclic) where successors and
+    predecessors are lists of component-id lists, and cyclic is a byte-map
+    flagging components which contain a cycle (more than one member or a
+    self-reference)
+    """
+    sizes = array('i', [0]) * components
+    for node in range(count):
+        sizes[component[node]] += 1
+    cyclic = bytearray([1 if size > 1 else 0 for size in sizes])
+    forward = [set() for i in range(components)]
+    for node in range(count):
+        source = component[node]
+        for child in successors(node):
+            target = component[child]
+            if target == source:
+                cyclic[source] = 1
+            else:
+                forward[source].add(target)
+    backward = [[] for i in range(components)]
+    for source, targets in enumerate(forward):
+        for target in targets:
+            backward[target].append(source)
+    return [sorted(targets) for targets in forward], backward, cyclic
+
+
+class IntervalLabels(object):
+    """Interval (tree-cover) reachability labels for a DAG
+
+    A depth-first spanning forest assigns every node a post-order number,
+    a node's spanning sub-tree is then the contiguous range of post-order
+    numbers [first, post].  The label of a node is the merged list of
+    ranges covering everything reachable from it (including itself), which
+    for near-tree graphs such as call graphs is only a handful of ranges.
+
+    Densely cross-linked graphs can need a number of ranges proportional to
+    the graph size, so labels are capped at `limit` ranges; nodes whose
+    label would be larger (and all of their predecessors) are left
+    unlabelled and answered by a search which stops at labelled nodes.
+
+    count -- number of DAG nodes
+    successors -- list of successor-id lists
+    limit -- maximum number of ranges in a single label
+    """
+
+    LIMIT = 64
+
+    def __init__(self, count, successors, limit=None):
+        limit = limit or self.LIMIT
+        self.successors = successors
+        self.post = array('i', [-1]) * count
+        first = array('i', [0]) * count
+        order = []
+        counter = 0
+        for root in range(count):
+            if self.post[root] != -1:
+                continue
+            self.post[root] = -2  # on the stack
+            work = [(root, iter(successors[root]), counter)]
+            while work:
+                node, children, start = work[-1]
+                for child in children:
+                    if self.post[child] == -1:
+                        self.post[child] = -2
+                        work.append((child, iter(successors[child]), counter))
+                        break
+                else:
+                    work.pop()
+                    self.post[node] = counter
+                    first[node] = start
+                    order.append(node)
+                    counter += 1
+        # post-order is a reverse topological order, so successor labels
+        # are always complete before they are needed...
+        self.labels = labels = [None] * count
+        self.starts = starts = [None] * count
+        unlabelled = 0
+        for node in order:
+            ranges = [(first[node], self.post[node])]
+            for child in successors[node]:
+                label = labels[child]
+                if label is None:
+                    ranges = None
+                    break
+                ranges.extend(label)
+            if ranges is not None:
+                ranges = merge_ranges(ranges)
+                if len(ranges) <= limit:
+                    labels[node] = ranges
+                    starts[node] = [start for start, stop in ranges]
+                    continue
+            unlabelled += 1
+        if unlabelled:
+            log.info(
+                'Reachability labels exceeded %s ranges for %s of %s nodes',
+                limit,
+                unlabelled,
+                count,
+            )
+        self.weights = {}
+        self.totals = {}
+
+    def add_weights(self, name, weights):
+        """Register a per-node weight for totalling over reachable sets"""
+        by_post = [0] * len(self.post)
+        for node, weight in enumerate(weights):
+            by_post[self.post[node]] = weight
+        prefix = [0]
+        total = 0
+        for weight in by_post:
+            total += weight
+            prefix.append(total)
+        self.weights[name] = prefix
+
+    def _in_label(self, node, position):
+        i = bisect_right(self.starts[node], position) - 1
+        return i >= 0 and self.labels[node][i][1] >= position
+
+    def reaches(self, source, target):
+        """Is target reachable from source (every node reaches itself)"""
+        position = self.post[target]
+        if self.labels[source] is not None:
+            return self._in_label(source, position)
+        if source == target:
+            return True
+        # unlabelled region, search it, labelled nodes answer for their
+        # whole sub-graph...
+        seen = bytearray(len(self.post))
+        seen[source] = 1
+        stack = [source]
+        while stack:
+            for child in self.successors[stack.pop()]:
+                if seen[child]:
+                    continue
+                seen[child] = 1
+                if child == target:
+                    return True
+                if self.labels[child] is None:
+                    stack.append(child)
+                elif self._in_label(child, position):
+                    return True
+        return False
+
+    def _ranges(self, node):
+        """Merged post-order ranges reachable from node (labelled or not)"""
+        label = self.labels[node]
+        if label is not None:
+            return label
+        position = self.post[node]
+        ranges = [(position, position)]
+        seen = bytearray(len(self.post))
+        seen[node] = 1
+        stack = [node]
+        while stack:
+            for child in self.successors[stack.pop()]:
+                if seen[child]:
+                    continue
+                seen[child] = 1
+                label = self.labels[child]
+                if label is None:
+                    position = self.post[child]
+                    ranges.append((position, position))
+                    stack.append(child)
+                else:
+                    ranges.extend(label)
+        return merge_ranges(ranges)
+
+    def total(self, node, name):
+        """Total of the weight over all nodes reachable from node (inclusive)"""
+        key = (node, name)
+        if key in self.totals:
+            return self.totals[key]
+        prefix = self.weights[name]
+        total = sum(
+            [prefix[stop + 1] - prefix[start] for start, stop in self._ranges(node)]
+        )
+        if self.labels[node] is None:
+            # expensive to recompute, the unlabelled nodes are few
+            self.totals[key] = total
+        return total
+
+    def size(self, node):
+        """Number of nodes reachable from node (inclusive)"""
+        return sum([stop - start + 1 for start, stop in self._ranges(node)])
+
+
+def merge_ranges(ranges):
+    """Merge overlapping/adjacent inclusive (start, stop) ranges"""
+    ranges.sort()
+    result = []
+    for start, stop in ranges:
+        if result and start <= result[-1][1] + 1:
+            if stop > result[-1][1]:
+                result[-1] = (result[-1][0], stop)
+        else:
+            result.append((start, stop))
+    return result
+
+
+class ReachabilityIndex(object):
+    """Precomputed reachability over a graph of dense node ids
+
+    The graph is condensed into its strongly connected components, which
+    are labelled with IntervalLabels in both directions, giving log-time
+    "is X reachable from Y" queries and ancestor/descendant counts and
+    weight totals in time proportional to the (small) number of label
+    ranges.
+
+    Descendants and ancestors follow BaseStat.descendants semantics, a
+    node only counts as its own descendant/ancestor when it is part of a
+    cycle.
+
+    count -- number of nodes (dense ids 0 .. count-1)
+    successors -- callable returning the successor ids of a node id
+    weights -- optional mapping of name: per-node weight sequences
+    """
+
+    def __init__(self, count, successors, weights=None):
+        self.count = count
+        self.component, self.components = strongly_connected_components(
+            count, successors
+        )
+        forward, backward, self.cyclic = condense(
+            count, successors, self.component, self.components
+        )
+        self.forward = IntervalLabels(self.components, forward)
+        self.backward = IntervalLabels(self.components, backward)
+        self.weights = {}
+        self.add_weights('count', [1] * count)
+        for name, values in (weights or {}).items():
+            self.add_weights(name, values)
+
+    def add_weights(self, name, values):
+        """Register per-node weights (totalled per component)"""
+        totals = [0] * self.components
+        for node, value in enumerate(values):
+            totals[self.component[node]] += value
+        self.weights[name] = totals
+        self.forward.add_weights(name, totals)
+        self.backward.add_weights(name, totals)
+
+    def reaches(self, source, target):
+        """Is target reachable from source via at least one edge"""
+        source, target = self.component[source], self.component[target]
+        if source == target:
+            return bool(self.cyclic[source])
+        return self.forward.reaches(source, target)
+
+    def _reachable_total(self, labels, node, name):
+        component = self.component[node]
+        total = labels.total(component, name)
+        if not self.cyclic[component]:
+            # a node is only its own descendant/ancestor via a cycle
+            total -= self.weights[name][component]
+        return total
+
+    def descendant_count(self, node):
+        """Number of distinct descendants of node"""
+        return self._reachable_total(self.forward, node, 'count')
+
+    def ancestor_count(self, node):
+        """Number of distinct ancestors of node"""
+        return self._reachable_total(self.backward, node, 'count')
+
+    def descendant_total(self, node, name):
+        """Total of the named weight over the distinct descendants of node"""
+        return self._reachable_total(self.forward, node, name)
+
+    def ancestor_total(self, node, name):
+        """Total of the named weight over the distinct ancestors of node"""
+        return self._reachable_total(self.backward, node, name)
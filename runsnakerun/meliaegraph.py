@@ -0,0 +1,902 @@
+"""Compact (array-backed) object graph for meliae memory dumps
+
+Keeping every heap object as a dictionary with its own refs/parents lists
+(as the record functions of meliaeloader do) needs several times the size
+of the dump in memory.  MemoryGraph stores the objects by dense integer id
+in typed arrays instead:
+
+* address, size, type, name and len of each object in parallel arrays
+  (strings interned in a single table)
+* references and parents as CSR (offset/target) arrays of ids, records
+  whose references or parents are rewritten by the analysis (dictionary
+  simplification, grouping, loop promotion) get a list in an override
+  mapping, which is a small fraction of the graph
+* the has-a model (totsize, rsize, module, children) in further arrays
+
+load() runs the analysis (reachability, dict simplification, grouping,
+loop promotion, has-a totals) on the ids, it is the implementation of
+meliaeloader.load.  MemoryRecord (a dict-like view of one object) and
+MemoryIndex (an address: record mapping) present the result through the
+API of dictionary records, so the adapter, list views and reports need
+not know about the ids.
+"""
+from __future__ import absolute_import
+import logging, weakref
+from array import array
+from bisect import bisect_right
+import six
+from six.moves import range
+from gettext import gettext as _
+from runsnakerun import meliaeloader, graphs
+from runsnakerun.pstatsloader import INT64
+from runsnakerun.progress import as_progress
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+log = logging.getLogger(__name__)
+
+# bits of MemoryGraph.flags
+DELETED = 1
+COMPRESSED = 2
+# totsize/rsize/children have been calculated
+SIZED = 4
+# the record has no 'refs' (the root and synthetic groupings)
+NO_REFS = 8
+
+
+class MemoryGraph(object):
+    """Object graph of a meliae dump indexed by dense integer ids
+
+    filename -- the dump (the name of the root record)
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.strings = []
+        self.string_ids = {}
+        self.addresses = array(INT64)
+        self.sizes = array(INT64)
+        self.types = array('i')
+        self.names = array('i')
+        self.lengths = array(INT64)
+        self.flags = bytearray()
+        # records which are not DELETED (see MemoryIndex.__len__)
+        self.live_count = 0
+        # sparse, only str/int objects have a value
+        self.values = {}
+        self.ref_offsets = array(INT64, [0])
+        # addresses while reading, ids (-1 for no such object) once resolved
+        self.ref_targets = array(INT64)
+        self.refs_override = {}
+        self.parent_offsets = None
+        self.parent_targets = None
+        self.parents_override = {}
+        self.totsize = array('d')
+        self.rsize = array('d')
+        self.modules = array('i')
+        self.child_offsets = array(INT64)
+        self.child_counts = array('i')
+        self.child_targets = array('i')
+        # addresses of the records created after the dump was read
+        self.synthetic = {}
+        self.sorted_addresses = array(INT64)
+        self.sorted_ids = array('i')
+        # keys set on records by clients (e.g. the adapter's 'contribution')
+        self.extra = {}
+        # visited-map for the traversals, all zero between them
+        self.seen = bytearray()
+        self.views = weakref.WeakValueDictionary()
+        self.index = MemoryIndex(self)
+        self.index_ref = meliaeloader.Ref(self.index)
+        self.root_ref = None
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        current = self.string_ids.get(value)
+        if current is None:
+            current = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return current
+
+    def type_ids(self, types):
+        """Set of the string ids of types (which occur in the graph)"""
+        return set([self.string_ids[t] for t in types if t in self.string_ids])
+
+    def add(self, address, type, size, name=None, value=None, length=-1, refs=()):
+        """Add a record, refs are addresses before resolve(), ids after"""
+        id = len(self.addresses)
+        self.addresses.append(address)
+        self.sizes.append(size)
+        self.types.append(self.intern(type))
+        self.names.append(self.intern(name))
+        self.lengths.append(length)
+        self.flags.append(0)
+        self.live_count += 1
+        if value is not None:
+            self.values[id] = value
+        self.ref_targets.extend(refs)
+        self.ref_offsets.append(len(self.ref_targets))
+        if self.parent_offsets is not None:
+            self.parent_offsets.append(len(self.parent_targets))
+        self.totsize.append(0.0)
+        self.rsize.append(0.0)
+        self.modules.append(-1)
+        self.child_offsets.append(0)
+        self.child_counts.append(0)
+        return id
+
+    def new_address(self):
+        """Synthetic (negative) address for a record created by the analysis"""
+        address = -1 - len(self.synthetic)
+        while self.lookup(address) != -1:
+            address -= 1
+        self.synthetic[address] = len(self.addresses)
+        return address
+
+    def lookup(self, address):
+        """Id of the record with the given address, -1 if there is none"""
+        position = bisect_right(self.sorted_addresses, address) - 1
+        if position >= 0 and self.sorted_addresses[position] == address:
+            return self.sorted_ids[position]
+        return self.synthetic.get(address, -1)
+
+    def extend(self, chunk):
+        """Add the records of a meliaeloader.RecordChunk
+
+        returns the addresses of the modules in chunk
+        """
+        first = len(self.addresses)
+        strings = [self.intern(value) for value in chunk.strings]
+        strings.append(-1)
+        self.addresses.extend(chunk.addresses)
+        self.sizes.extend(chunk.sizes)
+        self.types.extend(array('i', [strings[t] for t in chunk.types]))
+        self.names.extend(array('i', [strings[n] for n in chunk.names]))
+        self.lengths.extend(chunk.lengths)
+        self.flags.extend(bytearray(len(chunk)))
+        self.live_count += len(chunk)
+        for position, value in six.iteritems(chunk.values):
+            self.values[first + position] = value
+        base = len(self.ref_targets)
+        self.ref_targets.extend(chunk.ref_targets)
+        self.ref_offsets.extend(
+            array(INT64, [base + offset for offset in chunk.ref_offsets[1:]])
+        )
+        count = len(self.addresses)
+        if self.parent_offsets is not None:
+            self.parent_offsets.extend(
+                array(INT64, [len(self.parent_targets)] * len(chunk))
+            )
+        self.totsize.extend(array('d', [0.0]) * len(chunk))
+        self.rsize.extend(array('d', [0.0]) * len(chunk))
+        self.modules.extend(array('i', [-1]) * len(chunk))
+        self.child_offsets.extend(array(INT64, [0]) * len(chunk))
+        self.child_counts.extend(array('i', [0]) * len(chunk))
+        module = chunk.string_ids.get('module')
+        if module is None:
+            return []
+        return [
+            self.addresses[id]
+            for id in range(first, count)
+            if chunk.types[id - first] == module
+        ]
+
+    def read(self, filename, progress=None, processes=None):
+        """Read the records of a meliae dump
+
+        processes -- see meliaeloader.read_records
+
+        returns the set of module addresses
+        """
+        progress = as_progress(progress)
+        if meliaeloader.parallel(filename, processes):
+            modules = set()
+            for chunk in meliaeloader.read_chunks(filename, progress, processes):
+                modules.update(self.extend(chunk))
+            return modules
+        add = self.add
+        modules = set()
+        for struct in meliaeloader.read_records(filename, progress):
+            add(
+                struct['address'],
+                struct['type'],
+                struct['size'],
+                struct.get('name'),
+                struct.get('value'),
+                struct.get('len', -1),
+                struct['refs'],
+            )
+            if struct['type'] == 'module':
+                modules.add(struct['address'])
+        return modules
+
+    def resolve(self):
+        """Index the addresses and replace reference addresses with ids"""
+        addresses = self.addresses
+        real = [id for id in range(len(addresses)) if addresses[id] >= 0]
+        real.sort(key=addresses.__getitem__)
+        self.sorted_ids = array('i', real)
+        del real
+        self.sorted_addresses = array(INT64, [addresses[id] for id in self.sorted_ids])
+        for position in range(len(self.sorted_ids) - 1):
+            if self.sorted_addresses[position] == self.sorted_addresses[position + 1]:
+                # as in a dictionary, the last record with an address wins
+                self.delete(self.sorted_ids[position])
+        lookup = self.lookup
+        self.ref_targets = array('i', [lookup(address) for address in self.ref_targets])
+
+    def index_parents(self, reachable):
+        """Build the parents CSR from the references
+
+        Unreachable parents of reachable records are dropped (the
+        unreachable records keep all of their parents).
+        """
+        count = len(self.addresses)
+        offsets, targets = self.ref_offsets, self.ref_targets
+        counts = array(INT64, [0]) * (count + 1)
+        for source in range(count):
+            keep = reachable[source]
+            for target in targets[offsets[source] : offsets[source + 1]]:
+                if target != -1 and (keep or not reachable[target]):
+                    counts[target + 1] += 1
+        for id in range(count):
+            counts[id + 1] += counts[id]
+        fill = array(INT64, counts[:-1])
+        parents = array('i', [0]) * counts[-1]
+        for source in range(count):
+            keep = reachable[source]
+            for target in targets[offsets[source] : offsets[source + 1]]:
+                if target != -1 and (keep or not reachable[target]):
+                    parents[fill[target]] = source
+                    fill[target] += 1
+        self.parent_offsets = counts
+        self.parent_targets = parents
+
+    def refs(self, id):
+        """Reference ids of id (do not modify, see edit_refs)"""
+        override = self.refs_override.get(id)
+        if override is not None:
+            return override
+        return self.ref_targets[self.ref_offsets[id] : self.ref_offsets[id + 1]]
+
+    def edit_refs(self, id):
+        """Modifiable list of the reference ids of id"""
+        override = self.refs_override.get(id)
+        if override is None:
+            override = self.refs_override[id] = list(self.refs(id))
+        return override
+
+    def parents(self, id):
+        """Parent ids of id (do not modify, see edit_parents)"""
+        override = self.parents_override.get(id)
+        if override is not None:
+            return override
+        if self.parent_offsets is None or id + 1 >= len(self.parent_offsets):
+            return ()
+        return self.parent_targets[
+            self.parent_offsets[id] : self.parent_offsets[id + 1]
+        ]
+
+    def edit_parents(self, id):
+        """Modifiable list of the parent ids of id"""
+        override = self.parents_override.get(id)
+        if override is None:
+            override = self.parents_override[id] = list(self.parents(id))
+        return override
+
+    def replace_parent(self, id, old, new):
+        """Replace parent old of id with new (at most once, as rewrite_references)
+
+        The common case (old is a parent once, new is not) is rewritten in
+        place rather than moving the parents to the override mapping.
+        """
+        parents = self.parents(id)
+        if id not in self.parents_override and new not in parents:
+            positions = [i for i, parent in enumerate(parents) if parent == old]
+            if len(positions) == 1:
+                self.parent_targets[self.parent_offsets[id] + positions[0]] = new
+                return
+        parents = self.edit_parents(id)
+        if parents:
+            meliaeloader.rewrite_references(parents, old, new, single_ref=True)
+
+    def set_parents(self, id, parents):
+        """Replace the parents of id (in place if the count is unchanged)"""
+        if id not in self.parents_override and len(self.parents(id)) == len(parents):
+            start = self.parent_offsets[id]
+            self.parent_targets[start : start + len(parents)] = array('i', parents)
+        else:
+            self.edit_parents(id)[:] = parents
+
+    def children(self, id, stop=()):
+        """Live referenced ids of id whose type (id) is not in stop"""
+        flags, types = self.flags, self.types
+        return [
+            target
+            for target in self.refs(id)
+            if target != -1
+            and not flags[target] & DELETED
+            and types[target] not in stop
+        ]
+
+    def sized_children(self, id):
+        """Children of the has-a model (see recurse_module)"""
+        start = self.child_offsets[id]
+        return self.child_targets[start : start + self.child_counts[id]]
+
+    def set_children(self, id, children):
+        self.child_offsets[id] = len(self.child_targets)
+        self.child_counts[id] = len(children)
+        self.child_targets.extend(children)
+
+    def live(self, id):
+        return id != -1 and not self.flags[id] & DELETED
+
+    def delete(self, id):
+        if not self.flags[id] & DELETED:
+            self.flags[id] |= DELETED
+            self.live_count -= 1
+
+    def scratch(self):
+        """The (all zero) visited-map, covering every id"""
+        missing = len(self.addresses) - len(self.seen)
+        if missing > 0:
+            self.seen.extend(bytearray(missing))
+        return self.seen
+
+    def record(self, id):
+        """Retrieve the (unique while referenced) MemoryRecord for id"""
+        view = self.views.get(id)
+        if view is None:
+            view = self.views[id] = MemoryRecord(self, id)
+        return view
+
+    def find_reachable(self, modules, stop):
+        """Byte-map of the records reachable from modules (not entering stop types)"""
+        reachable = bytearray(len(self.addresses))
+        for module in modules:
+            if reachable[module]:
+                continue
+            reachable[module] = 1
+            stack = [module]
+            while stack:
+                for child in self.children(stack.pop(), stop):
+                    if not reachable[child]:
+                        reachable[child] = 1
+                        stack.append(child)
+        return reachable
+
+    def simplify_dicts(
+        self,
+        simplify_dicts=meliaeloader.SIMPLIFY_DICTS,
+        always_compress=meliaeloader.ALWAYS_COMPRESS_DICTS,
+    ):
+        """Fold module/type/class dictionaries into their owner
+
+        see meliaeloader.simplify_dicts
+        """
+        rewrite = meliaeloader.rewrite_references
+        types, flags, sizes = self.types, self.flags, self.sizes
+        dict_type = self.string_ids.get('dict')
+        simplify = self.type_ids(simplify_dicts)
+        always = self.type_ids(always_compress)
+        to_delete = set()
+        for id in range(len(self.addresses)):
+            if flags[id] & (DELETED | COMPRESSED) or id in to_delete:
+                continue
+            if types[id] not in simplify:
+                continue
+            for ref in list(self.refs(id)):
+                if not self.live(ref) or types[ref] != dict_type:
+                    continue
+                referrers = list(self.parents(ref))
+                if len(referrers) == 1 or types[id] in always:
+                    flags[id] |= COMPRESSED
+                    self.refs_override[id] = self.edit_refs(ref)
+                    sizes[id] += sizes[ref]
+                    # anything *else* pointing to the dict now points to us
+                    while id in referrers:
+                        referrers.remove(id)
+                    for parent in referrers:
+                        if self.live(parent):
+                            rewrite(self.edit_refs(parent), ref, id, single_ref=True)
+                    # the dict's children now have us as parent
+                    for grandchild in self.refs(ref):
+                        if grandchild != -1:
+                            self.replace_parent(grandchild, ref, id)
+                    to_delete.add(ref)
+        for id in to_delete:
+            self.delete(id)
+
+    def group_children(self, min_kids=10, stop=()):
+        """Collect simple like-typed children into <many> records
+
+        see meliaeloader.group_children
+        """
+        to_compress = []
+        types, sizes = self.types, self.sizes
+        for id in range(len(self.addresses)):
+            if not self.live(id):
+                continue
+            groups = {}
+            order = []
+            for child in self.children(id, stop):
+                kids = groups.get(types[child])
+                if kids is None:
+                    kids = groups[types[child]] = []
+                    order.append(types[child])
+                kids.append(child)
+            for typ in order:
+                kids = [kid for kid in groups[typ] if self.simple(kid, id)]
+                if len(kids) >= min_kids:
+                    to_compress.append((id, typ, kids))
+        for id, typ, kids in to_compress:
+            many = self.add(
+                self.new_address(),
+                meliaeloader.MANY_TYPE,
+                sum([sizes[kid] for kid in kids], 0),
+                name=self.strings[typ],
+            )
+            self.parents_override[many] = [id]
+            self.edit_refs(id)[:] = [many]
+            for kid in kids:
+                self.delete(kid)
+
+    def simple(self, id, parent):
+        """Is id childless and referenced only by parent"""
+        if len(self.refs(id)):
+            return False
+        parents = self.parents(id)
+        return not len(parents) or list(parents) == [parent]
+
+    def find_loops(self, module, stop):
+        """Find reference loops below module (see meliaeloader.find_loops)
+
+        returns list of frozensets of the ids in each loop
+        """
+        loop_type = self.string_ids.get(meliaeloader.LOOP_TYPE)
+        types, children = self.types, self.children
+
+        def successors(id):
+            return [child for child in children(id, stop) if types[child] != loop_type]
+
+        return [
+            frozenset(members)
+            for members in graphs.cyclic_components(successors(module), successors)
+        ]
+
+    def promote_loops(self, loops):
+        """Turn loops into records (see meliaeloader.promote_loops)"""
+        loop_type = self.intern(meliaeloader.LOOP_TYPE)
+        for loop in loops:
+            members = list(loop)
+            external = set()
+            for member in members:
+                for parent in self.parents(member):
+                    if parent not in loop:
+                        external.add(parent)
+            if not external:
+                continue
+            external = list(external)
+            if len(external) == 1 and self.types[external[0]] == loop_type:
+                # potentially a loop that's been looped...
+                continue
+            loop_id = self.add(
+                self.new_address(), meliaeloader.LOOP_TYPE, 0, refs=members
+            )
+            self.parents_override[loop_id] = external
+            for member in members:
+                self.refs_override[member] = [
+                    ref for ref in self.refs(member) if ref not in loop
+                ]
+                self.set_parents(member, [loop_id])
+            for parent in external:
+                if not self.live(parent):
+                    continue
+                refs = self.edit_refs(parent)
+                refs[:] = [ref for ref in refs if ref not in loop]
+                refs.append(loop_id)
+
+    def recurse_module(self, module, stop, name=None):
+        """Calculate the has-a totals below module (see meliaeloader.recurse_module)
+
+        Children are sized before their parents (post-order), records which
+        were already sized (via another module) keep their totals.
+        """
+        flags, sizes, totsize, rsize = self.flags, self.sizes, self.totsize, self.rsize
+        if name is None:
+            name = self.names[module]
+            if name == -1:
+                name = self.intern(meliaeloader.NON_MODULE_REFS)
+        seen = self.scratch()
+        visited = []
+
+        def successors(id):
+            return self.children(id, stop)
+
+        for node in graphs.postorder(module, successors, seen):
+            visited.append(node)
+            if flags[node] & SIZED:
+                continue
+            self.modules[node] = name
+            if not len(self.refs(node)):
+                children = ()
+                rsize[node] = 0
+            else:
+                children = self.children(node, stop)
+                rsize[node] = sum(
+                    [
+                        (totsize[child] if flags[child] & SIZED else 0.0)
+                        / float(len(self.parents(child)) or 1)
+                        for child in children
+                    ],
+                    0.0,
+                )
+            self.set_children(node, children)
+            totsize[node] = sizes[node] + rsize[node]
+            flags[node] |= SIZED
+        for node in visited:
+            seen[node] = 0
+
+    def find_roots(self, disconnected, stop):
+        """Root records for the records not reachable from modules
+
+        Records with references but no parents are roots of their own, the
+        rest are collected into a synthetic '<disconnected objects>' module.
+        """
+        log.warn(
+            '%s disconnected objects in %s total objects',
+            len(disconnected),
+            len(self.index),
+        )
+        natural_roots = [
+            id
+            for id in disconnected
+            if len(self.refs(id)) and not len(self.parents(id))
+        ]
+        log.warn('%s objects with no parents at all', len(natural_roots))
+        for natural_root in natural_roots:
+            self.recurse_module(natural_root, stop)
+            yield natural_root
+        rest = [id for id in disconnected if not self.flags[id] & SIZED]
+        un_found = self.add(
+            self.new_address(), 'module', 0, name='<disconnected objects>'
+        )
+        self.flags[un_found] |= SIZED | NO_REFS
+        self.parents_override[un_found] = []
+        self.set_children(un_found, rest)
+        self.totsize[un_found] = sum([self.sizes[id] for id in rest], 0)
+        yield un_found
+
+
+def load(filename, include_interpreter=False, progress=None, processes=None):
+    """Load a meliae dump into a compact has-a memory hierarchy
+
+    The model of meliaeloader.load, MemoryRecords stand in for the
+    dictionary records.
+
+    processes -- see meliaeloader.read_records
+
+    returns (root, index)
+    """
+    progress = as_progress(progress)
+    graph = MemoryGraph(filename)
+    root_id = graph.add(graph.new_address(), 'dump', 0, name=filename)
+    graph.flags[root_id] |= NO_REFS
+    root = graph.record(root_id)
+    graph.root_ref = meliaeloader.Ref(root)
+
+    modules = graph.read(filename, progress, processes)
+    graph.resolve()
+    modules = [graph.lookup(address) for address in modules]
+    stop = graph.type_ids(meliaeloader.STOP_TYPES)
+
+    progress.start(_('reachability'))
+    reachable = graph.find_reachable(modules, stop)
+    graph.index_parents(reachable)
+    del reachable
+
+    progress.start(_('simplify'))
+    graph.simplify_dicts()
+
+    progress.start(_('group'))
+    graph.group_children(min_kids=10, stop=stop)
+
+    progress.start(_('loops'), len(modules))
+    for i, module in enumerate(modules):
+        progress.update(i, len(modules))
+        graph.promote_loops(graph.find_loops(module, stop))
+        graph.recurse_module(module, stop)
+
+    modules.sort(key=lambda module: graph.totsize[module])
+    for module in modules:
+        graph.edit_parents(module).append(root_id)
+
+    disconnected = [
+        id
+        for id in range(len(graph))
+        if id != root_id and graph.live(id) and not graph.flags[id] & SIZED
+    ]
+    if include_interpreter:
+        for pseudo_module in graph.find_roots(disconnected, stop):
+            graph.edit_parents(pseudo_module).append(root_id)
+            modules.append(pseudo_module)
+    else:
+        for id in disconnected:
+            graph.delete(id)
+
+    all_modules = sum([graph.totsize[module] for module in modules], 0)
+    graph.totsize[root_id] = graph.rsize[root_id] = all_modules
+    graph.set_children(root_id, modules)
+    graph.flags[root_id] |= SIZED
+    return root, graph.index
+
+
+def retained(graph):
+    """Retained-size model of a loaded MemoryGraph (see RetainedGraph)
+
+    returns (root, index)
+    """
+    view = RetainedGraph(graph)
+    root = view.record(0)
+    view.root_ref = meliaeloader.Ref(root)
+    return root, view.index
+
+
+class RetainedGraph(object):
+    """Dominator-tree view of a loaded (analysed) MemoryGraph
+
+    A record's children are the records it immediately dominates (every
+    path from the root to them passes through it), its only parent is its
+    immediate dominator and its totsize is its retained size: the memory
+    freed if it were released.  The references followed are those of the
+    has-a model (after dict simplification, grouping and loop promotion),
+    the records themselves (address, type, refs, ...) are shared with the
+    underlying graph.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        stop = graph.type_ids(meliaeloader.STOP_TYPES)
+        flags = graph.flags
+
+        def successors(id):
+            if flags[id] & NO_REFS:
+                return graph.sized_children(id)
+            return graph.children(id, stop)
+
+        count = len(graph)
+        self.idom, order = graphs.dominators(count, successors, 0)
+        reached = bytearray(count)
+        totsize = array('d', [0.0]) * count
+        sizes = graph.sizes
+        for id in order:
+            reached[id] = 1
+            totsize[id] = sizes[id]
+        counts = array('i', [0]) * count
+        for id in order[:0:-1]:
+            totsize[self.idom[id]] += totsize[id]
+            counts[self.idom[id]] += 1
+        self.totsize = totsize
+        self.rsize = array('d', [totsize[id] - sizes[id] for id in range(count)])
+        self.flags = bytearray(
+            [
+                flag | SIZED if seen else flag | DELETED
+                for flag, seen in zip(flags, reached)
+            ]
+        )
+        self.live_count = len(order)
+        self.child_counts = counts
+        self.child_offsets = offsets = array(INT64, [0]) * count
+        for id in range(1, count):
+            offsets[id] = offsets[id - 1] + counts[id - 1]
+        fill = array(INT64, offsets)
+        self.child_targets = array('i', [0]) * (len(order) - 1)
+        for id in order[1:]:
+            parent = self.idom[id]
+            self.child_targets[fill[parent]] = id
+            fill[parent] += 1
+        self.extra = {}
+        self.views = weakref.WeakValueDictionary()
+        self.index = MemoryIndex(self)
+        self.index_ref = meliaeloader.Ref(self.index)
+        self.root_ref = None
+
+    def __getattr__(self, name):
+        # record data (addresses, types, refs, ...) of the underlying graph
+        return getattr(self.graph, name)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def parents(self, id):
+        parent = self.idom[id]
+        return (parent,) if parent != -1 else ()
+
+    def sized_children(self, id):
+        start = self.child_offsets[id]
+        return self.child_targets[start : start + self.child_counts[id]]
+
+    def live(self, id):
+        return id != -1 and not self.flags[id] & DELETED
+
+    def record(self, id):
+        view = self.views.get(id)
+        if view is None:
+            view = self.views[id] = MemoryRecord(self, id)
+        return view
+
+
+class MemoryRecord(Mapping):
+    """Dictionary-like view of a single record of a MemoryGraph
+
+    Provides the keys of the dictionary records of meliaeloader
+    (address, type, size, name, value, len, refs, parents, children,
+    totsize, rsize, module, compressed, root, index).  Other keys can be
+    set (as the adapter caches values on the records) and are stored in
+    the graph.
+    """
+
+    __slots__ = ('graph', 'id', '__weakref__')
+
+    def __init__(self, graph, id):
+        self.graph = graph
+        self.id = id
+
+    def __repr__(self):
+        return 'MemoryRecord( %r, %r, %r )' % (
+            self.get('address'),
+            self.get('type'),
+            self.get('name'),
+        )
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, MemoryRecord)
+            and other.graph is self.graph
+            and other.id == self.id
+        )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def keys(self):
+        return [key for key in FIELDS if self._has(key)] + list(
+            self.graph.extra.get(self.id, ())
+        )
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            return self._has(key)
+        return key in self.graph.extra.get(self.id, ())
+
+    def _has(self, key):
+        graph, id = self.graph, self.id
+        flags = graph.flags[id]
+        if key in ('totsize', 'rsize', 'children', 'module'):
+            return bool(flags & SIZED) and (key != 'module' or graph.modules[id] != -1)
+        elif key == 'name':
+            return graph.names[id] != -1
+        elif key == 'value':
+            return id in graph.values
+        elif key == 'len':
+            return graph.lengths[id] != -1
+        elif key == 'refs':
+            return not flags & NO_REFS
+        elif key == 'parents':
+            return id != 0
+        elif key == 'compressed':
+            return bool(flags & COMPRESSED)
+        return True
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            if not self._has(key):
+                raise KeyError(key)
+            return FIELDS[key](self.graph, self.id)
+        try:
+            return self.graph.extra[self.id][key]
+        except KeyError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in FIELDS:
+            raise KeyError('%s is calculated by the loader' % (key,))
+        self.graph.extra.setdefault(self.id, {})[key] = value
+
+    def __delitem__(self, key):
+        del self.graph.extra[self.id][key]
+
+
+def _addresses(graph, ids):
+    addresses = graph.addresses
+    return [addresses[id] for id in ids if id != -1]
+
+
+FIELDS = {
+    'address': lambda graph, id: graph.addresses[id],
+    'type': lambda graph, id: graph.strings[graph.types[id]],
+    'size': lambda graph, id: graph.sizes[id],
+    'name': lambda graph, id: graph.strings[graph.names[id]],
+    'value': lambda graph, id: graph.values[id],
+    'len': lambda graph, id: graph.lengths[id],
+    'refs': lambda graph, id: _addresses(graph, graph.refs(id)),
+    'parents': lambda graph, id: _addresses(graph, graph.parents(id)),
+    'children': lambda graph, id: [
+        graph.record(child) for child in graph.sized_children(id)
+    ],
+    'totsize': lambda graph, id: graph.totsize[id],
+    'rsize': lambda graph, id: graph.rsize[id],
+    'module': lambda graph, id: graph.strings[graph.modules[id]],
+    'compressed': lambda graph, id: True,
+    'root': lambda graph, id: graph.root_ref,
+    'index': lambda graph, id: graph.index_ref,
+}
+
+
+class MemoryIndex(Mapping):
+    """address: MemoryRecord mapping of the live records of a MemoryGraph"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, address):
+        id = self.graph.lookup(address)
+        if not self.graph.live(id):
+            raise KeyError(address)
+        return self.graph.record(id)
+
+    def __contains__(self, address):
+        return self.graph.live(self.graph.lookup(address))
+
+    def __iter__(self):
+        addresses, flags = self.graph.addresses, self.graph.flags
+        for id in range(len(addresses)):
+            if not flags[id] & DELETED:
+                yield addresses[id]
+
+    def __len__(self):
+        return self.graph.live_count
+
+    def records(self):
+        """Iterate over the live records (in id order)"""
+        graph = self.graph
+        flags = graph.flags
+        for id in range(len(flags)):
+            if not flags[id] & DELETED:
+                yield graph.record(id)
+
+    def values(self):
+        return list(self.records())
+
+    def itervalues(self):
+        return self.records()
+
+    def items(self):
+        return [(record['address'], record) for record in self.records()]
+
+    def iteritems(self):
+        for record in self.records():
+            yield record['address'], record
@@ -14,20 +14,16 @@ Trees:
 """
 from __future__ import absolute_import
 from __future__ import print_function
-import logging, sys, weakref
+import logging, sys, os, weakref
+from array import array
 import six
+from runsnakerun.progress import as_progress, STEP
+from runsnakerun.pstatsloader import INT64
 
 log = logging.getLogger(__name__)
 from gettext import gettext as _
 
-try:
-    from ._meliaejson import loads as json_loads
-except ImportError as err:
-    try:
-        from json import loads as json_loads
-    except ImportError as err:
-        from simplejson import loads as json_loads
-import sys
+from runsnakerun import _meliaejson, graphs
 
 LOOP_TYPE = _('<loop>')
 MANY_TYPE = _('<many>')
@@ -35,6 +31,11 @@ NON_MODULE_REFS = _('<non-module-references>')
 
 STOP_TYPES = set(['module'])
 
+# below this many bytes the process pool costs more than it saves
+MIN_PARALLEL_BYTES = 32 * 1024 * 1024
+# byte-range chunks per worker process (balances the load, paces the progress)
+CHUNKS_PER_PROCESS = 4
+
 
 def recurse(record, index, stop_types=STOP_TYPES, already_seen=None, type_group=False):
     """Depth first traversal of a tree, all children are yielded before parent
@@ -44,68 +45,78 @@ def recurse(record, index, stop_types=STOP_TYPES, already_seen=None, type_group=
     stop_types -- types which will *not* recurse 
     already_seen -- set storing already-visited nodes 
     
+    Uses an explicit stack (see graphs.postorder), so long reference chains
+    do not hit the recursion limit.
+
     yields the traversed nodes
     """
     if already_seen is None:
         already_seen = set()
-    if record['address'] not in already_seen:
-        already_seen.add(record['address'])
+    if record['address'] in already_seen:
+        return
+    already_seen.add(record['address'])
+
+    def successors(record):
         if 'refs' in record:
-            for child in children(record, index, stop_types=stop_types):
-                if child['address'] not in already_seen:
-                    for descendant in recurse(
-                        child,
-                        index,
-                        stop_types,
-                        already_seen=already_seen,
-                        type_group=type_group,
-                    ):
-                        yield descendant
-        yield record
-
-
-def find_loops(record, index, stop_types=STOP_TYPES, open=None, seen=None):
-    """Find all loops within the index and replace with loop records"""
-    if open is None:
-        open = []
-    if seen is None:
-        seen = set()
-    for child in children(record, index, stop_types=stop_types):
-        if child['type'] in stop_types or child['type'] == LOOP_TYPE:
-            continue
-        if child['address'] in open:
-            # loop has been found
-            start = open.index(child['address'])
-            new = frozenset(open[start:])
-            if new not in seen:
-                seen.add(new)
-                yield new
-        elif child['address'] in seen:
-            continue
+            return iter(children(record, index, stop_types=stop_types))
+        return iter(())
+
+    records, stack = [record], [successors(record)]
+    seen = already_seen.add
+    while stack:
+        for child in stack[-1]:
+            if child['address'] not in already_seen:
+                seen(child['address'])
+                records.append(child)
+                stack.append(successors(child))
+                break
         else:
-            seen.add(child['address'])
-            open.append(child['address'])
-            for loop in find_loops(
-                child, index, stop_types=stop_types, open=open, seen=seen
-            ):
-                yield loop
-            open.pop(-1)
+            stack.pop()
+            yield records.pop()
+
+
+def find_loops(record, index, stop_types=STOP_TYPES):
+    """Find the reference loops below record (to be collapsed by promote_loops)
+
+    A loop is a strongly connected component of the records reachable from
+    record (more than one record, or a record which references itself),
+    found in linear time by graphs.cyclic_components.  Records of
+    stop_types and existing loop records are not entered.
+
+    returns list of frozensets of the addresses in each loop
+    """
+
+    def successors(address):
+        return [
+            child['address']
+            for child in children(index[address], index, stop_types=stop_types)
+            if child['type'] != LOOP_TYPE
+        ]
+
+    return [
+        frozenset(members)
+        for members in graphs.cyclic_components(
+            successors(record['address']), successors
+        )
+    ]
 
 
 def promote_loops(loops, index, shared):
-    """Turn loops into "objects" that can be processed normally"""
+    """Turn loops into "objects" that can be processed normally
+
+    loops -- sets of addresses (see find_loops), each becomes a single
+        LOOP_TYPE record, referenced once by each of the loop's external
+        parents and the only parent of each member
+    """
     for loop in loops:
-        loop = list(loop)
+        loop = frozenset(loop)
         members = [index[addr] for addr in loop]
-        external_parents = list(
-            set(
-                [
-                    addr
-                    for addr in sum([shared.get(addr, []) for addr in loop], [])
-                    if addr not in loop
-                ]
-            )
-        )
+        external_parents = set()
+        for addr in loop:
+            for parent in shared.get(addr, ()):
+                if parent not in loop:
+                    external_parents.add(parent)
+        external_parents = list(external_parents)
         if external_parents:
             if len(external_parents) == 1:
                 # potentially a loop that's been looped...
@@ -117,7 +128,7 @@ def promote_loops(loops, index, shared):
             shared[loop_addr] = external_parents
             loop_record = index[loop_addr] = {
                 'address': loop_addr,
-                'refs': loop,
+                'refs': [member['address'] for member in members],
                 'parents': external_parents,
                 'type': LOOP_TYPE,
                 'size': 0,
@@ -129,10 +140,9 @@ def promote_loops(loops, index, shared):
                 member['parents'][:] = [loop_addr]
             # each referent to loop holds a single reference to the loop rather than many to children
             for parent in external_parents:
-                parent = index[parent]
-                for member in members:
-                    rewrite_references(parent['refs'], member['address'], None)
-                parent['refs'].append(loop_addr)
+                refs = index[parent]['refs']
+                refs[:] = [ref for ref in refs if ref not in loop]
+                refs.append(loop_addr)
 
 
 def children(record, index, key='refs', stop_types=STOP_TYPES):
@@ -380,32 +390,6 @@ def simplify_dicts(
     return index
 
 
-def find_reachable(modules, index, shared, stop_types=STOP_TYPES):
-    """Find the set of all reachable objects from given root nodes (modules)"""
-    reachable = set()
-    already_seen = set()
-    for module in modules:
-        for child in recurse(
-            module, index, stop_types=stop_types, already_seen=already_seen
-        ):
-            reachable.add(child['address'])
-    return reachable
-
-
-def deparent_unreachable(reachable, shared):
-    """Eliminate all parent-links from unreachable objects from reachable objects
-    """
-    for id, shares in six.iteritems(shared):
-        if id in reachable:  # child is reachable
-            filtered = [
-                x
-                for x in shares
-                if x in reachable  # only those parents which are reachable
-            ]
-            if len(filtered) != len(shares):
-                shares[:] = filtered
-
-
 class _syntheticaddress(object):
     current = -1
 
@@ -424,6 +408,14 @@ def index_size(index):
 
 
 def iterindex(index):
+    records = getattr(index, 'records', None)
+    if records is not None:
+        # a meliaegraph.MemoryIndex, every value is a record
+        return records()
+    return _iterdicts(index)
+
+
+def _iterdicts(index):
     for (k, v) in six.iteritems(index):
         if isinstance(v, dict) and isinstance(k, six.integer_types):
             yield v
@@ -441,131 +433,226 @@ def check_parents(index, reachable):
             print('parents', item['parents'])
 
 
-def load(filename, include_interpreter=False):
-    index = {}  # address: structure
-    shared = dict()  # address: [parent addresses,...]
-    modules = set()
-
-    root_address = new_address(index)
-    root = {
-        'type': 'dump',
-        'name': filename,
-        'children': [],
-        'totsize': 0,
-        'rsize': 0,
-        'size': 0,
-        'address': root_address,
-    }
-    index[root_address] = root
-    index_ref = Ref(index)
-    root_ref = Ref(root)
-
-    root['root'] = root_ref
-    root['index'] = index_ref
-
-    raw_total = 0
-
-    for line in open(filename):
-        struct = json_loads(line.strip())
-        index[struct['address']] = struct
-
-        struct['root'] = root_ref
-        struct['index'] = index_ref
-
-        refs = struct['refs']
-        for ref in refs:
-            parents = shared.get(ref)
-            if parents is None:
-                shared[ref] = []
-            shared[ref].append(struct['address'])
-        raw_total += struct['size']
-        if struct['type'] == 'module':
-            modules.add(struct['address'])
-
-    modules = [index[addr] for addr in modules]
-
-    reachable = find_reachable(modules, index, shared)
-    deparent_unreachable(reachable, shared)
-
-    bind_parents(index, shared)
-
-    #    unreachable = sum([
-    #        v.get( 'size' )
-    #        for v in iterindex( index )
-    #        if v['address'] not in reachable
-    #    ], 0 )
-    #    print '%s bytes are unreachable from modules'%( unreachable )
-
-    simplify_dicts(index, shared)
-
-    group_children(index, shared, min_kids=10)
-
-    records = []
-    for m in modules:
-        loops = list(find_loops(m, index))
-        promote_loops(loops, index, shared)
-        recurse_module(m, index, shared)
-
-    modules.sort(key=lambda m: m.get('totsize', 0))
-    for module in modules:
-        module['parents'].append(root_address)
-
-    if include_interpreter:
-        # Meliae produces quite a few of these un-referenced records, they aren't normally useful AFAICS
-        # reachable from any module, but are present in the dump...
-        disconnected = [x for x in iterindex(index) if x.get('totsize') is None]
-        for pseudo_module in find_roots(disconnected, index, shared):
-            pseudo_module['root'] = root_ref
-            pseudo_module['index'] = index_ref
-            pseudo_module.setdefault('parents', []).append(root_address)
-            modules.append(pseudo_module)
-    else:
-        to_delete = []
-        for v in iterindex(index):
-            if v.get('totsize') is None:
-                to_delete.append(v['address'])
-        for k in to_delete:
-            del index[k]
+def line_ranges(filename, count):
+    """Split filename into up to count (start, end) byte ranges on line boundaries"""
+    total = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as fh:
+        for i in range(1, count):
+            position = total * i // count
+            if position <= bounds[-1]:
+                continue
+            # finish the line which holds the byte before position
+            fh.seek(position - 1)
+            fh.readline()
+            position = fh.tell()
+            if bounds[-1] < position < total:
+                bounds.append(position)
+    bounds.append(total)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class RecordChunk(object):
+    """The records of a byte range of a meliae dump in compact arrays
+
+    Produced by read_chunk in a worker process, the arrays pickle far more
+    compactly (and quickly) than the decoded dictionaries.  Only the fields
+    meliae writes (address, type, size, name, value, len, refs) are kept.
+    """
 
-    all_modules = sum([x.get('totsize', 0) for x in modules], 0)
+    def __init__(self, size=0):
+        self.size = size
+        self.strings = []
+        self.string_ids = {}
+        self.addresses = array(INT64)
+        self.sizes = array(INT64)
+        self.types = array('i')
+        self.names = array('i')
+        # -1 where the record has no len
+        self.lengths = array(INT64)
+        # sparse, position: value
+        self.values = {}
+        self.ref_offsets = array(INT64, [0])
+        self.ref_targets = array(INT64)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def intern(self, value):
+        if value is None:
+            return -1
+        current = self.string_ids.get(value)
+        if current is None:
+            current = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return current
+
+    def add(self, struct):
+        if 'value' in struct:
+            self.values[len(self.addresses)] = struct['value']
+        self.addresses.append(struct['address'])
+        self.sizes.append(struct['size'])
+        self.types.append(self.intern(struct['type']))
+        self.names.append(self.intern(struct.get('name')))
+        self.lengths.append(struct.get('len', -1))
+        self.ref_targets.extend(struct['refs'])
+        self.ref_offsets.append(len(self.ref_targets))
+
+    def records(self):
+        """Generate the records as the dictionaries the decoders produce"""
+        strings = self.strings
+        offsets, targets = self.ref_offsets, self.ref_targets
+        for position in range(len(self.addresses)):
+            struct = {
+                'address': self.addresses[position],
+                'type': strings[self.types[position]],
+                'size': self.sizes[position],
+                'refs': list(targets[offsets[position] : offsets[position + 1]]),
+            }
+            if self.names[position] != -1:
+                struct['name'] = strings[self.names[position]]
+            if self.lengths[position] != -1:
+                struct['len'] = self.lengths[position]
+            if position in self.values:
+                struct['value'] = self.values[position]
+            yield struct
 
-    root['totsize'] = all_modules
-    root['rsize'] = all_modules
-    root['size'] = 0
-    root['children'] = modules
 
-    for item in iterindex(index):
-        item['root'] = root_ref
-        item['index'] = index_ref
+def line_batches(fh, size=None):
+    """Generate (lines, bytes) batches of up to STEP non-blank lines of fh
+
+    size -- if set, stop after the line which reaches size bytes
+    """
+    lines = []
+    read_bytes = 0
+    for line in fh:
+        read_bytes += len(line)
+        if size is not None:
+            size -= len(line)
+        line = line.strip()
+        if line:
+            lines.append(line)
+        if len(lines) >= STEP:
+            yield lines, read_bytes
+            lines, read_bytes = [], 0
+        if size is not None and size <= 0:
+            break
+    yield lines, read_bytes
+
+
+def read_chunk(job):
+    """Decode the lines of byte range (filename, start, end) into a RecordChunk"""
+    filename, start, end = job
+    chunk = RecordChunk(end - start)
+    add = chunk.add
+    name, decode = _meliaejson.fastest()
+    with open(filename, 'rb') as fh:
+        fh.seek(start)
+        for lines, size in line_batches(fh, end - start):
+            for struct in decode(lines):
+                add(struct)
+    return chunk
+
+
+def parallel(filename, processes):
+    """Whether reading filename with processes should use the process pool"""
+    return bool(processes) and os.path.getsize(filename) >= MIN_PARALLEL_BYTES
+
+
+def read_chunks(filename, progress=None, processes=True):
+    """Decode a meliae dump in a process pool, generating RecordChunks in file order
+
+    processes -- True for one worker per cpu, or a count
+    """
+    import multiprocessing
+
+    progress = as_progress(progress)
+    if processes is True:
+        processes = multiprocessing.cpu_count()
+    total_bytes = os.path.getsize(filename)
+    jobs = [
+        (filename, start, end)
+        for start, end in line_ranges(filename, processes * CHUNKS_PER_PROCESS)
+    ]
+    log.debug(
+        "Reading %s in %s chunks with %s processes", filename, len(jobs), processes
+    )
+    progress.start(_('read'), total_bytes)
+    read_bytes = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk in pool.imap(read_chunk, jobs):
+            read_bytes += chunk.size
+            progress.update(read_bytes, total_bytes)
+            yield chunk
+    finally:
+        pool.terminate()
+        pool.join()
 
-    return root, index
 
+def read_records(filename, progress=None, processes=None):
+    """Generate the records (dictionaries) of a meliae dump in file order
 
-def find_roots(disconnected, index, shared):
-    """Find appropriate "root" objects from which to recurse the hierarchies
-    
-    Will generate a synthetic root for anything which doesn't have any parents...
+    processes -- if set (True for one per cpu, or a count), and the dump is
+        at least MIN_PARALLEL_BYTES, decode the lines in a process pool (see
+        read_chunks), producing the same records as the serial read
     """
-    log.warn(
-        '%s disconnected objects in %s total objects', len(disconnected), len(index)
-    )
-    natural_roots = [x for x in disconnected if x.get('refs') and not x.get('parents')]
-    log.warn('%s objects with no parents at all', len(natural_roots))
-    for natural_root in natural_roots:
-        recurse_module(natural_root, index, shared)
-        yield natural_root
-    rest = [x for x in disconnected if x.get('totsize') is None]
-    un_found = {
-        'type': 'module',
-        'name': '<disconnected objects>',
-        'children': rest,
-        'parents': [],
-        'size': 0,
-        'totsize': sum([x['size'] for x in rest], 0),
-        'address': new_address(index),
-    }
-    index[un_found['address']] = un_found
-    yield un_found
+    progress = as_progress(progress)
+    if parallel(filename, processes):
+        for chunk in read_chunks(filename, progress, processes):
+            for struct in chunk.records():
+                yield struct
+        return
+    name, decode = _meliaejson.fastest()
+    log.debug("Decoding %s with %s", filename, name)
+    total_bytes = os.path.getsize(filename)
+    read_bytes = 0
+    progress.start(_('read'), total_bytes)
+    with open(filename, 'rb') as fh:
+        for lines, size in line_batches(fh):
+            for struct in decode(lines):
+                yield struct
+            read_bytes += size
+            progress.update(read_bytes, total_bytes)
+
+
+def load(filename, include_interpreter=False, progress=None, processes=None):
+    """Load a meliae dump into a has-a memory hierarchy
+
+    The objects are stored in a meliaegraph.MemoryGraph (typed arrays), the
+    root and the records of the index are dictionary-like views of it (see
+    meliaegraph.load).
+
+    progress -- progress.Progress instance to report the phases of the load
+        to (and to allow cancelling it from another thread)
+    processes -- if set (True for one per cpu, or a count), decode large
+        dumps in a process pool (see read_records)
+
+    returns (root, index)
+    """
+    from runsnakerun import meliaegraph
+
+    return meliaegraph.load(filename, include_interpreter, progress, processes)
+
+
+def retained(root, index, progress=None):
+    """Produce a retained-size (dominator tree) hierarchy from a has-a hierarchy
+
+    The has-a hierarchy splits the cost of a shared object between its
+    parents, here each record's children are the records it immediately
+    dominates (every path from the root to them passes through it), so
+    its totsize is the memory which would be freed with it.  References
+    are followed as in the has-a model (modules only from the root).
+
+    root, index -- result of load (the records are not modified)
+
+    returns (root, index) of new records (see meliaegraph.RetainedGraph)
+    """
+    from runsnakerun import meliaegraph
+
+    progress = as_progress(progress)
+    progress.start(_('dominators'))
+    return meliaegraph.retained(index.graph)
 
 
 class Ref(object):
@@ -577,28 +664,51 @@ class Ref(object):
 
 
 class Loader(object):
-    """A data-set loader for pulling root and rows from a meliae dump"""
+    """A data-set loader for pulling root and rows from a meliae dump
+
+    processes -- see load
+    """
 
-    def __init__(self, filename, include_interpreter=False):
+    def __init__(
+        self, filename, include_interpreter=False, progress=None, processes=None
+    ):
         self.filename = filename
         self.include_interpreter = include_interpreter
+        self.progress = progress
+        self.processes = processes
         self.roots = {}
 
-    ROOTS = ['memory']
+    ROOTS = ['memory', 'retained']
 
     def get_root(self, key):
         """Retrieve the given root by type-key"""
         if key not in self.roots:
-            root, self.rows = load(
-                self.filename, include_interpreter=self.include_interpreter
-            )
-            self.roots[key] = root
+            self.roots[key] = getattr(self, 'load_%s' % (key,))()
         return self.roots[key]
 
+    def load_memory(self):
+        root, self.rows = load(
+            self.filename,
+            include_interpreter=self.include_interpreter,
+            progress=self.progress,
+            processes=self.processes,
+        )
+        # later (lazy) work is not part of the load
+        self.progress = as_progress(None)
+        return root
+
+    def load_retained(self):
+        root, self.retained_rows = retained(
+            self.get_root('memory'), self.get_rows('memory'), self.progress
+        )
+        return root
+
     def get_rows(self, key):
         """Get the set of rows for the type-key"""
         if key not in self.roots:
             self.get_root(key)
+        if key == 'retained':
+            return self.retained_rows
         return self.rows
 
     def get_adapter(self, key):
@@ -0,0 +1,174 @@
+"""Persistent on-disk cache of loaded profile models
+
+Loading a large profile dump means unmarshalling the stats, building every
+row, weaving the call graph and finding the root.  The cache stores the
+resulting (flattened) model in a sidecar file so that a second open of the
+same dump only has to unpickle it.
+
+Entries are keyed by the size, modification time and a digest of the
+head and tail of every dump that contributed to the model (so a cache hit
+does not read the whole of a large dump), a dump that is re-written
+produces a new key and the stale entry for the same set of paths is
+removed.  The cache directory is kept below a configurable total size by
+discarding the least-recently-used entries.
+"""
+from __future__ import absolute_import
+import os, hashlib, logging, tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+log = logging.getLogger(__name__)
+
+# bump whenever the flattened model format changes...
+CACHE_VERSION = 3
+CACHE_EXTENSION = '.model'
+MAX_CACHE_SIZE = 1024 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+# bytes digested at each end of a dump (files up to twice this are read whole)
+SAMPLE_SIZE = 1024 * 1024
+
+
+def cache_directory():
+    """Retrieve (creating if necessary) the model cache directory
+
+    Lives in the RunSnakeRun configuration directory (see
+    runsnake.config_directory) without requiring the GUI to be importable.
+    """
+    from runsnakerun import homedirectory
+
+    base = homedirectory.appdatadirectory()
+    directory = os.path.join(base, 'RunSnakeRun', 'cache')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def file_digest(filename, sample=SAMPLE_SIZE):
+    """Calculate content digest for the given file
+
+    sample -- if not None, only digest this many bytes at the start and at
+        the end of the file (the size and modification time are part of
+        the cache key, this catches re-writes within the same second)
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        if sample is not None:
+            size = os.fstat(fh.fileno()).st_size
+            digest.update(fh.read(sample))
+            if size > 2 * sample:
+                fh.seek(size - sample)
+            digest.update(fh.read(sample))
+            return digest.hexdigest()
+        block = fh.read(BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = fh.read(BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def cache_key(filenames, variant=''):
+    """Calculate the cache key for the given set of dump files
+
+    variant -- distinguishes different model types built from the same files
+
+    returns (path_key, content_key) where path_key identifies the set of
+    files (and variant) and content_key identifies their current
+    size/mtime/content (see file_digest)
+    """
+    paths = hashlib.sha1()
+    paths.update(variant.encode('utf-8'))
+    content = hashlib.sha1()
+    content.update(('%s' % (CACHE_VERSION,)).encode('ascii'))
+    for filename in filenames:
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        paths.update(filename.encode('utf-8', 'replace'))
+        content.update(
+            (
+                '%s:%s:%s'
+                % (stat.st_size, int(stat.st_mtime * 1000), file_digest(filename))
+            ).encode('ascii')
+        )
+    return paths.hexdigest(), content.hexdigest()
+
+
+def entry_filename(key, directory):
+    return os.path.join(directory, '%s-%s%s' % (key[0], key[1], CACHE_EXTENSION))
+
+
+def fetch(key, directory=None):
+    """Retrieve the cached state for key or None if not present/unreadable"""
+    directory = directory or cache_directory()
+    filename = entry_filename(key, directory)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as fh:
+            version, state = pickle.load(fh)
+    except Exception as err:
+        log.warning('Unable to read model cache %s: %s', filename, err)
+        discard(filename)
+        return None
+    if version != CACHE_VERSION:
+        discard(filename)
+        return None
+    try:
+        # record the use for least-recently-used pruning
+        os.utime(filename, None)
+    except OSError:
+        pass
+    return state
+
+
+def store(key, state, directory=None, max_size=MAX_CACHE_SIZE):
+    """Store state for key, invalidating older entries for the same files"""
+    directory = directory or cache_directory()
+    filename = entry_filename(key, directory)
+    prefix = '%s-' % (key[0],)
+    for existing in os.listdir(directory):
+        if existing.startswith(prefix) and existing.endswith(CACHE_EXTENSION):
+            discard(os.path.join(directory, existing))
+    handle, temp = tempfile.mkstemp(suffix='~', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as fh:
+            pickle.dump((CACHE_VERSION, state), fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, filename)
+    except Exception:
+        discard(temp)
+        raise
+    prune(directory, max_size)
+    return filename
+
+
+def prune(directory, max_size=MAX_CACHE_SIZE):
+    """Remove least-recently-used entries until directory is below max_size"""
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if not name.endswith(CACHE_EXTENSION):
+            continue
+        filename = os.path.join(directory, name)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+        total += stat.st_size
+    entries.sort()
+    for mtime, size, filename in entries:
+        if total <= max_size:
+            break
+        log.info('Pruning model cache entry %s', filename)
+        discard(filename)
+        total -= size
+    return total
+
+
+def discard(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
@@ -0,0 +1,507 @@
+"""Versioned binary files of processed (analysed) models
+
+Loading a large profile or memory dump means reading the raw dump and
+then running the (slow) analysis, weaving the call graph and finding its
+root for pstats, reachability, dict simplification, grouping and loop
+promotion for meliae.  A model file stores the result of all of that so
+that it can be passed around and re-opened without repeating the work:
+
+    modelfile.save(loader, 'analysed.runsnake')
+    loader = modelfile.load('analysed.runsnake')
+
+File layout (little-endian prefix):
+
+    magic (8 bytes) version (u32) flags (u32) header length (u64)
+    header -- JSON, padded to a multiple of 8 bytes
+    body -- the arrays, each aligned to 8 bytes, zlib-compressed as a
+        whole if the FLAG_COMPRESSED flag is set
+
+The header describes each array as [typecode, offset, count] relative to
+the start of the body.  Uncompressed files are mapped with mmap and the
+arrays are zero-copy memoryviews of the mapping, compressed files are
+decompressed into memory once (the arrays are then views of that buffer).
+
+Profile models store the PStatTable arrays (see PStatTable.ARRAYS) with
+the entry points of the functions root, the location and context roots
+are derived from those when first viewed.  Memory models store every
+record of the processed has-a tree in the columns and CSR arrays of
+meliaegraph.MemoryGraph (references and parents as record numbers), so
+the graph is opened on the same views, only the flags, the (sparse)
+values and the string table are decoded.
+"""
+from __future__ import absolute_import
+import sys, os, io, json, mmap, struct, zlib, logging
+from array import array
+import six
+from six.moves import range
+from gettext import gettext as _
+from runsnakerun import pstatsloader, meliaeloader
+from runsnakerun.progress import as_progress
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'RUNSNAKE'
+VERSION = 3
+FLAG_COMPRESSED = 1
+PREFIX = struct.Struct('<8sIIQ')
+ALIGN = 8
+
+EXTENSION = '.runsnake'
+COMPRESSED_EXTENSION = '.runsnakez'
+
+# bits of the memory record flags column
+RECORD_INDEXED = 1
+RECORD_COMPRESSED = 2
+RECORD_UNCOMPRESSED = 4
+RECORD_REFS = 8
+# kinds of the memory record value column
+VALUE_NONE, VALUE_TEXT, VALUE_INT = -1, 0, 1
+
+
+def is_model(filename):
+    """Does filename start with the model file magic"""
+    try:
+        with open(filename, 'rb') as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def _tobytes(values):
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+class ModelWriter(object):
+    """Accumulates named arrays and writes them as a model file"""
+
+    def __init__(self, kind, **meta):
+        self.kind = kind
+        self.meta = meta
+        self.arrays = {}
+        self.body = io.BytesIO()
+
+    def add(self, name, values, typecode=None):
+        """Add an array (or sequence, with typecode) to the file"""
+        if not isinstance(values, array):
+            values = array(typecode, values)
+        padding = -self.body.tell() % ALIGN
+        self.body.write(b'\0' * padding)
+        self.arrays[name] = [values.typecode, self.body.tell(), len(values)]
+        self.body.write(_tobytes(values))
+
+    def add_strings(self, name, strings):
+        """Add a table of (unicode) strings as offsets and utf-8 data"""
+        offsets = array('q', [0])
+        data = bytearray()
+        for value in strings:
+            data.extend(value.encode('utf-8'))
+            offsets.append(len(data))
+        self.add('%s_offsets' % (name,), offsets)
+        self.add('%s_data' % (name,), array('B', bytes(data)))
+
+    def write(self, filename, compress=False):
+        header = json.dumps(
+            {
+                'kind': self.kind,
+                'byteorder': sys.byteorder,
+                'arrays': self.arrays,
+                'meta': self.meta,
+            },
+            sort_keys=True,
+        ).encode('utf-8')
+        header += b' ' * (-(PREFIX.size + len(header)) % ALIGN)
+        body = self.body.getvalue()
+        flags = 0
+        if compress:
+            body = zlib.compress(body, 6)
+            flags |= FLAG_COMPRESSED
+        # write to a temporary name, readers may have the old file mapped
+        temporary = '%s.tmp-%s' % (filename, os.getpid())
+        try:
+            with open(temporary, 'wb') as fh:
+                fh.write(PREFIX.pack(MAGIC, VERSION, flags, len(header)))
+                fh.write(header)
+                fh.write(body)
+            if os.name == 'nt' and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temporary, filename)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return filename
+
+
+class ModelFile(object):
+    """Read-side of a model file, arrays are views of the (mapped) file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            prefix = fh.read(PREFIX.size)
+            if len(prefix) != PREFIX.size:
+                raise ValueError('Truncated model file: %s' % (filename,))
+            magic, version, flags, length = PREFIX.unpack(prefix)
+            if magic != MAGIC:
+                raise ValueError('Not a model file: %s' % (filename,))
+            if version != VERSION:
+                raise ValueError(
+                    'Unsupported model file version %s (expected %s): %s'
+                    % (version, VERSION, filename)
+                )
+            header = json.loads(fh.read(length).decode('utf-8'))
+            if flags & FLAG_COMPRESSED:
+                self.buffer = zlib.decompress(fh.read())
+                self.base = 0
+            else:
+                self.buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                self.base = PREFIX.size + length
+        self.kind = header['kind']
+        self.meta = header['meta']
+        self.arrays = header['arrays']
+        self.swap = header['byteorder'] != sys.byteorder
+
+    def array(self, name):
+        """Retrieve the named array, zero-copy where the platform allows"""
+        typecode, offset, count = self.arrays[name]
+        size = array(typecode).itemsize
+        start = self.base + offset
+        if not self.swap and hasattr(memoryview, 'cast'):
+            return memoryview(self.buffer)[start : start + size * count].cast(typecode)
+        values = array(typecode)
+        data = self.buffer[start : start + size * count]
+        if hasattr(values, 'frombytes'):
+            values.frombytes(data)
+        else:
+            values.fromstring(data)
+        if self.swap:
+            values.byteswap()
+        return values
+
+    def strings(self, name):
+        """Retrieve a table of strings (see ModelWriter.add_strings)"""
+        offsets = self.array('%s_offsets' % (name,))
+        data = bytes(self.array('%s_data' % (name,)))
+        return [
+            data[offsets[i] : offsets[i + 1]].decode('utf-8')
+            for i in range(len(offsets) - 1)
+        ]
+
+
+def save(loader, filename, compress=None):
+    """Save the processed model of loader to filename
+
+    compress -- whether to compress the file, by default only if filename
+        ends with COMPRESSED_EXTENSION
+
+    Profile (pstatsloader.PStatsLoader) and memory (meliaeloader.Loader)
+    models can be saved, models with other roots (diffs, sampled calling
+    contexts) raise ValueError.
+    """
+    if compress is None:
+        compress = filename.endswith(COMPRESSED_EXTENSION)
+    if isinstance(loader, meliaeloader.Loader):
+        writer = memory_writer(loader)
+    elif isinstance(loader, pstatsloader.PStatsLoader) and set(loader.ROOTS) <= set(
+        pstatsloader.PStatsLoader.ROOTS
+    ):
+        writer = pstats_writer(loader)
+    else:
+        raise ValueError('Cannot save %s models' % (', '.join(loader.ROOTS),))
+    return writer.write(filename, compress)
+
+
+def load(filename, progress=None):
+    """Open a model file as a loader (PStatModelLoader or MemoryModelLoader)"""
+    model = ModelFile(filename)
+    if model.kind == 'pstats':
+        return PStatModelLoader(filename, model=model, progress=progress)
+    elif model.kind == 'memory':
+        return MemoryModelLoader(filename, model=model, progress=progress)
+    raise ValueError('Unknown model kind %r in %s' % (model.kind, filename))
+
+
+def kind(filename):
+    """Kind of model stored in filename ('pstats' or 'memory')"""
+    return ModelFile(filename).kind
+
+
+def pstats_writer(loader):
+    """Produce a ModelWriter for a profile model"""
+    table = loader.table
+    if table is None:
+        stats = dict(
+            [
+                (
+                    row.key,
+                    (row.calls, row.recursive, row.local, row.cumulative, row.callers),
+                )
+                for row in loader.dense_rows()
+            ]
+        )
+        table = pstatsloader.PStatTable(stats)
+    ids = dict([(table.key(id), id) for id in range(len(table))])
+    root = loader.get_root('functions')
+    if isinstance(root, pstatsloader.PStatGroup):
+        entries = [ids[child.key] for child in root.children]
+    else:
+        entries = [ids[root.key]]
+    writer = ModelWriter(
+        'pstats',
+        files=[six.text_type(name) for name in loader.filename],
+        entries=entries,
+        others=sorted([ids[key] for key in loader.others if key in ids]),
+    )
+    writer.add_strings('strings', [six.text_type(value) for value in table.strings])
+    for name in pstatsloader.PStatTable.ARRAYS:
+        writer.add(name, getattr(table, name))
+    return writer
+
+
+class PStatModelLoader(pstatsloader.PStatsLoader):
+    """Profile model read from a model file (see save)
+
+    The rows are views of a PStatTable whose arrays are (zero-copy) views
+    of the file, nothing is re-analysed beyond setting the entry points.
+    """
+
+    # watch mode (in-place updates) is not supported for saved models
+    update = None
+
+    def __init__(self, filename, model=None, progress=None):
+        self.filename = (filename,)
+        self.rows = {}
+        self.roots = {}
+        self.location_rows = {}
+        self.processes = None
+        self.columnar = True
+        self.reachability = None
+        self.progress = as_progress(progress)
+        self.progress.start(_('read'))
+        model = model or ModelFile(filename)
+        # the dumps the model was produced from
+        self.sources = model.meta['files']
+        table = pstatsloader.PStatTable.__new__(pstatsloader.PStatTable)
+        table.strings = model.strings('strings')
+        for name in pstatsloader.PStatTable.ARRAYS:
+            setattr(table, name, model.array(name))
+        table.extra_parents = {}
+        table.views = []
+        self.table = table
+        self.rows.update(table.rows())
+        self.others = frozenset([table.key(id) for id in model.meta['others']])
+        self.tree = self.set_entry_points(
+            [table.view(id) for id in model.meta['entries']]
+        )
+        self.progress = as_progress(None)
+
+
+def memory_writer(loader):
+    """Produce a ModelWriter for a (processed) meliae memory model"""
+    root = loader.get_root('memory')
+    index = loader.get_rows('memory')
+    records = [root]
+    numbers = {id(root): 0}
+    for record in meliaeloader.iterindex(index):
+        if id(record) not in numbers:
+            numbers[id(record)] = len(records)
+            records.append(record)
+    indexed = set(numbers)
+    # children which are not in the index (should not happen) are kept too
+    position = 0
+    while position < len(records):
+        for child in records[position].get('children', ()):
+            if id(child) not in numbers:
+                numbers[id(child)] = len(records)
+                records.append(child)
+        position += 1
+
+    # parents which are not saved (e.g. unreachable) are kept as records
+    # which are not indexed, so the parent counts (contributions) are kept
+    saved = set([record['address'] for record in records])
+    for record in records[:]:
+        for address in record.get('parents', ()):
+            if address not in saved:
+                saved.add(address)
+                records.append({'address': address})
+    del saved
+    # references resolve to record numbers as in MemoryGraph.resolve (the
+    # last record with an address wins)
+    lookup = dict([(record['address'], i) for i, record in enumerate(records)])
+
+    strings = []
+    string_ids = {}
+
+    def intern(value):
+        if value is None:
+            return -1
+        current = string_ids.get(value)
+        if current is None:
+            current = string_ids[value] = len(strings)
+            strings.append(value)
+        return current
+
+    # MemoryGraph's own columns (typecodes), so loading is zero-copy
+    columns = dict(
+        [
+            (name, array(typecode))
+            for name, typecode in (
+                ('address', 'q'),
+                ('size', 'q'),
+                ('totsize', 'd'),
+                ('rsize', 'd'),
+                ('length', 'q'),
+                ('type', 'i'),
+                ('name', 'i'),
+                ('module', 'i'),
+                ('flags', 'b'),
+                ('value_ids', 'i'),
+                ('value', 'i'),
+                ('value_kind', 'b'),
+                ('synthetic', 'i'),
+                ('children_counts', 'i'),
+            )
+        ]
+    )
+    adjacency = {}
+    for name in ('children', 'parents', 'refs'):
+        adjacency[name] = (array('q', [0]), array('i'))
+    for number, record in enumerate(records):
+        columns['address'].append(record['address'])
+        if record['address'] < 0:
+            columns['synthetic'].append(number)
+        columns['size'].append(record.get('size', 0))
+        columns['totsize'].append(record.get('totsize') or 0)
+        columns['rsize'].append(record.get('rsize') or 0)
+        columns['length'].append(record.get('len', -1))
+        columns['type'].append(intern(record.get('type')))
+        columns['name'].append(intern(record.get('name')))
+        columns['module'].append(intern(record.get('module')))
+        value = record.get('value')
+        if value is not None:
+            columns['value_ids'].append(number)
+            if isinstance(value, six.integer_types):
+                columns['value'].append(intern(six.text_type(value)))
+                columns['value_kind'].append(VALUE_INT)
+            else:
+                columns['value'].append(intern(value))
+                columns['value_kind'].append(VALUE_TEXT)
+        flags = RECORD_INDEXED if id(record) in indexed else 0
+        if 'compressed' in record:
+            flags |= RECORD_COMPRESSED if record['compressed'] else RECORD_UNCOMPRESSED
+        if 'refs' in record:
+            flags |= RECORD_REFS
+        columns['flags'].append(flags)
+        offsets, targets = adjacency['children']
+        targets.extend([numbers[id(child)] for child in record.get('children', ())])
+        columns['children_counts'].append(len(targets) - offsets[-1])
+        offsets.append(len(targets))
+        for name in ('parents', 'refs'):
+            offsets, targets = adjacency[name]
+            targets.extend(
+                [lookup.get(address, -1) for address in record.get(name, ())]
+            )
+            offsets.append(len(targets))
+    # lookup index of the real (dump) addresses, see MemoryGraph.lookup
+    real = sorted(
+        [number for number in lookup.values() if records[number]['address'] >= 0],
+        key=lambda number: records[number]['address'],
+    )
+    writer = ModelWriter(
+        'memory',
+        files=[six.text_type(loader.filename)],
+        include_interpreter=bool(loader.include_interpreter),
+        live=len(indexed),
+    )
+    writer.add_strings('strings', strings)
+    for name, values in columns.items():
+        writer.add(name, values)
+    for name, (offsets, targets) in adjacency.items():
+        writer.add('%s_offsets' % (name,), offsets)
+        writer.add(name, targets)
+    writer.add('sorted_ids', real, 'i')
+    writer.add('sorted_addresses', [records[number]['address'] for number in real], 'q')
+    return writer
+
+
+def _graph_flags():
+    """bytes.translate table from the flags column to MemoryGraph.flags"""
+    from runsnakerun import meliaegraph
+
+    table = bytearray(256)
+    for flags in range(256):
+        state = meliaegraph.SIZED
+        if flags & RECORD_COMPRESSED:
+            state |= meliaegraph.COMPRESSED
+        if not flags & RECORD_REFS:
+            state |= meliaegraph.NO_REFS
+        if not flags & RECORD_INDEXED:
+            state |= meliaegraph.DELETED
+        table[flags] = state
+    return bytes(table)
+
+
+def memory_graph(model, filename):
+    """Open the memory model as a meliaegraph.MemoryGraph
+
+    The graph's columns and adjacency (CSR) arrays are the arrays of the
+    file (zero-copy views of the mapping where the platform allows), only
+    the flags, the sparse values and the string table are decoded.
+
+    returns (root, index)
+    """
+    from runsnakerun import meliaegraph
+
+    graph = meliaegraph.MemoryGraph(filename)
+    graph.strings = model.strings('strings')
+    graph.string_ids = dict([(value, i) for i, value in enumerate(graph.strings)])
+    for attribute, name in (
+        ('addresses', 'address'),
+        ('sizes', 'size'),
+        ('types', 'type'),
+        ('names', 'name'),
+        ('lengths', 'length'),
+        ('totsize', 'totsize'),
+        ('rsize', 'rsize'),
+        ('modules', 'module'),
+        ('ref_offsets', 'refs_offsets'),
+        ('ref_targets', 'refs'),
+        ('parent_offsets', 'parents_offsets'),
+        ('parent_targets', 'parents'),
+        ('child_offsets', 'children_offsets'),
+        ('child_targets', 'children'),
+        ('child_counts', 'children_counts'),
+        ('sorted_ids', 'sorted_ids'),
+        ('sorted_addresses', 'sorted_addresses'),
+    ):
+        setattr(graph, attribute, model.array(name))
+    graph.flags = bytearray(model.array('flags')).translate(_graph_flags())
+    graph.live_count = model.meta['live']
+    strings = graph.strings
+    for id, value, kind in zip(
+        model.array('value_ids'), model.array('value'), model.array('value_kind')
+    ):
+        graph.values[id] = int(strings[value]) if kind == VALUE_INT else strings[value]
+    addresses = graph.addresses
+    for id in model.array('synthetic'):
+        graph.synthetic[addresses[id]] = id
+    root = graph.record(0)
+    graph.root_ref = meliaeloader.Ref(root)
+    return root, graph.index
+
+
+class MemoryModelLoader(meliaeloader.Loader):
+    """Memory model read from a model file (see save)"""
+
+    def __init__(self, filename, model=None, progress=None):
+        super(MemoryModelLoader, self).__init__(filename, progress=progress)
+        progress = as_progress(progress)
+        progress.start(_('read'))
+        model = model or ModelFile(filename)
+        # the dump the model was produced from
+        self.sources = model.meta['files']
+        self.include_interpreter = model.meta['include_interpreter']
+        self.roots['memory'], self.rows = memory_graph(model, filename)
+        # later (lazy) work is not part of the load
+        self.progress = as_progress(None)
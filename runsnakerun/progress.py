@@ -0,0 +1,68 @@
+"""Progress reporting and cancellation for (background) loads
+
+The loaders accept a Progress instance and report each phase of the load
+(read, weave, find root, ...) through it.  A Progress can be cancelled from
+another thread (the GUI), the loader then raises Cancelled at its next
+report.  Nothing in here depends on wx, so the loaders stay usable from
+headless code.
+"""
+from __future__ import absolute_import
+import time, logging
+
+log = logging.getLogger(__name__)
+
+# loaders report every STEP items within a phase...
+STEP = 10000
+
+
+class Cancelled(Exception):
+    """Raised (in the loading thread) when the load has been cancelled"""
+
+
+class Progress(object):
+    """Progress/cancellation token passed to loaders
+
+    callback -- callable(phase, done, total) to receive reports (total may
+        be None if unknown), called in the loading thread
+    interval -- minimum seconds between reports within a single phase
+    """
+
+    def __init__(self, callback=None, interval=0.1):
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+        self.phase = None
+        self.last = 0
+
+    def cancel(self):
+        """Request cancellation (may be called from any thread)"""
+        self.cancelled = True
+
+    def check(self):
+        """Raise Cancelled if the load has been cancelled"""
+        if self.cancelled:
+            raise Cancelled(self.phase)
+
+    def start(self, phase, total=None):
+        """Start a new phase of the load"""
+        log.debug('Load phase: %s', phase)
+        self.phase = phase
+        self.last = 0
+        self.update(0, total)
+
+    def update(self, done, total=None):
+        """Report progress within the current phase (throttled)"""
+        self.check()
+        if self.callback is None:
+            return
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.callback(self.phase, done, total)
+
+
+def as_progress(progress):
+    """Produce a Progress for progress (None for no reporting)"""
+    if progress is None:
+        return Progress()
+    return progress
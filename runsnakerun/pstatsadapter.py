@@ -21,8 +21,47 @@ class PStatsAdapter(squaremap.DefaultAdapter):
                 return 0
         elif parent is None:
             return node.cumulative
+        weights = getattr(parent, 'child_weights', None)
+        if weights is not None:
+            # precomputed in weave, see PStatRow.child_weights
+            position = self.child_position(node, parent)
+            return weights[position] if position is not None else 0
         return parent.child_cumulative_time(node)
 
+    # (parent, position after the last child_position found)
+    last_position = (None, 0)
+
+    def child_position(self, node, parent):
+        """Position of node in parent.children (None if not a child)
+
+        The square map values a parent's children in order, so the
+        position after the previous lookup is tried before searching.
+        """
+        children = parent.children
+        last, position = self.last_position
+        if (
+            last is not parent
+            or position >= len(children)
+            or children[position] is not node
+        ):
+            try:
+                position = children.index(node)
+            except ValueError:
+                return None
+        self.last_position = (parent, position + 1)
+        return position
+
+    def children_sum(self, children, node):
+        weights = getattr(node, 'child_weights', None)
+        if (
+            weights is not None
+            and children is getattr(node, 'children', None)
+            and type(self).value == PStatsAdapter.value
+        ):
+            # the weights are exactly what value() returns for the children
+            return sum(weights)
+        return sum([self.value(child, node) for child in children])
+
     def label(self, node):
         if isinstance(node, pstatsloader.PStatGroup):
             return '%s / %s' % (node.filename, node.directory)
@@ -85,3 +124,59 @@ class DirectoryViewAdapter(PStatsAdapter):
         if isinstance(node, pstatsloader.PStatGroup):
             return node.children
         return []
+
+
+class DiffAdapter(PStatsAdapter):
+    """Adapter for diffloader models, showing where time changed
+
+    Squares are sized by the magnitude of the change in cumulative time
+    (along the calling edge where known), regressions are shaded red and
+    improvements green, more intensely the larger the relative change.
+    """
+
+    NEUTRAL = 220
+
+    def delta(self, node):
+        if isinstance(node, pstatsloader.PStatGroup):
+            return sum([self.delta(child) for child in node.children])
+        return node.cumulative_delta
+
+    def value(self, node, parent=None):
+        if parent is not None and parent.key in getattr(node, 'callers', ()):
+            return abs(node.edge_delta(parent.key)[3])
+        if isinstance(node, pstatsloader.PStatGroup):
+            return sum([self.value(child) for child in node.children])
+        return abs(node.cumulative_delta)
+
+    def children_sum(self, children, node):
+        """Total of the children's (absolute) deltas, see value"""
+        return sum([self.value(child, node) for child in children])
+
+    def label(self, node):
+        if isinstance(node, pstatsloader.PStatGroup):
+            return '%s / %s' % (node.filename, node.directory)
+        return '%s@%s:%s [%+0.3fs %+0.1f%%]' % (
+            node.name,
+            node.filename,
+            node.lineno,
+            node.cumulative_delta,
+            node.relative_delta * 100.0,
+        )
+
+    def empty(self, node):
+        """Fraction of the change which is in the function itself"""
+        if isinstance(node, pstatsloader.PStatGroup) or not node.cumulative_delta:
+            return 0.0
+        return min(abs(node.local_delta / float(node.cumulative_delta)), 1.0)
+
+    def background_color(self, node, depth):
+        """Red for regressions (slower), green for improvements"""
+        relative = getattr(node, 'relative_delta', 0.0)
+        intensity = min(abs(relative), 1.0)
+        shade = int(self.NEUTRAL - 160 * intensity)
+        strong = int(self.NEUTRAL + 35 * intensity)
+        if relative > 0:
+            return wx.Colour(strong, shade, shade)
+        elif relative < 0:
+            return wx.Colour(shade, strong, shade)
+        return wx.Colour(self.NEUTRAL, self.NEUTRAL, self.NEUTRAL)
@@ -1,9 +1,13 @@
 """Module to load cProfile/profile records as a tree of records"""
 from __future__ import absolute_import
 from __future__ import print_function
-import pstats, os, logging
+import pstats, os, logging, struct, operator
+from array import array
+from bisect import bisect_left
 import six
 from six.moves import range
+from runsnakerun import graphs
+from runsnakerun.progress import as_progress, STEP
 
 log = logging.getLogger(__name__)
 from gettext import gettext as _
@@ -15,54 +19,525 @@ except NameError:
 
 TREE_CALLS, TREE_FILES = list(range(2))
 
+# below this many files the process pool costs more than it saves
+MIN_PARALLEL_FILES = 4
 
-def load_pstats(filenames):
+
+def load_pstats(filenames, processes=None, stream=False):
     """Given list of filenames, load pstats, potentially using a different python version
     
-    Internally will create a python2 subprocess to convert python2
-    pstats dumps for loading in python3, that will create a cPickle/pickle
-    dump and load it locally.
+    Dumps which the running interpreter's marshal module cannot read (e.g.
+    python2 dumps loaded in python3) are decoded in-process with
+    MarshalReader.
+
+    processes -- if set (True for one per cpu, or a count), decode and merge
+        the files in a process pool (see parallel_load_pstats)
+    stream -- if True, a single foreign-version dump is returned as an
+        iterable of (func, stat) pairs rather than decoded into a dictionary
     """
     # first up, happy path...
     filenames = [filenames] if isinstance(filenames, (bytes, unicode)) else filenames
+    if processes and len(filenames) >= MIN_PARALLEL_FILES:
+        return parallel_load_pstats(filenames, processes)
     try:
         log.debug("Using native loading for %s", filenames)
         stats = pstats.Stats(*filenames)
         return stats.stats
     except ValueError as err:
-        import subprocess
+        log.info("Failure loading %s with native, using marshal decoder", filenames)
+        if stream and len(filenames) == 1:
+            return iter_foreign_stats(filenames[0])
+        stats = {}
+        for filename in filenames:
+            try:
+                merge_stats(stats, pstats.Stats(filename).stats)
+            except ValueError as err:
+                merge_stats(stats, dict(iter_foreign_stats(filename)))
+        return stats
+
 
+def iter_foreign_stats(filename):
+    """Iterate over (func, stat) records of a pstats dump from another python version"""
+    with open(filename, 'rb') as fh:
+        reader = MarshalReader(fh)
         try:
-            import cPickle as pickle
-        except ImportError:
-            import pickle
-        log.info("Failure loading %s with native, trying python2", filenames)
-        converter = (
-            '''import pstats, cPickle; print(cPickle.dumps(pstats.Stats(*%r).stats))'''
-            % (filenames,)
+            for item in reader.iter_dict():
+                yield item
+        except (ValueError, EOFError) as err:
+            raise RuntimeError(
+                'Unable to load %r as a pstats dump: %s' % (filename, err)
+            )
+
+
+class MarshalReader(object):
+    """Streaming decoder for marshal data written by other python versions
+
+    Supports the data types which can appear in pstats dumps (None, booleans,
+    ints, longs, floats, strings, unicode, tuples, lists, dicts and sets) in
+    the python2 marshal formats and the python3 formats (including the
+    version 3+ reference flag and short/ascii string codes).  Python2 byte
+    strings are decoded as utf-8 text so that python2 and python3 function
+    keys compare equal.
+    """
+
+    FLAG_REF = 0x80
+    CONTAINERS = (b'(', b')', b'[', b'{', b'<', b'>')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.refs = []
+        self.interned = []
+        self.handlers = {
+            b'0': self.read_null,
+            b'N': self.read_none,
+            b'F': self.read_false,
+            b'T': self.read_true,
+            b'i': self.read_int,
+            b'I': self.read_int64,
+            b'l': self.read_long,
+            b'f': self.read_text_float,
+            b'g': self.read_binary_float,
+            b's': self.read_string,
+            b't': self.read_interned,
+            b'R': self.read_string_ref,
+            b'u': self.read_unicode,
+            b'a': self.read_ascii,
+            b'A': self.read_ascii,
+            b'z': self.read_short_ascii,
+            b'Z': self.read_short_ascii,
+            b'(': self.read_tuple,
+            b')': self.read_small_tuple,
+            b'[': self.read_list,
+            b'{': self.read_dict,
+            b'<': self.read_set,
+            b'>': self.read_set,
+            b'r': self.read_ref,
+        }
+
+    def read_bytes(self, count):
+        data = self.stream.read(count)
+        if len(data) != count:
+            raise EOFError('Truncated marshal data')
+        return data
+
+    def read_code(self):
+        code = ord(self.read_bytes(1))
+        flag = code & self.FLAG_REF
+        code = six.int2byte(code & ~self.FLAG_REF)
+        if code not in self.handlers:
+            raise ValueError('Unsupported marshal type code %r' % (code,))
+        return code, flag
+
+    def read(self):
+        """Read a single (complete) object from the stream"""
+        code, flag = self.read_code()
+        return self.read_value(code, flag)
+
+    def read_value(self, code, flag):
+        """Read the object for an already-read type code"""
+        if code in self.CONTAINERS:
+            return self.handlers[code](flag)
+        value = self.handlers[code]()
+        if flag:
+            self.refs.append(value)
+        return value
+
+    def iter_dict(self):
+        """Iterate over the (key, value) pairs of a top-level dictionary"""
+        code, flag = self.read_code()
+        if code != b'{':
+            raise ValueError('Expected a marshalled dictionary, got %r' % (code,))
+        if flag:
+            self.refs.append({})
+        while True:
+            code, flag = self.read_code()
+            if code == b'0':
+                break
+            key = self.read_value(code, flag)
+            yield key, self.read()
+
+    def reserve(self, flag):
+        if flag:
+            self.refs.append(None)
+            return len(self.refs) - 1
+        return None
+
+    def read_null(self):
+        raise ValueError('Unexpected NULL in marshal data')
+
+    def read_none(self):
+        return None
+
+    def read_false(self):
+        return False
+
+    def read_true(self):
+        return True
+
+    def read_int(self):
+        return struct.unpack('<i', self.read_bytes(4))[0]
+
+    def read_int64(self):
+        return struct.unpack('<q', self.read_bytes(8))[0]
+
+    def read_long(self):
+        size = self.read_int()
+        digits = struct.unpack('<%dH' % abs(size), self.read_bytes(2 * abs(size)))
+        value = 0
+        for digit in reversed(digits):
+            value = (value << 15) | digit
+        return -value if size < 0 else value
+
+    def read_text_float(self):
+        size = ord(self.read_bytes(1))
+        return float(self.read_bytes(size).decode('ascii'))
+
+    def read_binary_float(self):
+        return struct.unpack('<d', self.read_bytes(8))[0]
+
+    def decode(self, data):
+        if six.PY2:
+            return data
+        return data.decode('utf-8', 'replace')
+
+    def read_string(self):
+        return self.decode(self.read_bytes(self.read_int()))
+
+    def read_interned(self):
+        value = self.read_string()
+        self.interned.append(value)
+        return value
+
+    def read_string_ref(self):
+        return self.interned[self.read_int()]
+
+    def read_unicode(self):
+        return self.read_bytes(self.read_int()).decode('utf-8', 'surrogatepass')
+
+    def read_ascii(self):
+        return self.read_bytes(self.read_int()).decode('latin-1')
+
+    def read_short_ascii(self):
+        return self.read_bytes(ord(self.read_bytes(1))).decode('latin-1')
+
+    def read_ref(self):
+        return self.refs[self.read_int()]
+
+    def read_items(self, count):
+        return [self.read() for i in range(count)]
+
+    def read_tuple(self, flag=0):
+        index = self.reserve(flag)
+        value = tuple(self.read_items(self.read_int()))
+        if index is not None:
+            self.refs[index] = value
+        return value
+
+    def read_small_tuple(self, flag=0):
+        index = self.reserve(flag)
+        value = tuple(self.read_items(ord(self.read_bytes(1))))
+        if index is not None:
+            self.refs[index] = value
+        return value
+
+    def read_list(self, flag=0):
+        value = []
+        if flag:
+            self.refs.append(value)
+        value.extend(self.read_items(self.read_int()))
+        return value
+
+    def read_set(self, flag=0):
+        index = self.reserve(flag)
+        value = frozenset(self.read_items(self.read_int()))
+        if index is not None:
+            self.refs[index] = value
+        return value
+
+    def read_dict(self, flag=0):
+        value = {}
+        if flag:
+            self.refs.append(value)
+        while True:
+            code, item_flag = self.read_code()
+            if code == b'0':
+                break
+            key = self.read_value(code, item_flag)
+            value[key] = self.read()
+        return value
+
+
+def parallel_load_pstats(filenames, processes=True):
+    """Load and merge many pstats dumps using a process pool
+
+    The files are split into one chunk per worker, each worker loads and
+    merges its chunk (via load_pstats) and the partial stats dictionaries
+    are then reduced pair-wise (tree-wise) into a single stats dictionary
+    of the form {func: (cc, nc, tt, ct, callers)}.
+    """
+    import multiprocessing
+
+    if processes is True:
+        processes = multiprocessing.cpu_count()
+    processes = max((1, min((processes, len(filenames)))))
+    chunks = [list(filenames[i::processes]) for i in range(processes)]
+    log.debug("Loading %s files with %s processes", len(filenames), processes)
+    pool = multiprocessing.Pool(processes)
+    try:
+        partials = pool.map(load_pstats, chunks)
+        while len(partials) > 1:
+            pairs = [partials[i : i + 2] for i in range(0, len(partials), 2)]
+            if len(pairs) > 1:
+                partials = pool.map(_merge_pair, pairs)
+            else:
+                partials = [_merge_pair(pairs[0])]
+    finally:
+        pool.close()
+        pool.join()
+    return partials[0]
+
+
+def _merge_pair(pair):
+    if len(pair) == 1:
+        return pair[0]
+    return merge_stats(pair[0], pair[1])
+
+
+def merge_stats(target, source):
+    """Merge pstats dictionary source into target (as pstats.Stats.add does)
+
+    returns target
+    """
+    for func, stat in six.iteritems(source):
+        current = target.get(func)
+        if current is None:
+            target[func] = stat
+            continue
+        cc, nc, tt, ct, callers = stat
+        t_cc, t_nc, t_tt, t_ct, t_callers = current
+        target[func] = (
+            cc + t_cc,
+            nc + t_nc,
+            tt + t_tt,
+            ct + t_ct,
+            merge_callers(t_callers, callers),
         )
-        try:
-            content = pickle.loads(
-                subprocess.check_output(['python2', '-c', converter,])
+    return target
+
+
+def merge_callers(target, source):
+    """Merge two callers dictionaries into a new dictionary"""
+    result = dict(target)
+    for func, caller in six.iteritems(source):
+        current = result.get(func)
+        if current is None:
+            result[func] = caller
+        elif isinstance(caller, tuple):
+            result[func] = tuple([a + b for a, b in zip(current, caller)])
+        else:
+            result[func] = current + caller
+    return result
+
+
+# name of the aggregate node which replaces a parent's pruned callees
+OTHER_NAME = '<other:%s>'
+
+
+def as_edge(edge):
+    """Normalise a callers value to a (nc, cc, tt, ct) tuple
+
+    The old profile module records only call counts for caller edges.
+    """
+    if isinstance(edge, tuple):
+        return edge
+    return (edge, edge, 0, 0)
+
+
+def add_edge(callers, key, edge):
+    current = callers.get(key)
+    if current is None:
+        callers[key] = edge
+    else:
+        callers[key] = tuple([a + b for a, b in zip(current, edge)])
+
+
+def threshold_seconds(stats, threshold):
+    """Resolve a threshold (seconds, or 'N%' of the root's cumulative time)"""
+    if isinstance(threshold, (bytes, unicode)):
+        threshold = threshold.strip()
+        if threshold.endswith('%'):
+            total = max([raw[3] for raw in six.itervalues(stats)] or [0])
+            return total * float(threshold[:-1]) / 100.0
+    return float(threshold)
+
+
+def prune_stats(stats, threshold):
+    """Collapse insignificant functions into per-parent "other" records
+
+    stats -- pstats dictionary
+    threshold -- functions with less cumulative time than this many seconds
+        (or 'N%' of the root's cumulative time) are pruned
+
+    Each significant function which called pruned functions gets a single
+    OTHER_NAME record as a child, whose cumulative time is that of the
+    calls into the pruned functions (so the parent's totals stay exact)
+    and whose local time is whatever of that is not spent in significant
+    functions the pruned ones called.  Significant functions called from
+    pruned ones are re-parented to the "other" record the pruned caller
+    was collapsed into.  The most expensive function is never pruned.
+
+    returns (stats, others) where others is the set of "other" keys
+    """
+    limit = threshold_seconds(stats, threshold)
+    top = max(stats, key=lambda func: stats[func][3]) if stats else None
+    significant = set(
+        [func for func, raw in six.iteritems(stats) if raw[3] >= limit or func == top]
+    )
+    if len(significant) == len(stats):
+        return stats, set()
+    result = {}
+    owners = {}
+
+    def other(func):
+        file, line, name = func
+        return (file, line, OTHER_NAME % (name,))
+
+    def owner(func):
+        """The "other" record which the pruned function func is collapsed into"""
+        # walk up the most expensive callers until we reach a significant one
+        path = []
+        current = func
+        found = None
+        while current not in owners:
+            owners[current] = None  # cycle guard
+            path.append(current)
+            callers = stats[current][4]
+            ranked = sorted(
+                callers, key=lambda caller: as_edge(callers[caller])[3], reverse=True
             )
-        except subprocess.CalledProcessError as err:
-            raise RuntimeError('Unable to load %r as a pstats dump' % (filenames,))
+            direct = [caller for caller in ranked if caller in significant]
+            if direct:
+                found = other(direct[0])
+                break
+            resolved = [owners[caller] for caller in ranked if owners.get(caller)]
+            if resolved:
+                found = resolved[0]
+                break
+            pending = [
+                caller for caller in ranked if caller in stats and caller not in owners
+            ]
+            if not pending:
+                break
+            current = pending[0]
         else:
-            return content
+            found = owners[current]
+        for func in path:
+            owners[func] = found
+        return found
+
+    totals = {}
+    issuperset = significant.issuperset
+    for func, raw in six.iteritems(stats):
+        nc, cc, tt, ct, callers = raw
+        if func in significant:
+            if issuperset(callers):
+                result[func] = raw
+                continue
+            rewritten = {}
+            for caller, edge in six.iteritems(callers):
+                if caller in significant:
+                    rewritten[caller] = edge
+                elif caller in stats:
+                    target = owner(caller)
+                    if target is not None:
+                        add_edge(rewritten, target, as_edge(edge))
+            result[func] = (nc, cc, tt, ct, rewritten)
+            continue
+        for caller, edge in six.iteritems(callers):
+            if caller in significant:
+                edges = totals.get(caller)
+                if edges is None:
+                    edges = totals[caller] = {}
+                add_edge(edges, caller, as_edge(edge))
+    others = set()
+    for parent, edges in six.iteritems(totals):
+        nc, cc, tt, ct = edges[parent]
+        key = other(parent)
+        others.add(key)
+        result[key] = [nc, cc, ct, ct, edges]
+    # the other records' local time is what their significant children don't use
+    for func in significant:
+        for caller, edge in six.iteritems(result[func][4]):
+            if caller in others:
+                result[caller][2] -= as_edge(edge)[3]
+    for key in others:
+        nc, cc, tt, ct, edges = result[key]
+        result[key] = (nc, cc, max(tt, 0), ct, edges)
+    log.info(
+        'Pruned %s of %s functions below %0.6fs into %s other records',
+        len(stats) - len(significant),
+        len(stats),
+        limit,
+        len(others),
+    )
+    return result, others
 
 
 class PStatsLoader(object):
-    """Load profiler statistics from PStats (cProfile) files"""
+    """Load profiler statistics from PStats (cProfile) files
+
+    filenames -- pstats dump files to merge into a single model
+    cache -- if True, use the default on-disk model cache, if a directory
+        name, use that directory for the model cache (see modelcache)
+    processes -- if set, merge many dumps in a process pool (see load_pstats)
+    columnar -- if True, store the rows in a PStatTable (array-backed) rather
+        than as individual PStatRow objects, rows are then PStatRowViews
+    reachability -- if True, build the graphs.ReachabilityIndex for the call
+        graph at load time rather than on first use
+    progress -- progress.Progress instance to report the phases of the load
+        to (and to allow cancelling it from another thread)
+    threshold -- if set, functions with less cumulative time than this many
+        seconds (or 'N%' of the root's cumulative time) are collapsed into
+        per-parent "other" records (see prune_stats)
+    context_nodes, context_depth -- limits on the number of nodes and the
+        depth of the 'context' root (see PStatContext)
+    """
+
+    threshold = None
+    # keys of the "other" records produced by pruning
+    others = frozenset()
+    # limits of the (lazily expanded) estimated calling-context tree
+    context_nodes = 200000
+    context_depth = 100
+    context_count = 0
 
-    def __init__(self, *filenames):
+    def __init__(self, *filenames, **named):
         self.filename = filenames
         self.rows = {}
         self.roots = {}
         self.location_rows = {}
-        self.tree = self.load(load_pstats(self.filename))
-        self.location_tree = l = self.load_location()
+        self.processes = named.get('processes')
+        self.columnar = named.get('columnar')
+        self.threshold = named.get('threshold')
+        self.context_nodes = named.get('context_nodes') or self.context_nodes
+        self.context_depth = named.get('context_depth') or self.context_depth
+        self.table = None
+        self.progress = as_progress(named.get('progress'))
+        self.progress.start(_('read'))
+        cache = named.get('cache')
+        if cache:
+            self.tree = self.load_cached(cache)
+        else:
+            self.tree = self.load(
+                load_pstats(self.filename, self.processes, stream=True)
+            )
+        self.reachability = None
+        if named.get('reachability'):
+            self.get_reachability()
+        # later (lazy) work is not part of the load
+        self.progress = as_progress(None)
 
-    ROOTS = ['functions', 'location']
+    ROOTS = ['functions', 'location', 'context']
 
     def get_root(self, key):
         """Retrieve a given declared root by root-type-key"""
@@ -83,7 +558,7 @@ class PStatsLoader(object):
     def get_adapter(self, key):
         from runsnakerun import pstatsadapter
 
-        if key == 'functions':
+        if key in ('functions', 'context'):
             return pstatsadapter.PStatsAdapter()
         elif key == 'location':
             return pstatsadapter.DirectoryViewAdapter()
@@ -91,17 +566,181 @@ class PStatsLoader(object):
             raise KeyError("""Unknown root type %s""" % (key,))
 
     def load(self, stats):
-        """Build a squaremap-compatible model from a pstats class"""
+        """Build a squaremap-compatible model from a pstats dictionary
+
+        stats -- pstats dictionary or iterable of (func, stat) pairs
+        """
+        if self.threshold:
+            stats = self.prune(stats)
+        if self.columnar:
+            return self.load_table(PStatTable(stats))
         rows = self.rows
-        for func, raw in six.iteritems(stats):
+        others = self.others
+        items = six.iteritems(stats) if hasattr(stats, 'items') else stats
+        for func, raw in items:
             try:
-                rows[func] = row = PStatRow(func, raw)
+                if func in others:
+                    rows[func] = row = PStatOther(func, raw)
+                else:
+                    rows[func] = row = PStatRow(func, raw)
             except ValueError as err:
                 log.info('Null row: %s', func)
-        for row in six.itervalues(rows):
+            else:
+                # dense id for graph traversals (see graphs.Visited)
+                row.id = len(rows) - 1
+                if not row.id % STEP:
+                    self.progress.update(row.id)
+        self.progress.start(_('weave'), len(rows))
+        for i, row in enumerate(six.itervalues(rows)):
             row.weave(rows)
+            if not i % STEP:
+                self.progress.update(i, len(rows))
         return self.find_root(rows)
 
+    def prune(self, stats):
+        """Apply our threshold to stats (see prune_stats)"""
+        if not hasattr(stats, 'items'):
+            stats = dict(stats)
+        self.progress.start(_('prune'))
+        stats, self.others = prune_stats(stats, self.threshold)
+        return stats
+
+    def load_table(self, table):
+        """Build the model from an (already populated) PStatTable"""
+        self.table = table
+        self.rows.update(table.rows())
+        return self.find_root(self.rows)
+
+    def dense_rows(self):
+        """Retrieve the list of rows indexed by their dense id"""
+        if self.table is not None:
+            return [self.table.view(id) for id in range(len(self.table))]
+        result = [
+            row for row in self.rows.values() if getattr(row, 'id', None) is not None
+        ]
+        result.sort(key=operator.attrgetter('id'))
+        return result
+
+    def get_reachability(self):
+        """Retrieve (building if necessary) the call-graph ReachabilityIndex"""
+        if self.reachability is None:
+            self.progress.start(_('reachability'))
+            rows = self.dense_rows()
+            if self.table is not None:
+                offsets, targets = self.table.child_offsets, self.table.child_targets
+
+                def successors(id):
+                    return targets[offsets[id] : offsets[id + 1]]
+
+            else:
+
+                def successors(id):
+                    return [
+                        child.id
+                        for child in rows[id].children
+                        if getattr(child, 'id', None) is not None
+                    ]
+
+            self.reachability = graphs.ReachabilityIndex(
+                len(rows), successors, {'local': [row.local for row in rows]},
+            )
+        return self.reachability
+
+    def reaches(self, source, target):
+        """Is target (directly or indirectly) called from source"""
+        return self.get_reachability().reaches(source.id, target.id)
+
+    def descendant_count(self, node):
+        """Number of distinct functions (directly or indirectly) called by node"""
+        return self.get_reachability().descendant_count(node.id)
+
+    def ancestor_count(self, node):
+        """Number of distinct functions which (directly or indirectly) call node"""
+        return self.get_reachability().ancestor_count(node.id)
+
+    def descendant_time(self, node):
+        """Total local time of the distinct functions called by node"""
+        return self.get_reachability().descendant_total(node.id, 'local')
+
+    def load_cached(self, cache):
+        """Load our functions model via the on-disk model cache"""
+        from runsnakerun import modelcache
+
+        directory = cache if isinstance(cache, (bytes, unicode)) else None
+        try:
+            variant = 'columnar' if self.columnar else ''
+            if self.threshold:
+                variant += ' threshold=%s' % (self.threshold,)
+            key = modelcache.cache_key(self.filename, variant)
+            state = modelcache.fetch(key, directory)
+        except (IOError, OSError) as err:
+            log.warning('Model cache unavailable: %s', err)
+            return self.load(load_pstats(self.filename, self.processes))
+        if state is not None:
+            log.info('Loaded %s from model cache', self.filename)
+            return self.restore(state)
+        root = self.load(load_pstats(self.filename, self.processes))
+        try:
+            modelcache.store(key, self.snapshot(), directory)
+        except Exception as err:
+            log.warning('Unable to store model cache: %s', err)
+        return root
+
+    def snapshot(self):
+        """Produce a flat (non-recursive, picklable) version of the functions model
+
+        Each node is recorded as (class, attributes, children, parents) with
+        the graph links replaced by indices into the node list, so that
+        pickling does not recurse through the (possibly very deep) call graph.
+        The keys of the pruned "other" rows (see prune) are kept too.
+        """
+        if self.table is not None:
+            return {'table': self.table, 'others': sorted(self.others)}
+        nodes = list(self.rows.values())
+        root = self.roots['functions']
+        ids = dict([(id(node), i) for i, node in enumerate(nodes)])
+        records = []
+        for node in nodes:
+            state = node.__dict__.copy()
+            children = state.pop('children', [])
+            parents = state.pop('parents', [])
+            # aligned with children, recomputed on restore
+            state.pop('child_weights', None)
+            records.append(
+                (
+                    node.__class__,
+                    state,
+                    [ids[id(n)] for n in children if id(n) in ids],
+                    [ids[id(n)] for n in parents if id(n) in ids],
+                )
+            )
+        return {
+            'nodes': records,
+            'root': ids[id(root)],
+            'others': sorted(self.others),
+        }
+
+    def restore(self, state):
+        """Restore a functions model from a snapshot, returning the root"""
+        self.others = frozenset(state['others'])
+        if 'table' in state:
+            return self.load_table(state['table'])
+        nodes = []
+        for cls, attributes, children, parents in state['nodes']:
+            node = cls.__new__(cls)
+            node.__dict__.update(attributes)
+            nodes.append(node)
+        for node, (cls, attributes, children, parents) in zip(nodes, state['nodes']):
+            node.children = [nodes[i] for i in children]
+            node.parents = [nodes[i] for i in parents]
+        for node in nodes:
+            self.rows[node.key] = node
+            if isinstance(node, PStatRow):
+                node.weigh()
+        root = nodes[state['root']]
+        self.roots['functions'] = root
+        return root
+
     def load_functions(self):
         """Load function records from the pstats file"""
         return self.load()
@@ -111,96 +750,272 @@ class PStatsLoader(object):
 
         rows -- key: PStatRow mapping
 
-        TODO: still need more robustness here, particularly in the case of
-        threaded programs.  Should be tracing back each row to root, breaking
-        cycles by sorting on cumulative time, and then collecting the traced
-        roots (or, if they are all on the same root, use that).
+        The call graph is condensed into strongly connected components, each
+        component which is not called from outside itself is an entry point
+        (the main program, a thread's run method, a callback from C code),
+        represented by its member with the greatest cumulative time.  With
+        more than one entry point a "<profiling run>" group collects them, so
+        that every row is always reachable from the root (threaded servers).
         """
-        maxes = sorted(list(rows.values()), key=lambda x: x.cumulative)
-        if not maxes:
+        return self.set_entry_points(self.find_entry_points(rows))
+
+    def find_entry_points(self, rows):
+        """Find the entry point rows (see find_root)"""
+        self.progress.start(_('find root'))
+        is_live = self.is_live
+        nodes = [
+            row
+            for row in rows.values()
+            if getattr(row, 'id', None) is not None and is_live(row)
+        ]
+        if not nodes:
             raise RuntimeError("""Null results!""")
-        root = maxes[-1]
-        roots = [root]
-        for key, value in rows.items():
-            if not value.parents:
-                log.debug('Found node root: %s', value)
-                if value not in roots:
-                    roots.append(value)
-        if len(roots) > 1:
-            root = PStatGroup(
-                directory='*', filename='*', name=_("<profiling run>"), children=roots,
+        # the common case, uncalled functions are entry points...
+        roots = [row for row in nodes if not row.parents]
+        visited = graphs.Visited(max([row.id for row in nodes]) + 1)
+        children = operator.attrgetter('children')
+        for root in roots:
+            visited.add(root)
+            for row in graphs.reachable(root, children, visited):
+                pass
+        # anything not reached is below an entry point which is part of a
+        # cycle (e.g. a recursive thread run method), condense what's left
+        remaining = [row for row in nodes if row not in visited]
+        if remaining:
+            index = dict([(id(row), i) for i, row in enumerate(remaining)])
+
+            def callers(i):
+                return [
+                    index[id(parent)]
+                    for parent in remaining[i].parents
+                    if id(parent) in index
+                ]
+
+            component, components = graphs.strongly_connected_components(
+                len(remaining), callers
+            )
+            # components called from another component are not entry points...
+            called = bytearray(components)
+            members = [[] for i in range(components)]
+            for i, row in enumerate(remaining):
+                source = component[i]
+                members[source].append(row)
+                for parent in callers(i):
+                    if component[parent] != source:
+                        called[source] = 1
+            roots.extend(
+                [
+                    max(group, key=operator.attrgetter('cumulative'))
+                    for source, group in enumerate(members)
+                    if not called[source]
+                ]
             )
-            root.finalize()
-            self.rows[root.key] = root
+        for root in roots:
+            log.debug('Found entry point: %s', root)
+        return roots
+
+    def is_live(self, row):
+        """Is the row part of the profile (rows zeroed by update() are not)"""
+        return row.calls or row.cumulative
+
+    def set_entry_points(self, roots):
+        """Set the functions root for the given entry points
+
+        A single entry point is the root itself, multiple entry points are
+        collected in a "<profiling run>" group (which is re-used if the
+        current root is already such a group, see detach_group).
+        """
+        group = self.roots.get('functions')
+        if not isinstance(group, PStatGroup):
+            group = None
+        if len(roots) > 1:
+            roots.sort(key=operator.attrgetter('cumulative'), reverse=True)
+            if group is None:
+                group = PStatGroup(
+                    directory='*',
+                    filename='*',
+                    name=_("<profiling run>"),
+                    children=roots,
+                )
+                group.finalize()
+            else:
+                group.children = roots
+                for child in roots:
+                    child.add_parent(group)
+                group.calculate_totals(group.children, group.local_children)
+            self.rows[group.key] = root = group
+        else:
+            root = roots[0]
+            if group is not None:
+                self.rows.pop(group.key, None)
         self.roots['functions'] = root
         return root
 
+    def detach_group(self, group):
+        """Remove the synthetic group from the parents of its children"""
+        for child in group.children:
+            parents = child.parents
+            for i in range(len(parents) - 1, -1, -1):
+                if parents[i] is group:
+                    del parents[i]
+                    break
+
+    def update(self, stats):
+        """Apply a new snapshot of the same profile to the model in place
+
+        stats -- pstats dictionary (e.g. from load_pstats) for the same files
+
+        Only the rows whose statistics changed are updated (and only their
+        changed edges re-woven), existing rows, edges and the root keep their
+        identity, so views can preserve selection and history.  Functions
+        which are no longer present keep their rows with zeroed statistics
+        (their ids stay dense).  The reachability index is discarded and the
+        (lazy) location tree re-totalled or, if new files appeared, rebuilt.
+
+        Columnar models cannot be updated in place, they are rebuilt.
+
+        returns list of changed rows or None if the model was rebuilt
+        """
+        rows = self.rows
+        if self.table is not None:
+            self.rows, self.roots, self.location_rows = {}, {}, {}
+            self.others = frozenset()
+            self.reachability = None
+            self.tree = self.load(stats)
+            return None
+        if self.threshold:
+            # other records of earlier snapshots stay "other" records
+            previous = self.others
+            stats = self.prune(stats)
+            self.others = previous | self.others
+        ids = [row.id for row in rows.values() if getattr(row, 'id', None) is not None]
+        next_id = max(ids) + 1 if ids else 0
+        added = []
+        for func, raw in six.iteritems(stats):
+            if func not in rows:
+                try:
+                    if func in self.others:
+                        row = PStatOther(func, raw)
+                    else:
+                        row = PStatRow(func, raw)
+                except ValueError as err:
+                    continue
+                rows[func] = row
+                row.id = next_id
+                next_id += 1
+                added.append(row)
+        changed = []
+        # rows whose children or edge statistics changed
+        reweigh = set()
+        structure = bool(added)
+        for row in added:
+            row.weave(rows)
+        null = (0, 0, 0, 0, {})
+        for row in list(rows.values()):
+            if getattr(row, 'id', None) is None or row in added:
+                continue
+            raw = stats.get(row.key, null)
+            if not row.stats_changed(raw):
+                continue
+            changed.append(row)
+            old, new = row.callers, raw[4]
+            if set(old) != set(new):
+                structure = True
+                for key in old:
+                    parent = rows.get(key)
+                    if key not in new and parent is not None:
+                        parent.children.remove(row)
+                        reweigh.add(parent)
+                        row.parents.remove(parent)
+                for key in new:
+                    parent = rows.get(key)
+                    if key not in old and parent is not None:
+                        row.parents.append(parent)
+                        parent.children.append(row)
+                        reweigh.add(parent)
+            row.set_stats(raw)
+        for row in changed:
+            # our cumulative and/or the edges from our parents changed
+            reweigh.add(row)
+            reweigh.update(row.parents)
+        for row in reweigh:
+            if isinstance(row, PStatRow):
+                row.weigh()
+        if not (changed or added):
+            return []
+        self.reachability = None
+        # the estimated contexts are rebuilt on next access
+        self.roots.pop('context', None)
+        root = self.roots.get('functions')
+        if structure:
+            if isinstance(root, PStatGroup):
+                self.detach_group(root)
+            self.tree = self.set_entry_points(self.find_entry_points(rows))
+        elif isinstance(root, PStatGroup):
+            root.calculate_totals(root.children, root.local_children)
+        if 'location' in self.roots:
+            # the synthetic root group is part of the location tree too
+            self.update_location(added, rebuild=self.tree is not root)
+        return added + changed
+
+    def update_location(self, added, rebuild=False):
+        """Bring the location tree up to date after update()"""
+        index = self.location_index
+        if not rebuild:
+            for row in added:
+                if not index.add(row):
+                    break
+            else:
+                index.refresh()
+                return
+        # new file/directory records are needed, rebuild lazily
+        for record in self.location_rows.values():
+            if isinstance(record, PStatLocation) and not isinstance(
+                record, PStatLazyLocation
+            ):
+                self.detach_group(record)
+        del self.roots['location']
+        self.location_rows = {}
+
     def load_location(self):
-        """Load the location root record (loading regular records if necessary)"""
+        """Load the location root record (loading regular records if necessary)
+
+        The location tree is lazy, only the root is created here, directory
+        records create their children the first time they are accessed
+        (see PStatLocationIndex).
+        """
         if not self.rows:
             self.load()
         return self._load_location()
 
     def _load_location(self):
         """Build a squaremap-compatible model for location-based hierarchy"""
-        directories = {}
-        files = {}
-        root = PStatLocation('/', 'PYTHONPATH')
         self.location_rows = self.rows.copy()
-        for child in self.rows.values():
-            current = directories.get(child.directory)
-            directory, filename = child.directory, child.filename
-            if current is None:
-                if directory == '':
-                    current = root
-                else:
-                    current = PStatLocation(directory, '')
-                    self.location_rows[current.key] = current
-                directories[directory] = current
-            if filename == '~':
-                filename = '<built-in>'
-            file_current = files.get((directory, filename))
-            if file_current is None:
-                file_current = PStatLocation(directory, filename)
-                self.location_rows[file_current.key] = file_current
-                files[(directory, filename)] = file_current
-                current.children.append(file_current)
-            file_current.children.append(child)
-        # now link the directories...
-        for key, value in directories.items():
-            if value is root:
-                continue
-            found = False
-            while key:
-                new_key, rest = os.path.split(key)
-                if new_key == key:
-                    break
-                key = new_key
-                parent = directories.get(key)
-                if parent:
-                    if value is not parent:
-                        parent.children.append(value)
-                        found = True
-                        break
-            if not found:
-                root.children.append(value)
-        # lastly, finalize all of the directory records...
-        root.finalize()
-        return root
+        self.location_index = PStatLocationIndex(self.rows, self.location_rows)
+        return self.location_index.root
+
+    def load_context(self):
+        """Create the root of the estimated calling-context tree (see PStatContext)"""
+        root = self.get_root('functions')
+        self.context_count = 1
+        return PStatContext(self, root, None, root.cumulative, 0)
+
+    @property
+    def location_tree(self):
+        return self.get_root('location')
 
 
 class BaseStat(object):
+    __slots__ = ()
+
     def recursive_distinct(self, already_done=None, attribute='children'):
-        if already_done is None:
-            already_done = {}
-        for child in getattr(self, attribute, ()):
-            if child not in already_done:
-                already_done[child] = True
-                yield child
-                for descendent in child.recursive_distinct(
-                    already_done=already_done, attribute=attribute
-                ):
-                    yield descendent
+        """Iterate over all distinct records reachable via attribute
+
+        already_done -- optional graphs.Visited instance
+        """
+        return graphs.reachable(
+            self, operator.attrgetter(attribute), visited=already_done
+        )
 
     def descendants(self):
         return list(self.recursive_distinct(attribute='children'))
@@ -208,13 +1023,23 @@ class BaseStat(object):
     def ancestors(self):
         return list(self.recursive_distinct(attribute='parents'))
 
+    def add_parent(self, parent):
+        self.parents.append(parent)
+
 
 class PStatRow(BaseStat):
-    """Simulates a HotShot profiler record using PStats module"""
+    """Simulates a HotShot profiler record using PStats module
+
+    child_weights -- array of the fraction of our cumulative time spent in
+        calls to each child, parallel to children (computed in weave, so
+        the adapters need not look up and divide the edge statistics on
+        every paint)
+    """
 
     def __init__(self, key, raw):
         self.children = []
         self.parents = []
+        self.child_weights = array('d')
         file, line, func = self.key = key
         try:
             dirname, basename = os.path.dirname(file), os.path.basename(file)
@@ -224,6 +1049,17 @@ class PStatRow(BaseStat):
         nc, cc, tt, ct, callers = raw
         if nc == cc == tt == ct == 0:
             raise ValueError('Null stats row')
+        self.directory, self.filename, self.name, self.lineno = (
+            dirname,
+            basename,
+            func,
+            line,
+        )
+        self.set_stats(raw)
+
+    def set_stats(self, raw):
+        """Set our statistics from a pstats (nc, cc, tt, ct, callers) record"""
+        nc, cc, tt, ct, callers = raw
         (
             self.calls,
             self.recursive,
@@ -231,10 +1067,6 @@ class PStatRow(BaseStat):
             self.localPer,
             self.cumulative,
             self.cumulativePer,
-            self.directory,
-            self.filename,
-            self.name,
-            self.lineno,
         ) = (
             nc,
             cc,
@@ -242,13 +1074,19 @@ class PStatRow(BaseStat):
             tt / (cc or 0.00000000000001),
             ct,
             ct / (nc or 0.00000000000001),
-            dirname,
-            basename,
-            func,
-            line,
         )
         self.callers = callers
 
+    def stats_changed(self, raw):
+        """Does the pstats record differ from our current statistics"""
+        nc, cc, tt, ct, callers = raw
+        return (self.calls, self.recursive, self.local, self.cumulative) != (
+            nc,
+            cc,
+            tt,
+            ct,
+        ) or (self.callers != callers)
+
     def __repr__(self):
         return 'PStatRow( %r,%r,%r,%r, %s )' % (
             self.directory,
@@ -260,6 +1098,7 @@ class PStatRow(BaseStat):
 
     def add_child(self, child):
         self.children.append(child)
+        self.child_weights.append(self.edge_fraction(child.callers.get(self.key)))
 
     def weave(self, rows):
         for caller, data in six.iteritems(self.callers):
@@ -268,17 +1107,447 @@ class PStatRow(BaseStat):
             if parent:
                 self.parents.append(parent)
                 parent.children.append(self)
+                parent.child_weights.append(parent.edge_fraction(data))
 
-    def child_cumulative_time(self, child):
+    def edge_fraction(self, data):
+        """Fraction of our cumulative time for a (cc,nc,tt,ct) edge to a child"""
         total = self.cumulative
-        if total:
+        if total and data:
             try:
-                (cc, nc, tt, ct) = child.callers[self.key]
+                (cc, nc, tt, ct) = data
             except TypeError as err:
-                ct = child.callers[self.key]
+                ct = data
             return float(ct) / total
         return 0
 
+    def weigh(self):
+        """Recompute child_weights (after our or our children's stats changed)"""
+        key = self.key
+        self.child_weights = array(
+            'd', [self.edge_fraction(child.callers.get(key)) for child in self.children]
+        )
+
+    def child_cumulative_time(self, child):
+        # by key (as child_weights is computed), not a scan of children
+        return self.edge_fraction(child.callers.get(self.key))
+
+
+class PStatOther(PStatRow):
+    """Aggregate of the insignificant functions called by a parent (see prune_stats)"""
+
+    def __repr__(self):
+        return 'PStatOther( %r,%r,%r,%r, %s )' % (
+            self.directory,
+            self.filename,
+            self.lineno,
+            self.name,
+            len(self.children),
+        )
+
+
+class PStatContext(BaseStat):
+    """A function at a particular (estimated) calling context
+
+    pstats records only per-edge totals, so the time a function spends in
+    a particular context is estimated by splitting the time of each callee
+    proportionally along the calling edges: a context's children share its
+    cumulative time in the proportions of its function's child weights.
+    Recursive calls (a function already on the context's path) are not
+    unfolded, their time is part of the enclosing call.
+
+    Children are created on first access (as the user drills down), at most
+    loader.context_nodes contexts are ever created and none deeper than
+    loader.context_depth.  The other statistics are the function's scaled
+    by the context's share of its cumulative time.
+    """
+
+    __slots__ = ('loader', 'row', 'parent', 'cumulative', 'depth', '_children')
+
+    key = property(lambda self: self.row.key)
+    name = property(lambda self: self.row.name)
+    filename = property(lambda self: self.row.filename)
+    directory = property(lambda self: self.row.directory)
+    lineno = property(lambda self: self.row.lineno)
+    localPer = property(lambda self: self.row.localPer)
+    cumulativePer = property(lambda self: self.row.cumulativePer)
+    calls = property(lambda self: self.row.calls * self.scale)
+    recursive = property(lambda self: self.row.recursive * self.scale)
+    local = property(lambda self: self.row.local * self.scale)
+
+    def __init__(self, loader, row, parent, cumulative, depth):
+        self.loader = loader
+        self.row = row
+        self.parent = parent
+        self.cumulative = cumulative
+        self.depth = depth
+        self._children = None
+
+    def __repr__(self):
+        return 'PStatContext( %r,%r,%r,%r, %s )' % (
+            self.directory,
+            self.filename,
+            self.lineno,
+            self.name,
+            self.depth,
+        )
+
+    @property
+    def scale(self):
+        """Fraction of the function's time spent in this context"""
+        total = self.row.cumulative
+        if total:
+            return self.cumulative / float(total)
+        return 0
+
+    @property
+    def parents(self):
+        return [self.parent] if self.parent is not None else []
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = self.expand()
+        return self._children
+
+    def path(self):
+        """Contexts from the root down to (and including) this one"""
+        result = []
+        context = self
+        while context is not None:
+            result.append(context)
+            context = context.parent
+        result.reverse()
+        return result
+
+    def expand(self):
+        """Create our child contexts (within the loader's limits)"""
+        loader = self.loader
+        if self.depth >= loader.context_depth:
+            return []
+        row = self.row
+        weights = getattr(row, 'child_weights', None)
+        recursive = set([id(context.row) for context in self.path()])
+        result = []
+        for position, child in enumerate(row.children):
+            if id(child) in recursive:
+                continue
+            if weights is not None:
+                fraction = weights[position]
+            elif isinstance(row, PStatGroup):
+                fraction = child.cumulative / float(row.cumulative or 1)
+            else:
+                fraction = row.child_cumulative_time(child)
+            share = self.cumulative * fraction
+            if not share:
+                continue
+            if loader.context_count >= loader.context_nodes:
+                if loader.context_count == loader.context_nodes:
+                    # only warn once, the count is never compared again
+                    log.warning(
+                        'Calling-context budget of %s nodes exhausted',
+                        loader.context_nodes,
+                    )
+                    loader.context_count += 1
+                break
+            loader.context_count += 1
+            result.append(PStatContext(loader, child, self, share, self.depth + 1))
+        return result
+
+    def child_cumulative_time(self, child):
+        if self.cumulative:
+            return child.cumulative / float(self.cumulative)
+        return 0
+
+    def descendants(self):
+        """Functions called (directly or indirectly) from this context"""
+        return self.row.descendants()
+
+    def ancestors(self):
+        """Functions on the path to this context"""
+        return [context.row for context in self.path()[:-1]]
+
+
+def _int64_code():
+    try:
+        array('q')
+    except ValueError:
+        return 'l'
+    return 'q'
+
+
+INT64 = _int64_code()
+
+
+class PStatTable(object):
+    """Columnar (array-backed) storage for the rows of a pstats model
+
+    Numeric fields are stored in typed arrays indexed by a dense row id,
+    strings (paths, directories, filenames, function names) are interned
+    in a single table and the call graph is stored as two CSR (compressed
+    sparse row) adjacency structures, one for parents (callers) with the
+    caller's (cc, nc, tt, ct) edge statistics and one for children.
+
+    PStatRowView instances provide the PStatRow attribute API on top of
+    the table.
+    """
+
+    # names of the array attributes (everything but the strings table)
+    ARRAYS = (
+        'paths',
+        'directories',
+        'filenames',
+        'names',
+        'linenos',
+        'calls',
+        'recursive',
+        'local',
+        'cumulative',
+        'parent_offsets',
+        'parent_targets',
+        'edge_calls',
+        'edge_recursive',
+        'edge_local',
+        'edge_cumulative',
+        'child_offsets',
+        'child_targets',
+        'child_edges',
+        'child_fractions',
+    )
+
+    def __init__(self, stats):
+        self.strings = []
+        self.paths = array('i')
+        self.directories = array('i')
+        self.filenames = array('i')
+        self.names = array('i')
+        self.linenos = array('i')
+        self.calls = array(INT64)
+        self.recursive = array(INT64)
+        self.local = array('d')
+        self.cumulative = array('d')
+        self.extra_parents = {}
+        self.views = []
+        self.build(stats)
+
+    def __len__(self):
+        return len(self.names)
+
+    def build(self, stats):
+        string_ids = {}
+
+        def intern(value):
+            current = string_ids.get(value)
+            if current is None:
+                current = string_ids[value] = len(self.strings)
+                self.strings.append(value)
+            return current
+
+        ids = {}
+        splits = {}
+        pending = []
+        items = six.iteritems(stats) if hasattr(stats, 'items') else stats
+        for key, (nc, cc, tt, ct, callers) in items:
+            if nc == cc == tt == ct == 0:
+                log.info('Null row: %s', key)
+                continue
+            file, line, func = key
+            ids[key] = len(self.names)
+            path = intern(file)
+            split = splits.get(path)
+            if split is None:
+                split = splits[path] = (
+                    intern(os.path.dirname(file)),
+                    intern(os.path.basename(file)),
+                )
+            self.paths.append(path)
+            self.directories.append(split[0])
+            self.filenames.append(split[1])
+            self.names.append(intern(func))
+            self.linenos.append(line)
+            self.calls.append(nc)
+            self.recursive.append(cc)
+            self.local.append(tt)
+            self.cumulative.append(ct)
+            pending.append(callers)
+
+        # parent (caller) edges, with the per-edge statistics...
+        self.parent_offsets = array('i', [0])
+        self.parent_targets = array('i')
+        self.edge_calls = array(INT64)
+        self.edge_recursive = array(INT64)
+        self.edge_local = array('d')
+        self.edge_cumulative = array('d')
+        child_counts = [0] * len(pending)
+        for callers in pending:
+            for caller, data in six.iteritems(callers):
+                parent = ids.get(caller)
+                if parent is None:
+                    continue
+                if not isinstance(data, tuple):
+                    # old profile module only records call counts
+                    data = (data, data, 0.0, data)
+                self.parent_targets.append(parent)
+                self.edge_calls.append(data[0])
+                self.edge_recursive.append(data[1])
+                self.edge_local.append(data[2])
+                self.edge_cumulative.append(data[3])
+                child_counts[parent] += 1
+            self.parent_offsets.append(len(self.parent_targets))
+        del pending
+
+        # child edges by counting-sort of the parent edges, child_edges
+        # records the parent-edge index to find the edge statistics...
+        self.child_offsets = array('i', [0])
+        total = 0
+        for count in child_counts:
+            total += count
+            self.child_offsets.append(total)
+        fill = array('i', self.child_offsets[:-1])
+        self.child_targets = array('i', [0]) * total
+        self.child_edges = array('i', [0]) * total
+        # fraction of the parent's cumulative time, aligned with child_targets
+        self.child_fractions = array('d', [0.0]) * total
+        for child in range(len(self.names)):
+            for edge in range(
+                self.parent_offsets[child], self.parent_offsets[child + 1]
+            ):
+                parent = self.parent_targets[edge]
+                position = fill[parent]
+                self.child_targets[position] = child
+                self.child_edges[position] = edge
+                if self.cumulative[parent]:
+                    self.child_fractions[position] = (
+                        self.edge_cumulative[edge] / self.cumulative[parent]
+                    )
+                fill[parent] = position + 1
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['views'] = []
+        state['extra_parents'] = {}
+        return state
+
+    def view(self, id):
+        """Retrieve the (unique) PStatRowView for the given row id"""
+        views = self.views
+        if not views:
+            views.extend([None] * len(self.names))
+        view = views[id]
+        if view is None:
+            view = views[id] = PStatRowView(self, id)
+        return view
+
+    def rows(self):
+        """Produce a key: PStatRowView mapping for all rows"""
+        result = {}
+        for id in range(len(self.names)):
+            view = self.view(id)
+            result[view.key] = view
+        return result
+
+    def key(self, id):
+        return (
+            self.strings[self.paths[id]],
+            self.linenos[id],
+            self.strings[self.names[id]],
+        )
+
+    def children(self, id):
+        view = self.view
+        return [
+            view(target)
+            for target in self.child_targets[
+                self.child_offsets[id] : self.child_offsets[id + 1]
+            ]
+        ]
+
+    def parents(self, id):
+        view = self.view
+        return [
+            view(target)
+            for target in self.parent_targets[
+                self.parent_offsets[id] : self.parent_offsets[id + 1]
+            ]
+        ] + self.extra_parents.get(id, [])
+
+    def edge(self, parent, child):
+        """Find (cc, nc, tt, ct) edge statistics for parent calling child"""
+        for edge in range(self.parent_offsets[child], self.parent_offsets[child + 1]):
+            if self.parent_targets[edge] == parent:
+                return (
+                    self.edge_calls[edge],
+                    self.edge_recursive[edge],
+                    self.edge_local[edge],
+                    self.edge_cumulative[edge],
+                )
+        raise KeyError(parent)
+
+    def child_fraction(self, parent, child):
+        """Fraction of parent's cumulative time spent in calls to child"""
+        start, stop = self.child_offsets[parent], self.child_offsets[parent + 1]
+        # children are filled in ascending id order
+        position = bisect_left(self.child_targets, child, start, stop)
+        if position < stop and self.child_targets[position] == child:
+            return self.child_fractions[position]
+        return 0
+
+    def callers(self, id):
+        return dict(
+            [
+                (self.key(parent), self.edge(parent, id))
+                for parent in self.parent_targets[
+                    self.parent_offsets[id] : self.parent_offsets[id + 1]
+                ]
+            ]
+        )
+
+
+class PStatRowView(BaseStat):
+    """PStatRow-compatible view of a single row in a PStatTable"""
+
+    __slots__ = ('table', 'id')
+
+    def __init__(self, table, id):
+        self.table = table
+        self.id = id
+
+    def __repr__(self):
+        return 'PStatRowView( %r,%r,%r,%r, %s )' % (
+            self.directory,
+            self.filename,
+            self.lineno,
+            self.name,
+            len(self.children),
+        )
+
+    key = property(lambda self: self.table.key(self.id))
+    calls = property(lambda self: self.table.calls[self.id])
+    recursive = property(lambda self: self.table.recursive[self.id])
+    local = property(lambda self: self.table.local[self.id])
+    cumulative = property(lambda self: self.table.cumulative[self.id])
+    localPer = property(lambda self: self.local / (self.recursive or 0.00000000000001))
+    cumulativePer = property(
+        lambda self: self.cumulative / (self.calls or 0.00000000000001)
+    )
+    directory = property(
+        lambda self: self.table.strings[self.table.directories[self.id]]
+    )
+    filename = property(lambda self: self.table.strings[self.table.filenames[self.id]])
+    name = property(lambda self: self.table.strings[self.table.names[self.id]])
+    lineno = property(lambda self: self.table.linenos[self.id])
+    children = property(lambda self: self.table.children(self.id))
+    parents = property(lambda self: self.table.parents(self.id))
+    callers = property(lambda self: self.table.callers(self.id))
+
+    def add_parent(self, parent):
+        self.table.extra_parents.setdefault(self.id, []).append(parent)
+
+    def child_cumulative_time(self, child):
+        try:
+            return self.table.child_fraction(self.id, child.id)
+        except AttributeError:
+            return 0
+
 
 class PStatGroup(BaseStat):
     """A node/record that holds a group of children but isn't a raw-record based group"""
@@ -324,7 +1593,7 @@ class PStatGroup(BaseStat):
         for child in children:
             if hasattr(child, 'finalize'):
                 child.finalize(already_done)
-            child.parents.append(self)
+            child.add_parent(self)
         self.calculate_totals(self.children, self.local_children)
 
     def filter_children(self):
@@ -337,7 +1606,7 @@ class PStatGroup(BaseStat):
             for child in children:
                 if isinstance(child, PStatGroup) or not self.LOCAL_ONLY:
                     values.append(getattr(child, field, 0))
-                elif isinstance(child, PStatRow) and self.LOCAL_ONLY:
+                elif self.LOCAL_ONLY:
                     values.append(getattr(child, local_field, 0))
             value = sum(values)
             setattr(self, field, value)
@@ -357,6 +1626,126 @@ class PStatGroup(BaseStat):
             self.localPer = 0
 
 
+class PStatLocationIndex(object):
+    """Aggregate totals for the location (package) tree which is built lazily
+
+    A single pass over the rows groups them by (directory, filename) and
+    accumulates per-directory totals, directory records are only created
+    (as PStatLazyLocation) when their parent is expanded, and file records
+    are only created (and finalized) when their directory is expanded.
+
+    rows -- key: row mapping from which to build the tree
+    location_rows -- key: row mapping to which created records are added
+    """
+
+    def __init__(self, rows, location_rows):
+        self.location_rows = location_rows
+        self.files = {}
+        directory_files = {}
+        for child in rows.values():
+            directory, filename = child.directory, child.filename
+            if filename == '~':
+                filename = '<built-in>'
+            current = self.files.get((directory, filename))
+            if current is None:
+                current = self.files[(directory, filename)] = []
+                directory_files.setdefault(directory, []).append(filename)
+            current.append(child)
+        self.directory_files = directory_files
+        # now link the directories...
+        self.subdirectories = {'': []}
+        for key in directory_files:
+            if key == '':
+                continue
+            parent = ''
+            value = key
+            while key:
+                new_key, rest = os.path.split(key)
+                if new_key == key:
+                    break
+                key = new_key
+                if key in directory_files:
+                    parent = key
+                    break
+            self.subdirectories.setdefault(parent, []).append(value)
+        # accumulate totals for each directory, deepest directories first...
+        self.totals = {}
+        for directory in sorted(directory_files, key=self.depth, reverse=True):
+            self.accumulate(directory)
+        self.accumulate('')
+        self.root = PStatLazyLocation('/', 'PYTHONPATH', index=self, key='')
+
+    def depth(self, directory):
+        return (directory.count(os.sep), len(directory))
+
+    def accumulate(self, directory):
+        """Calculate (cumulative, recursive) for the directory record"""
+        cumulative = recursive = 0
+        for filename in self.directory_files.get(directory, ()):
+            for child in self.files[(directory, filename)]:
+                if child.name == '<module>':
+                    continue
+                if isinstance(child, PStatGroup):
+                    cumulative += child.cumulative
+                    recursive += child.recursive
+                else:
+                    cumulative += child.local
+                    recursive += child.calls
+        for subdirectory in self.subdirectories.get(directory, ()):
+            sub_cumulative, sub_recursive = self.totals[subdirectory]
+            cumulative += sub_cumulative
+            recursive += sub_recursive
+        self.totals[directory] = (cumulative, recursive)
+        return cumulative, recursive
+
+    def add(self, row):
+        """Add a new row to an existing file, returns False if the file is new"""
+        filename = '<built-in>' if row.filename == '~' else row.filename
+        current = self.files.get((row.directory, filename))
+        if current is None:
+            return False
+        current.append(row)
+        self.location_rows[row.key] = row
+        record = self.location_rows.get((row.directory, filename, 'package'))
+        if isinstance(record, PStatLocation):
+            if row.name == '<module>':
+                record.local_children.append(row)
+            else:
+                record.children.append(row)
+                row.add_parent(record)
+        return True
+
+    def refresh(self):
+        """Recalculate totals of the (already created) records after changes"""
+        self.totals = {}
+        for directory in sorted(self.directory_files, key=self.depth, reverse=True):
+            self.accumulate(directory)
+        self.accumulate('')
+        for record in [self.root] + list(self.location_rows.values()):
+            if isinstance(record, PStatLazyLocation):
+                record.set_totals()
+            elif isinstance(record, PStatLocation):
+                record.calculate_totals(record.children, record.local_children)
+
+    def expand(self, record):
+        """Create the children of the given directory record"""
+        directory = record.index_key
+        children = []
+        for filename in self.directory_files.get(directory, ()):
+            child = PStatLocation(directory, filename)
+            child.children = list(self.files[(directory, filename)])
+            child.finalize()
+            children.append(child)
+        for subdirectory in self.subdirectories.get(directory, ()):
+            children.append(
+                PStatLazyLocation(subdirectory, '', index=self, key=subdirectory)
+            )
+        for child in children:
+            child.add_parent(record)
+            self.location_rows[child.key] = child
+        return children
+
+
 class PStatLocation(PStatGroup):
     """A row that represents a hierarchic structure other than call-patterns
 
@@ -384,6 +1773,43 @@ class PStatLocation(PStatGroup):
         self.children = real_children
 
 
+class PStatLazyLocation(PStatLocation):
+    """A directory location record which creates its children on first access"""
+
+    def __init__(self, directory, filename, index, key, tree=TREE_FILES):
+        super(PStatLazyLocation, self).__init__(directory, filename, tree=tree)
+        self.index = index
+        self.index_key = key
+        self._children = None
+        self.set_totals()
+
+    def set_totals(self):
+        """Set our totals from the index"""
+        cumulative, recursive = self.index.totals.get(self.index_key, (0, 0))
+        self.cumulative = cumulative
+        self.recursive = recursive
+        if recursive:
+            self.cumulativePer = cumulative / float(recursive)
+        self.local = self.calls = self.localPer = 0
+
+    def _get_children(self):
+        if self._children is None:
+            self._children = self.index.expand(self)
+        return self._children
+
+    def _set_children(self, children):
+        self._children = children
+
+    children = property(_get_children, _set_children)
+
+    @property
+    def expanded(self):
+        return self._children is not None
+
+    def finalize(self, already_done=None):
+        """Our totals were calculated by the index, nothing to do"""
+
+
 if __name__ == "__main__":
     import sys
 
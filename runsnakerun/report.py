@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+"""Headless (text/JSON) reports on profile and memory dumps
+
+Produces the same information as the list views of the GUI viewer, but
+without importing wx or squaremap, so it can run on machines without a
+display (build agents, production servers):
+
+    runsnakereport --report somefile.profile [otherfile.profile ...]
+    runsnakereport --report --memory meliae.memoryfile
+    runsnakereport --report --format json --limit 50 somefile.profile
+    runsnakereport --report --export analysed.runsnakez somefile.profile
+    runsnakereport --report analysed.runsnakez
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, json, heapq, logging, operator, argparse
+from gettext import gettext as _
+
+log = logging.getLogger(__name__)
+
+# (attribute, title) for each of the profile tables
+PROFILE_TABLES = [
+    ('local', _('Local time')),
+    ('cumulative', _('Cumulative time')),
+    ('localPer', _('Local time per call')),
+    ('cumulativePer', _('Cumulative time per call')),
+]
+PROFILE_COLUMNS = [
+    'calls',
+    'recursive',
+    'local',
+    'localPer',
+    'cumulative',
+    'cumulativePer',
+    'name',
+    'filename',
+    'lineno',
+    'directory',
+]
+# (key, title) for each of the memory tables
+MEMORY_TABLES = [
+    ('type', _('Memory by type')),
+    ('module', _('Memory by module')),
+]
+
+RANKS = [
+    (1024 * 1024 * 1024, '%0.1fGB'),
+    (1024 * 1024, '%0.1fMB'),
+    (1024, '%0.1fKB'),
+    (0, '%iB'),
+]
+
+
+def mb(value):
+    """Format a byte count (see meliaeadapter.mb, which requires wx)"""
+    for (unit, format) in RANKS:
+        if abs(value) >= unit * 2:
+            return format % (value / float(unit or 1))
+    raise ValueError("Number where abs(x) is not >= 0?: %s" % (value,))
+
+
+def profile_report(loader, limit=20, tables=None):
+    """Produce top-N tables for a loaded PStatsLoader
+
+    loader -- pstatsloader.PStatsLoader
+    limit -- number of rows in each table
+    tables -- attributes to report on (default all of PROFILE_TABLES)
+
+    returns dictionary suitable for JSON encoding
+    """
+    rows = loader.dense_rows()
+    root = loader.get_root('functions')
+    result = {
+        'files': list(loader.filename),
+        'functions': len(rows),
+        'total': root.cumulative,
+        'tables': [],
+    }
+    for attribute, title in PROFILE_TABLES:
+        if tables and attribute not in tables:
+            continue
+        # nlargest is linear in the number of rows for small limits
+        top = heapq.nlargest(limit, rows, key=operator.attrgetter(attribute))
+        result['tables'].append(
+            {
+                'key': attribute,
+                'title': title,
+                'rows': [
+                    dict([(column, getattr(row, column)) for column in PROFILE_COLUMNS])
+                    for row in top
+                ],
+            }
+        )
+    return result
+
+
+def memory_report(loader, limit=20, tables=None):
+    """Produce memory totals by type/module for a loaded meliaeloader.Loader
+
+    Totals are of each object's own size (not the has-a weighted totals
+    shown in the square map), so they add up to the total memory of the
+    objects reachable from the modules.  Groups of simple objects which
+    the loader compressed into a single <many> record are totalled under
+    the type of their members (and count as a single object).
+    """
+    from runsnakerun import meliaeloader
+
+    root = loader.get_root('memory')
+    records = [
+        record for record in loader.get_rows('memory').values() if record is not root
+    ]
+    result = {
+        'files': [loader.filename],
+        'objects': len(records),
+        'total': sum([record.get('size', 0) for record in records]),
+        'tables': [],
+    }
+    for key, title in MEMORY_TABLES:
+        if tables and key not in tables:
+            continue
+        totals = {}
+        for record in records:
+            if key == 'type' and record.get('type') == meliaeloader.MANY_TYPE:
+                group = record.get('name') or ''
+            else:
+                group = record.get(key) or ''
+            size, count = totals.get(group, (0, 0))
+            totals[group] = (size + record.get('size', 0), count + 1)
+        top = heapq.nlargest(limit, totals.items(), key=lambda item: item[1])
+        result['tables'].append(
+            {
+                'key': key,
+                'title': title,
+                'rows': [
+                    {'key': group, 'size': size, 'count': count}
+                    for group, (size, count) in top
+                ],
+            }
+        )
+    return result
+
+
+def format_profile(report):
+    """Format a profile_report as plain text"""
+    lines = [
+        _('Profile: %s') % (', '.join(report['files']),),
+        _('Functions: %s  Total time: %0.5f') % (report['functions'], report['total'],),
+    ]
+    header = '%9s %9s %10s %10s %10s %10s  %s' % (
+        _('Calls'),
+        _('RCalls'),
+        _('Local'),
+        _('/Call'),
+        _('Cum'),
+        _('/Call'),
+        _('Function'),
+    )
+    for table in report['tables']:
+        lines.extend(['', table['title'], header])
+        for row in table['rows']:
+            lines.append(
+                '%9s %9s %10.5f %10.5f %10.5f %10.5f  %s (%s:%s)'
+                % (
+                    row['calls'],
+                    row['recursive'],
+                    row['local'],
+                    row['localPer'],
+                    row['cumulative'],
+                    row['cumulativePer'],
+                    row['name'],
+                    os.path.join(row['directory'], row['filename']),
+                    row['lineno'],
+                )
+            )
+    return '\n'.join(lines)
+
+
+def format_memory(report):
+    """Format a memory_report as plain text"""
+    lines = [
+        _('Memory: %s') % (', '.join(report['files']),),
+        _('Objects: %s  Total size: %s') % (report['objects'], mb(report['total'])),
+    ]
+    for table in report['tables']:
+        lines.extend(
+            ['', table['title'], '%10s %9s  %s' % (_('Size'), _('Count'), _('Name'))]
+        )
+        for row in table['rows']:
+            lines.append('%10s %9s  %s' % (mb(row['size']), row['count'], row['key']))
+    return '\n'.join(lines)
+
+
+def report(
+    filenames,
+    memory=False,
+    limit=20,
+    tables=None,
+    format='text',
+    threshold=None,
+    export=None,
+):
+    """Load the dump file(s) and produce the formatted report
+
+    Model files (see modelfile) are recognised whatever memory says, export
+    saves the loaded model to that model file.
+    """
+    from runsnakerun import modelfile
+
+    if modelfile.is_model(filenames[0]):
+        loader = modelfile.load(filenames[0])
+        memory = modelfile.kind(filenames[0]) == 'memory'
+    elif memory:
+        from runsnakerun import meliaeloader
+
+        loader = meliaeloader.Loader(filenames[0], processes=True)
+    else:
+        from runsnakerun import pstatsloader
+
+        loader = pstatsloader.PStatsLoader(
+            *filenames, processes=True, threshold=threshold
+        )
+    if export:
+        modelfile.save(loader, export)
+    if memory:
+        result = memory_report(loader, limit, tables)
+        formatter = format_memory
+    else:
+        result = profile_report(loader, limit, tables)
+        formatter = format_profile
+    if format == 'json':
+        return json.dumps(result, indent=2, sort_keys=True)
+    return formatter(result)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='runsnakereport --report',
+        description=_('Report on profile (or meliae memory) dumps without a GUI'),
+    )
+    parser.add_argument('filenames', nargs='+', help=_('dump file(s) to report on'))
+    parser.add_argument(
+        '-m',
+        '--memory',
+        action='store_true',
+        help=_('the file is a meliae memory dump'),
+    )
+    parser.add_argument(
+        '-n', '--limit', type=int, default=20, help=_('rows in each table'),
+    )
+    parser.add_argument(
+        '-t',
+        '--table',
+        action='append',
+        dest='tables',
+        choices=[key for key, title in PROFILE_TABLES + MEMORY_TABLES],
+        help=_('restrict the report to the given table(s)'),
+    )
+    parser.add_argument(
+        '-f', '--format', choices=['text', 'json'], default='text',
+    )
+    parser.add_argument(
+        '--threshold',
+        help=_(
+            'collapse functions cheaper than this many seconds (or N%% of the '
+            'run) into per-caller <other> records'
+        ),
+    )
+    parser.add_argument(
+        '--export',
+        help=_(
+            'also save the loaded model to this model file (compressed if it '
+            'ends with .runsnakez)'
+        ),
+    )
+    parser.add_argument(
+        '-o', '--output', help=_('write the report to this file (default stdout)'),
+    )
+    return parser
+
+
+def main(argv=None):
+    """Command-line entry point for the headless report"""
+    logging.basicConfig(level=logging.WARNING)
+    options = get_parser().parse_args(sys.argv[1:] if argv is None else argv)
+    text = report(
+        options.filenames,
+        memory=options.memory,
+        limit=options.limit,
+        tables=options.tables,
+        format=options.format,
+        threshold=options.threshold,
+        export=options.export,
+    )
+    if options.output:
+        with open(options.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+def dispatch():
+    """Entry point for `runsnakereport`, runs the report for --report, otherwise the GUI
+
+    A console script, so the report (and the GUI's log) reach the terminal,
+    the GUI module (and thus wx) is only imported when it is needed.
+    """
+    argv = sys.argv[1:]
+    if '--report' in argv:
+        argv.remove('--report')
+        return main(argv)
+    from runsnakerun import runsnake
+
+    return runsnake.main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,7 @@
 """The main script for the RunSnakeRun profile viewer"""
 
 from __future__ import absolute_import
-import wx, sys, os, logging, traceback
+import wx, sys, os, logging, traceback, threading
 import six
 
 log = logging.getLogger(__name__)
@@ -17,8 +17,9 @@ from gettext import gettext as _
 import pstats
 from squaremap import squaremap
 from runsnakerun import pstatsloader, pstatsadapter, meliaeloader, meliaeadapter
-from runsnakerun import listviews
+from runsnakerun import listviews, collapsedloader, modelfile
 from runsnakerun import homedirectory
+from runsnakerun import progress
 
 if sys.platform == 'win32':
     windows = True
@@ -33,6 +34,11 @@ log = logging.getLogger(__name__)
 
 ID_OPEN = wx.NewId()
 ID_OPEN_MEMORY = wx.NewId()
+ID_OPEN_DIFF = wx.NewId()
+ID_EXPORT_MODEL = wx.NewId()
+ID_CANCEL_LOAD = wx.NewId()
+ID_WATCH = wx.NewId()
+ID_CACHE = wx.NewId()
 ID_EXIT = wx.NewId()
 
 ID_TREE_TYPE = wx.NewId()
@@ -111,6 +117,46 @@ PROFILE_VIEW_COLUMNS = [
     ),
 ]
 
+DIFF_VIEW_COLUMNS = (
+    PROFILE_VIEW_COLUMNS[:1]
+    + [
+        listviews.ColumnDefinition(
+            name=_('Cum Delta'),
+            attribute='cumulative_delta',
+            format='%+0.5f',
+            defaultOrder=False,
+            sortDefault=True,
+            targetWidth=50,
+        ),
+        listviews.ColumnDefinition(
+            name=_('Local Delta'),
+            attribute='local_delta',
+            format='%+0.5f',
+            defaultOrder=False,
+            targetWidth=50,
+        ),
+        listviews.ColumnDefinition(
+            name=_('Calls Delta'),
+            attribute='calls_delta',
+            format='%+d',
+            defaultOrder=False,
+            targetWidth=50,
+        ),
+        listviews.ColumnDefinition(
+            name=_('Base Cum'),
+            attribute='baseline_cumulative',
+            format='%0.5f',
+            defaultOrder=False,
+            targetWidth=50,
+        ),
+    ]
+    + [
+        column
+        for column in PROFILE_VIEW_COLUMNS[1:]
+        if column.attribute not in ('localPer', 'cumulativePer')
+    ]
+)
+
 MAX_NAME_LEN = 64
 
 
@@ -192,6 +238,22 @@ class MainFrame(wx.Frame):
     viewType = 'functions'
     viewTypeTool = None
 
+    # progress.Progress for the load running in the background (if any)
+    loading = None
+
+    # prune functions below this cost when loading profiles (see
+    # pstatsloader.prune_stats), set with --threshold
+    threshold = None
+
+    # keep loaded profile models in the model cache (see modelcache), off
+    # unless chosen in the File menu or with --cache
+    cacheModels = False
+
+    # milliseconds between checks of the loaded files in watch mode
+    WATCH_INTERVAL = 2000
+    watchSignature = None
+    watchReading = False
+
     TBFLAGS = (
         wx.TB_HORIZONTAL
         # | wx.NO_BORDER
@@ -283,6 +345,7 @@ class MainFrame(wx.Frame):
             squaremap.EVT_SQUARE_SELECTED, self.OnSquareSelectedMap,
         )
         self.squareMap.Bind(squaremap.EVT_SQUARE_ACTIVATED, self.OnNodeActivated)
+        self.tabs.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.OnTabChanged)
         for control in self.ProfileListControls:
             control.Bind(squaremap.EVT_SQUARE_ACTIVATED, self.OnNodeActivated)
             control.Bind(squaremap.EVT_SQUARE_HIGHLIGHTED, self.OnSquareHighlightedList)
@@ -296,6 +359,32 @@ class MainFrame(wx.Frame):
         menu.Append(
             ID_OPEN_MEMORY, _('Open &Memory'), _('Open a Meliae memory-dump file')
         )
+        menu.Append(
+            ID_OPEN_DIFF,
+            _('Open &Diff'),
+            _('Compare a baseline and a candidate set of cProfile files'),
+        )
+        self.exportModelItem = menu.Append(
+            ID_EXPORT_MODEL,
+            _('&Export Model'),
+            _('Save the loaded (analysed) model to a model file for fast re-opening'),
+        )
+        self.cancelLoadItem = menu.Append(
+            ID_CANCEL_LOAD,
+            _('C&ancel Load\tEsc'),
+            _('Stop loading the file(s) currently being loaded'),
+        )
+        self.cancelLoadItem.Enable(False)
+        self.watchItem = menu.AppendCheckItem(
+            ID_WATCH,
+            _('&Watch Files'),
+            _('Update the display whenever the loaded profile files change'),
+        )
+        self.cacheItem = menu.AppendCheckItem(
+            ID_CACHE,
+            _('Cache &Models'),
+            _('Keep loaded profile models on disk so re-opening them is fast'),
+        )
         menu.AppendSeparator()
         menu.Append(ID_EXIT, _('&Close'), _('Close this RunSnakeRun window'))
         menubar.Append(menu, _('&File'))
@@ -345,6 +434,13 @@ class MainFrame(wx.Frame):
         self.Bind(wx.EVT_MENU, lambda evt: self.Close(True), id=ID_EXIT)
         self.Bind(wx.EVT_MENU, self.OnOpenFile, id=ID_OPEN)
         self.Bind(wx.EVT_MENU, self.OnOpenMemory, id=ID_OPEN_MEMORY)
+        self.Bind(wx.EVT_MENU, self.OnOpenDiff, id=ID_OPEN_DIFF)
+        self.Bind(wx.EVT_MENU, self.OnExportModel, id=ID_EXPORT_MODEL)
+        self.Bind(wx.EVT_MENU, self.OnCancelLoad, id=ID_CANCEL_LOAD)
+        self.Bind(wx.EVT_MENU, self.OnWatchToggle, id=ID_WATCH)
+        self.Bind(wx.EVT_MENU, self.OnCacheToggle, id=ID_CACHE)
+        self.watchTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnWatchTimer, self.watchTimer)
 
         self.Bind(wx.EVT_MENU, self.OnPercentageView, id=ID_PERCENTAGE_VIEW)
         self.Bind(
@@ -489,7 +585,7 @@ class MainFrame(wx.Frame):
         dialog = wx.FileDialog(self, style=wx.FD_OPEN | wx.FD_MULTIPLE)
         if dialog.ShowModal() == wx.ID_OK:
             paths = dialog.GetPaths()
-            if self.loader:
+            if self.loader or self.loading:
                 # we've already got a displayed data-set, open new window...
                 frame = MainFrame()
                 frame.Show(True)
@@ -502,7 +598,7 @@ class MainFrame(wx.Frame):
         dialog = wx.FileDialog(self, style=wx.FD_OPEN)
         if dialog.ShowModal() == wx.ID_OK:
             path = dialog.GetPath()
-            if self.loader:
+            if self.loader or self.loading:
                 # we've already got a displayed data-set, open new window...
                 frame = MainFrame()
                 frame.Show(True)
@@ -510,6 +606,44 @@ class MainFrame(wx.Frame):
             else:
                 self.load_memory(path)
 
+    def OnOpenDiff(self, event):
+        """Request to compare two sets of profile files"""
+        paths = []
+        for message in (_('Baseline profile file(s)'), _('Candidate profile file(s)')):
+            dialog = wx.FileDialog(self, message, style=wx.FD_OPEN | wx.FD_MULTIPLE)
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            paths.append(dialog.GetPaths())
+        if self.loader or self.loading:
+            # we've already got a displayed data-set, open new window...
+            frame = MainFrame()
+            frame.Show(True)
+            frame.load_diff(*paths)
+        else:
+            self.load_diff(*paths)
+
+    def OnExportModel(self, event):
+        """Request to save the loaded model to a model file"""
+        if not self.loader:
+            return
+        dialog = wx.FileDialog(
+            self,
+            _('Export model'),
+            wildcard=_('Model files (*%s)|*%s|Compressed model files (*%s)|*%s')
+            % (
+                modelfile.EXTENSION,
+                modelfile.EXTENSION,
+                modelfile.COMPRESSED_EXTENSION,
+                modelfile.COMPRESSED_EXTENSION,
+            ),
+            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT,
+        )
+        if dialog.ShowModal() == wx.ID_OK:
+            try:
+                modelfile.save(self.loader, dialog.GetPath())
+            except ValueError as err:
+                wx.MessageBox(str(err), _('Export model'), wx.OK | wx.ICON_ERROR)
+
     def OnShallowerView(self, event):
         if not self.squareMap.max_depth:
             new_depth = self.squareMap.max_depth_seen or 0 - 1
@@ -645,11 +779,40 @@ class MainFrame(wx.Frame):
 
     def OnSquareSelected(self, event):
         """Update all views to show selection children/parents"""
-        self.selected_node = event.node
-        self.calleeListControl.integrateRecords(self.adapter.children(event.node))
-        self.callerListControl.integrateRecords(self.adapter.parents(event.node))
-        # self.allCalleeListControl.integrateRecords(event.node.descendants())
-        # self.allCallerListControl.integrateRecords(event.node.ancestors())
+        self.SetSelected(event.node)
+
+    def SetSelected(self, node):
+        """Record node as the selection, show its children/parents in the lists"""
+        self.selected_node = node
+        self.calleeListControl.integrateRecords(self.adapter.children(node))
+        self.callerListControl.integrateRecords(self.adapter.parents(node))
+        self.UpdateAllLists()
+
+    def UpdateAllLists(self, page=None):
+        """Fill the All Callees/All Callers list on display (if any)
+
+        Collecting descendants/ancestors walks the whole (lazy) tree below
+        or above the selection, so it is only done for the tab being shown
+        (again when the tab changes) and not for groups (packages,
+        directories) whose descendants are every row below them.
+        """
+        node = self.selected_node
+        if isinstance(node, pstatsloader.PStatGroup):
+            node = None
+        if page is None:
+            page = self.tabs.GetCurrentPage()
+        for control, attribute in (
+            (self.allCalleeListControl, 'descendants'),
+            (self.allCallerListControl, 'ancestors'),
+        ):
+            if control is not page:
+                continue
+            collect = getattr(node, attribute, None)
+            control.integrateRecords(collect() if collect else [])
+
+    def OnTabChanged(self, event):
+        event.Skip()
+        self.UpdateAllLists(self.tabs.GetPage(event.GetSelection()))
 
     def OnMoreSquareToggle(self, event):
         """Toggle the more-square view (better looking, but more likely to filter records)"""
@@ -689,45 +852,269 @@ class MainFrame(wx.Frame):
             self.restoringHistory = False
 
     def load(self, *filenames):
-        """Load our dataset (iteratively)"""
+        """Load our dataset (in the background)"""
         if len(filenames) == 1:
             if os.path.basename(filenames[0]) == 'index.coldshot':
                 return self.load_coldshot(os.path.dirname(filenames[0]))
             elif os.path.isdir(filenames[0]):
                 return self.load_coldshot(filenames[0])
-        try:
-            self.loader = pstatsloader.PStatsLoader(*filenames)
-            self.ConfigureViewTypeChoices()
-            self.SetModel(self.loader)
-            self.viewType = self.loader.ROOTS[0]
-            self.SetTitle(
-                _("Run Snake Run: %(filenames)s")
-                % {'filenames': ', '.join(filenames)[:120]}
+        if modelfile.is_model(filenames[0]):
+            return self.load_model(filenames[0])
+        if collapsedloader.is_collapsed(filenames[0]):
+            return self.load_collapsed(*filenames)
+
+        def factory(token):
+            return pstatsloader.PStatsLoader(
+                *filenames,
+                cache=self.cacheModels,
+                progress=token,
+                threshold=self.threshold
             )
-        except (IOError, OSError, ValueError, MemoryError) as err:
+
+        self.LoadInBackground(factory, filenames, PROFILE_VIEW_COLUMNS)
+
+    def load_collapsed(self, *filenames):
+        """Load collapsed-stack sampling profile(s) (in the background)"""
+
+        def factory(token):
+            return collapsedloader.Loader(*filenames, progress=token)
+
+        self.LoadInBackground(factory, filenames, PROFILE_VIEW_COLUMNS)
+
+    def load_model(self, filename):
+        """Load a saved model file (in the background)"""
+
+        def factory(token):
+            return modelfile.load(filename, progress=token)
+
+        if modelfile.kind(filename) == 'memory':
+            columns = MEMORY_VIEW_COLUMNS
+        else:
+            columns = PROFILE_VIEW_COLUMNS
+        self.LoadInBackground(factory, [filename], columns)
+
+    def load_memory(self, filename):
+        """Load a meliae memory dump (in the background)"""
+
+        def factory(token):
+            return meliaeloader.Loader(filename, progress=token)
+
+        self.LoadInBackground(factory, [filename], MEMORY_VIEW_COLUMNS)
+
+    def load_diff(self, baseline, candidate):
+        """Load a comparison of two sets of profile files (in the background)"""
+        from runsnakerun import diffloader
+
+        def factory(token):
+            return diffloader.DiffLoader(baseline, candidate, progress=token)
+
+        title = _('%(baseline)s vs %(candidate)s') % dict(
+            baseline=', '.join(baseline), candidate=', '.join(candidate)
+        )
+        self.LoadInBackground(factory, [title], DIFF_VIEW_COLUMNS)
+
+    def load_coldshot(self, dirname):
+        """Load a coldshot profile directory (in the background)"""
+        from runsnakerun import coldshotadapter
+
+        def factory(token):
+            loader = coldshotadapter.Loader(dirname)
+            loader.load()
+            return loader
+
+        self.LoadInBackground(factory, [dirname], PROFILE_VIEW_COLUMNS)
+
+    def LoadInBackground(self, factory, filenames, columns):
+        """Run factory(progress) in a worker thread, display the loader it returns
+
+        Any load already in progress is cancelled.  The frame only ever
+        sees the result of the most recently started load.
+
+        Factories load serially: forking worker processes from a thread of
+        the running wx application is not safe (the headless report uses
+        the process pools).
+        """
+        self.CancelLoad()
+        self.loading = token = progress.Progress(
+            lambda phase, done, total: wx.CallAfter(
+                self.OnLoadProgress, token, phase, done, total
+            )
+        )
+        self.cancelLoadItem.Enable(True)
+        worker = threading.Thread(
+            target=self._load_worker,
+            args=(factory, token, filenames, columns),
+            name='RunSnakeRun loader',
+        )
+        worker.daemon = True
+        worker.start()
+
+    def _load_worker(self, factory, token, filenames, columns):
+        """Body of the loading thread, GUI updates go through wx.CallAfter"""
+        try:
+            loader = factory(token)
+            # memory dumps are loaded on first access to the root...
+            loader.get_root(loader.ROOTS[0])
+        except progress.Cancelled:
+            # the frame may already be gone (cancelled by closing it)
+            log.info('Cancelled load of %s', filenames)
+        except Exception as err:
+            # anything else (malformed dumps, stale cache entries...) would
+            # otherwise end the thread silently and leave the load pending
             log.exception('Failure loading: %s', filenames)
+            wx.CallAfter(self.OnLoadFailed, token, filenames, err)
+        else:
+            wx.CallAfter(self.OnLoaded, token, loader, filenames, columns)
+
+    def CancelLoad(self):
+        """Cancel the background load (if any)"""
+        if self.loading:
+            self.loading.cancel()
+            self.loading = None
+        self.cancelLoadItem.Enable(False)
+
+    def OnCancelLoad(self, event):
+        if self.loading:
+            self.CancelLoad()
+            self.SetStatusText(_('Load cancelled'))
+
+    def OnLoadProgress(self, token, phase, done, total):
+        if token is not self.loading:
+            return
+        if total:
             self.SetStatusText(
-                _('Failure during load of %(filenames)s: %(err)s')
-                % dict(filenames=" ".join([repr(x) for x in filenames]), err=err)
+                _('Loading: %(phase)s %(percent)0.0f%%')
+                % dict(phase=phase, percent=100.0 * done / total)
             )
+        else:
+            self.SetStatusText(_('Loading: %(phase)s') % dict(phase=phase))
 
-    def load_memory(self, filename):
-        self.viewType = 'memory'
+    def OnLoadFailed(self, token, filenames, err):
+        if token is not self.loading:
+            return
+        self.loading = None
+        self.cancelLoadItem.Enable(False)
+        self.SetStatusText(
+            _('Failure during load of %(filenames)s: %(err)s')
+            % dict(filenames=" ".join([repr(x) for x in filenames]), err=err)
+        )
+
+    def OnLoaded(self, token, loader, filenames, columns):
+        """The background load has completed, display the result"""
+        if token is not self.loading:
+            return
+        self.loading = None
+        self.cancelLoadItem.Enable(False)
         for view in self.ProfileListControls:
-            view.SetColumns(MEMORY_VIEW_COLUMNS)
-        self.loader = meliaeloader.Loader(filename)
+            view.SetColumns(columns)
+        self.loader = loader
+        self.viewType = loader.ROOTS[0]
         self.ConfigureViewTypeChoices()
-        self.viewType = self.loader.ROOTS[0]
-        self.SetModel(self.loader)
+        self.SetModel(loader)
+        self.SetTitle(
+            _("Run Snake Run: %(filenames)s")
+            % {'filenames': ', '.join(filenames)[:120]}
+        )
+        self.SetStatusText('')
+        self.watchSignature = self.WatchSignature()
 
-    def load_coldshot(self, dirname):
-        from runsnakerun import coldshotadapter
+    def WatchSignature(self):
+        """Size/modification time of each of the loaded files (None if unavailable)"""
+        try:
+            return [
+                (stat.st_size, stat.st_mtime)
+                for stat in [os.stat(filename) for filename in self.loader.filename]
+            ]
+        except (OSError, AttributeError, TypeError) as err:
+            return None
 
-        self.loader = coldshotadapter.Loader(dirname)
-        self.loader.load()
-        self.ConfigureViewTypeChoices()
-        self.viewType = self.loader.ROOTS[0]
-        self.SetModel(self.loader)
+    def OnWatchToggle(self, event):
+        """Start/stop watching the loaded files for changes"""
+        if self.watchItem.IsChecked():
+            if not getattr(self.loader, 'update', None):
+                self.watchItem.Check(False)
+                self.SetStatusText(_('Only profile files can be watched'))
+                return
+            self.watchSignature = self.WatchSignature()
+            self.watchTimer.Start(self.WATCH_INTERVAL)
+        else:
+            self.watchTimer.Stop()
+
+    def OnCacheToggle(self, event):
+        """Turn the model cache on/off for later profile loads"""
+        self.SetCacheModels(self.cacheItem.IsChecked())
+
+    def SetCacheModels(self, cacheModels):
+        """Set whether loaded profile models are kept in the model cache"""
+        self.cacheModels = cacheModels
+        self.cacheItem.Check(cacheModels)
+
+    def OnWatchTimer(self, event):
+        """Check the loaded files, re-read them in the background if changed"""
+        if (
+            self.watchReading
+            or self.loading
+            or not getattr(self.loader, 'update', None)
+        ):
+            return
+        signature = self.WatchSignature()
+        if signature is None or signature == self.watchSignature:
+            return
+        self.watchReading = True
+        worker = threading.Thread(
+            target=self._watch_worker,
+            args=(self.loader, signature),
+            name='RunSnakeRun watcher',
+        )
+        worker.daemon = True
+        worker.start()
+
+    def _watch_worker(self, loader, signature):
+        try:
+            stats = pstatsloader.load_pstats(loader.filename, loader.processes)
+        except Exception as err:
+            # most likely caught the file half-written, retry on next tick
+            log.info('Unable to re-read %s: %s', loader.filename, err)
+            stats = None
+        wx.CallAfter(self.OnWatchStats, loader, signature, stats)
+
+    def OnWatchStats(self, loader, signature, stats):
+        """Apply re-read statistics to the displayed model"""
+        self.watchReading = False
+        if loader is not self.loader or stats is None:
+            return
+        self.watchSignature = signature
+        previous = loader.get_root(self.viewType)
+        changed = loader.update(stats)
+        if changed is None:
+            self.SetModel(loader)
+        elif changed:
+            self.RefreshModel(previous)
+        self.SetStatusText(
+            _('Updated %(count)s functions') % dict(count=len(changed or ()))
+        )
+
+    def RefreshModel(self, previous):
+        """Redisplay a model which has been updated in place
+
+        previous -- the root of the current view before the update
+
+        The activated/selected nodes and history are preserved, unless the
+        root itself was replaced.
+        """
+        self.adapter, tree, rows = self.RootNode()
+        self.listControl.integrateRecords(list(rows.values()))
+        if tree is not previous:
+            if self.activated_node is previous or self.viewType != 'functions':
+                self.activated_node = tree
+                self.selected_node = None
+            self.history = [
+                tree if record is previous else record for record in self.history
+            ]
+        self.squareMap.SetModel(self.activated_node, self.adapter)
+        if self.selected_node is not None:
+            self.squareMap.SetSelected(self.selected_node)
+            self.SetSelected(self.selected_node)
 
     def SetModel(self, loader):
         """Set our overall model (a loader object) and populate sub-controls"""
@@ -762,6 +1149,7 @@ class MainFrame(wx.Frame):
         config_parser.set('window', 'height', str(size[1]))
         config_parser.set('window', 'x', str(position[0]))
         config_parser.set('window', 'y', str(position[1]))
+        config_parser.set('window', 'cache_models', str(self.cacheModels))
 
         for control in self.ProfileListControls:
             control.SaveState(config_parser)
@@ -804,6 +1192,11 @@ class MainFrame(wx.Frame):
             for ctrl in self.ProfileListControls:
                 ctrl.SetFont(font)
 
+        try:
+            self.SetCacheModels(config_parser.getboolean('window', 'cache_models'))
+        except Exception:
+            pass  # the cache is off by default
+
         for control in self.ProfileListControls:
             control.LoadState(config_parser)
 
@@ -811,6 +1204,8 @@ class MainFrame(wx.Frame):
         self.Bind(wx.EVT_CLOSE, self.OnCloseWindow)
 
     def OnCloseWindow(self, event=None):
+        self.CancelLoad()
+        self.watchTimer.Stop()
         try:
             self.SaveState(self.config)
             config = config_file()
@@ -836,14 +1231,27 @@ class RunSnakeRunApp(wx.App):
         frame = MainFrame(config_parser=load_config())
         frame.Show(True)
         self.SetTopWindow(frame)
-        if sys.argv[1:]:
-            if sys.argv[1] == '-m':
-                if sys.argv[2:]:
-                    wx.CallAfter(frame.load_memory, sys.argv[2])
+        argv = sys.argv[:]
+        if '--threshold' in argv[1:-1]:
+            index = argv.index('--threshold')
+            frame.threshold = argv[index + 1]
+            del argv[index : index + 2]
+        if '--cache' in argv[1:]:
+            argv.remove('--cache')
+            frame.SetCacheModels(True)
+        if argv[1:]:
+            if argv[1] == '-m':
+                if argv[2:]:
+                    wx.CallAfter(frame.load_memory, argv[2])
                 else:
                     log.warn('No memory file specified')
+            elif argv[1] == '--diff':
+                if len(argv) == 4:
+                    wx.CallAfter(frame.load_diff, [argv[2]], [argv[3]])
+                else:
+                    log.warn('Specify a baseline and a candidate file to diff')
             else:
-                wx.CallAfter(frame.load, *sys.argv[1:])
+                wx.CallAfter(frame.load, *argv[1:])
         return True
 
 
@@ -897,6 +1305,12 @@ def load_config():
 
 usage = """runsnake.py profilefile
 runsnake.py -m meliae.memoryfile
+runsnake.py --diff baseline.profile candidate.profile
+runsnake.py samples.collapsed (collapsed stacks from a sampling profiler)
+runsnake.py analysed.runsnake (a model saved with File/Export Model)
+runsnake.py --threshold 0.01% profilefile (collapse functions below 0.01% of the run)
+runsnake.py --cache profilefile (keep the loaded model on disk for fast re-opening)
+runsnakereport --report [--memory] [--format json] dumpfile (no GUI, see report.py)
 
 profilefile -- a file generated by a HotShot profile run from Python
 """
@@ -0,0 +1,275 @@
+"""Out-of-core aggregation of many time-sliced pstats dumps
+
+Services which dump a profile every minute produce thousands of dumps a
+day, far too many to merge into a single model.  TimeSeries streams the
+dumps in one at a time (only one raw dump is ever held in memory) and
+reduces each to a sparse per-function (calls, local, cumulative) column
+for its time bucket.  Completed buckets are written to disk as flat
+arrays, so memory use is bounded by the number of distinct functions
+rather than by the number of dumps.
+
+    series = TimeSeries(bucket_seconds=300)
+    for filename in filenames:
+        series.add(filename)
+    series.series(key)  # [(bucket start time, cumulative), ...]
+    series.growth(limit=10)  # functions which grew most over the window
+    loader = series.open_window(start, stop)  # a regular PStatsLoader
+"""
+from __future__ import absolute_import
+import os, heapq, logging, shutil, tempfile
+from array import array
+from bisect import bisect_left
+import six
+from six.moves import range
+from runsnakerun import pstatsloader
+
+log = logging.getLogger(__name__)
+
+# (name, typecode) of the columns stored for each bucket, in file order
+COLUMNS = [
+    ('ids', 'i'),
+    ('calls', pstatsloader.INT64),
+    ('local', 'd'),
+    ('cumulative', 'd'),
+]
+
+
+class Bucket(object):
+    """Sparse per-function totals for a single time bucket
+
+    ids -- sorted function ids present in the bucket
+    calls, local, cumulative -- totals parallel to ids
+    """
+
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def totals(self):
+        """Produce id: [calls, local, cumulative] mapping for merging"""
+        return dict(
+            [
+                (id, [self.calls[i], self.local[i], self.cumulative[i]])
+                for i, id in enumerate(self.ids)
+            ]
+        )
+
+    @classmethod
+    def from_totals(cls, totals):
+        bucket = cls()
+        for id in sorted(totals):
+            calls, local, cumulative = totals[id]
+            bucket.ids.append(id)
+            bucket.calls.append(calls)
+            bucket.local.append(local)
+            bucket.cumulative.append(cumulative)
+        return bucket
+
+    def write(self, filename):
+        with open(filename, 'wb') as fh:
+            for name, typecode in COLUMNS:
+                getattr(self, name).tofile(fh)
+
+    @classmethod
+    def read(cls, filename, count):
+        bucket = cls()
+        with open(filename, 'rb') as fh:
+            for name, typecode in COLUMNS:
+                getattr(bucket, name).fromfile(fh, count)
+        return bucket
+
+    @classmethod
+    def read_value(cls, filename, count, id, field):
+        """Read a single function's field without loading the whole bucket"""
+        ids = array('i')
+        with open(filename, 'rb') as fh:
+            ids.fromfile(fh, count)
+            i = bisect_left(ids, id)
+            if i == count or ids[i] != id:
+                return 0
+            offset = 0
+            for name, typecode in COLUMNS:
+                column = array(typecode)
+                if name == field:
+                    break
+                offset += column.itemsize * count
+            fh.seek(offset + column.itemsize * i)
+            column.fromfile(fh, 1)
+            return column[0]
+
+
+class TimeSeries(object):
+    """Per-function, per-time-bucket totals of a stream of pstats dumps
+
+    bucket_seconds -- width of each time bucket
+    directory -- where to store completed buckets (default a temporary
+        directory, removed by close())
+    timestamp -- callable returning the time of a dump file (default the
+        file's modification time)
+    """
+
+    def __init__(self, bucket_seconds=60, directory=None, timestamp=None):
+        self.bucket_seconds = bucket_seconds
+        self.temporary = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='runsnake-series-')
+        self.timestamp = timestamp or os.path.getmtime
+        self.keys = []
+        self.ids = {}
+        # bucket number: (count, filenames) of completed (on-disk) buckets
+        self.stored = {}
+        self.current = None
+        self.current_totals = None
+        self.current_filenames = None
+
+    def close(self):
+        """Release the on-disk storage (if temporary)"""
+        if self.temporary and os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def function_id(self, key):
+        id = self.ids.get(key)
+        if id is None:
+            id = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return id
+
+    def bucket_for(self, timestamp):
+        return int(timestamp // self.bucket_seconds)
+
+    def bucket_time(self, bucket):
+        """Start time of the given bucket number"""
+        return bucket * self.bucket_seconds
+
+    def bucket_filename(self, bucket):
+        return os.path.join(self.directory, 'bucket-%s.columns' % (bucket,))
+
+    def add(self, filename, timestamp=None):
+        """Stream a single pstats dump into its time bucket"""
+        if timestamp is None:
+            timestamp = self.timestamp(filename)
+        bucket = self.bucket_for(timestamp)
+        if bucket != self.current:
+            self.flush()
+            self.current = bucket
+            if bucket in self.stored:
+                # out-of-order dump, re-open the completed bucket
+                count, filenames = self.stored.pop(bucket)
+                self.current_totals = Bucket.read(
+                    self.bucket_filename(bucket), count
+                ).totals()
+                self.current_filenames = filenames
+            else:
+                self.current_totals = {}
+                self.current_filenames = []
+        totals = self.current_totals
+        function_id = self.function_id
+        for key, (calls, recursive, tt, ct, callers) in six.iteritems(
+            pstatsloader.load_pstats([filename])
+        ):
+            id = function_id(key)
+            current = totals.get(id)
+            if current is None:
+                totals[id] = [calls, tt, ct]
+            else:
+                current[0] += calls
+                current[1] += tt
+                current[2] += ct
+        self.current_filenames.append(filename)
+        return bucket
+
+    def flush(self):
+        """Write the bucket being accumulated to disk"""
+        if self.current is None:
+            return
+        bucket = Bucket.from_totals(self.current_totals)
+        bucket.write(self.bucket_filename(self.current))
+        self.stored[self.current] = (len(bucket), self.current_filenames)
+        self.current = self.current_totals = self.current_filenames = None
+
+    def buckets(self, start=None, stop=None):
+        """Sorted bucket numbers with data, optionally within [start, stop) times"""
+        self.flush()
+        result = sorted(self.stored)
+        if start is not None:
+            result = [b for b in result if self.bucket_time(b) >= start]
+        if stop is not None:
+            result = [b for b in result if self.bucket_time(b) < stop]
+        return result
+
+    def series(self, key, field='cumulative', start=None, stop=None):
+        """How did the field of function key evolve
+
+        returns [(bucket start time, value), ...] (0 where absent)
+        """
+        id = self.ids.get(key)
+        result = []
+        for bucket in self.buckets(start, stop):
+            count, filenames = self.stored[bucket]
+            value = 0
+            if id is not None:
+                value = Bucket.read_value(
+                    self.bucket_filename(bucket), count, id, field
+                )
+            result.append((self.bucket_time(bucket), value))
+        return result
+
+    def growth(self, field='cumulative', start=None, stop=None, limit=20):
+        """Which functions grew most over the window
+
+        Growth is the least-squares slope of the field per bucket (a
+        function absent from a bucket counts as 0), accumulated bucket by
+        bucket so only one bucket is read at a time.
+
+        returns [(slope, key), ...] with the largest slope first
+        """
+        buckets = self.buckets(start, stop)
+        n = len(buckets)
+        if n < 2:
+            return []
+        count = len(self.keys)
+        sum_y = array('d', [0.0]) * count
+        sum_xy = array('d', [0.0]) * count
+        sum_x = sum_xx = 0.0
+        for x, bucket in enumerate(buckets):
+            stored, filenames = self.stored[bucket]
+            data = Bucket.read(self.bucket_filename(bucket), stored)
+            values = getattr(data, field)
+            for i, id in enumerate(data.ids):
+                sum_y[id] += values[i]
+                sum_xy[id] += x * values[i]
+            sum_x += x
+            sum_xx += x * x
+        denominator = n * sum_xx - sum_x * sum_x
+        slopes = (
+            ((n * sum_xy[id] - sum_x * sum_y[id]) / denominator, id)
+            for id in range(count)
+        )
+        return [(slope, self.keys[id]) for slope, id in heapq.nlargest(limit, slopes)]
+
+    def filenames(self, start=None, stop=None):
+        """Dump files contributing to the buckets within [start, stop)"""
+        result = []
+        for bucket in self.buckets(start, stop):
+            result.extend(self.stored[bucket][1])
+        return result
+
+    def open_window(self, start=None, stop=None, **named):
+        """Open the dumps of the buckets within [start, stop) as a merged model
+
+        named -- passed to pstatsloader.PStatsLoader (processes defaults
+            to True, as windows can be large)
+        """
+        filenames = self.filenames(start, stop)
+        if not filenames:
+            raise ValueError('No dumps between %s and %s' % (start, stop))
+        named.setdefault('processes', True)
+        return pstatsloader.PStatsLoader(*filenames, **named)
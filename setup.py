@@ -48,7 +48,10 @@ if __name__ == "__main__":
         packages=['runsnakerun',],
         options={'sdist': {'force_manifest': 1, 'formats': ['gztar', 'zip'],},},
         zip_safe=False,
-        entry_points={'gui_scripts': gui_commands,},
+        entry_points={
+            'gui_scripts': gui_commands,
+            'console_scripts': ['runsnakereport=runsnakerun.report:dispatch',],
+        },
         install_package_data=True,
         classifiers=[
             """License :: OSI Approved :: BSD License""",
@@ -0,0 +1,35 @@
+#! /usr/bin/env python
+"""Time loading a large synthetic collapsed-stack (sampling) profile
+
+bench_collapsed.py [stacks] [functions]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, time, tempfile, shutil
+from runsnakerun import collapsedloader
+from synthetic import synthetic_collapsed
+
+
+def main():
+    stacks = int(sys.argv[1]) if sys.argv[1:] else 200000
+    functions = int(sys.argv[2]) if sys.argv[2:] else 5000
+    lines = synthetic_collapsed(stacks, functions)
+    directory = tempfile.mkdtemp(prefix='runsnake-bench-')
+    try:
+        filename = os.path.join(directory, 'samples.collapsed')
+        with open(filename, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        start = time.time()
+        loader = collapsedloader.Loader(filename)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    root = loader.get_root('calls')
+    print(
+        '%s distinct stacks (%s samples): loaded in %0.2fs (%s contexts, %s functions)'
+        % (len(lines), root.calls, elapsed, loader.contexts, len(loader.rows))
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+"""Compare memory used by the PStatRow object model and the PStatTable model
+
+bench_columnar.py [functions] [fanout]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, gc, time, tracemalloc
+from runsnakerun import pstatsloader
+from synthetic import synthetic_stats
+
+
+def object_model(stats):
+    rows = {}
+    for func, raw in stats.items():
+        rows[func] = pstatsloader.PStatRow(func, raw)
+    for row in rows.values():
+        row.weave(rows)
+    return rows
+
+
+def columnar_model(stats):
+    table = pstatsloader.PStatTable(stats)
+    return table, table.rows()
+
+
+def measure(build, functions, fanout):
+    """Measure memory retained by the model once the raw stats are released"""
+    gc.collect()
+    tracemalloc.start()
+    stats = synthetic_stats(functions, fanout)
+    start = time.time()
+    model = build(stats)
+    elapsed = time.time() - start
+    del stats
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, elapsed
+
+
+def main():
+    functions = int(sys.argv[1]) if sys.argv[1:] else 50000
+    fanout = int(sys.argv[2]) if sys.argv[2:] else 4
+    print('%s functions, average fan-out %s' % (functions, fanout))
+    results = []
+    for name, build in (('objects', object_model), ('columnar', columnar_model)):
+        current, peak, elapsed = measure(build, functions, fanout)
+        results.append(current)
+        print(
+            '%-9s retained %7.1fMB  peak %7.1fMB  build %0.2fs'
+            % (name, current / 1048576.0, peak / 1048576.0, elapsed)
+        )
+    print('columnar uses %0.1f%% of the object model' % (results[1] * 100.0 / results[0]))
+
+
+if __name__ == "__main__":
+    main()
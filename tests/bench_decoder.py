@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+"""Compare the meliae record decoders against per-line stdlib json
+
+bench_decoder.py [dump.memory ...]
+
+Decodes the lines of each meliae dump (default the sample dump.memory)
+with json.loads line-by-line (the baseline), the regex _meliaejson.loads
+line-by-line and each of the batch decoders, and reports which decoder
+meliaeloader would choose (_meliaejson.fastest).
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, json, time
+from runsnakerun import _meliaejson, meliaeloader
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_lines(filename):
+    with open(filename, 'rb') as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def per_line(loads):
+    def decode(lines):
+        return [loads(line.decode('utf-8')) for line in lines]
+
+    return decode
+
+
+def batched(decode):
+    """Decode in batches of the size meliaeloader uses"""
+
+    def decode_batches(lines):
+        result = []
+        for start in range(0, len(lines), meliaeloader.STEP):
+            result.extend(decode(lines[start : start + meliaeloader.STEP]))
+        return result
+
+    return decode_batches
+
+
+def best_of(decode, lines, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = decode(lines)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min((best, elapsed))
+    return best, result
+
+
+def main():
+    filenames = sys.argv[1:] or [os.path.join(HERE, 'dump.memory')]
+    candidates = [
+        ('json.loads', per_line(json.loads)),
+        ('meliaejson.loads', per_line(_meliaejson.loads)),
+    ] + [
+        ('batch ' + name, batched(decode)) for name, decode in _meliaejson.decoders()
+    ]
+    print('fastest(): %s' % (_meliaejson.fastest()[0],))
+    for filename in filenames:
+        lines = read_lines(filename)
+        print('%s: %s records' % (filename, len(lines)))
+        timings = []
+        expected = None
+        for name, decode in candidates:
+            elapsed, result = best_of(decode, lines)
+            if expected is None:
+                expected = result
+            assert result == expected, name
+            timings.append((name, elapsed))
+        baseline = timings[0][1]
+        for name, elapsed in timings:
+            print(
+                '  %-20s %8.3fs  %6.0fk records/s  %5.2fx'
+                % (name, elapsed, len(lines) / elapsed / 1000.0, baseline / elapsed)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+"""Time building a differential model of two large synthetic profiles
+
+bench_diff.py [functions] [changed-fraction]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, time, random, tempfile, shutil, marshal
+from runsnakerun import diffloader
+from synthetic import synthetic_stats
+
+
+def candidate_stats(baseline, fraction, seed=2):
+    """Copy of baseline with fraction of the functions slowed down"""
+    rng = random.Random(seed)
+    candidate = dict(baseline)
+    for key in rng.sample(list(candidate), int(len(candidate) * fraction)):
+        nc, cc, tt, ct, callers = candidate[key]
+        candidate[key] = (nc + 1, cc + 1, tt * 2, ct * 2, callers)
+    return candidate
+
+
+def main():
+    functions = int(sys.argv[1]) if sys.argv[1:] else 100000
+    fraction = float(sys.argv[2]) if sys.argv[2:] else 0.1
+    baseline = synthetic_stats(functions, 2)
+    candidate = candidate_stats(baseline, fraction)
+    directory = tempfile.mkdtemp(prefix='runsnake-bench-')
+    try:
+        filenames = []
+        for name, stats in (('baseline', baseline), ('candidate', candidate)):
+            filename = os.path.join(directory, '%s.profile' % (name,))
+            with open(filename, 'wb') as fh:
+                marshal.dump(stats, fh)
+            filenames.append(filename)
+        start = time.time()
+        loader = diffloader.DiffLoader([filenames[0]], [filenames[1]])
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    print(
+        '%s functions, %0.0f%% changed: diff loaded in %0.2fs (%s rows)'
+        % (functions, fraction * 100, elapsed, len(loader.rows))
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+"""Measure memory used and load time of the (MemoryGraph) meliae model
+
+bench_meliae.py [copies] [processes]
+
+The sample dump (dump.memory) is replicated copies times (at distinct
+addresses) to produce a larger dump.  The model is loaded serially and
+with the lines decoded in a process pool (processes workers, default one
+per cpu).
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, gc, json, time, shutil, tempfile, tracemalloc
+from runsnakerun import meliaeloader
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_dump(filename, copies):
+    with open(os.path.join(HERE, 'dump.memory')) as fh:
+        records = [json.loads(line) for line in fh]
+    with open(filename, 'w') as fh:
+        for copy in range(copies):
+            offset = copy << 48
+            for record in records:
+                record = dict(record)
+                record['address'] += offset
+                record['refs'] = [ref + offset for ref in record['refs']]
+                fh.write(json.dumps(record) + '\n')
+    return len(records) * copies
+
+
+def measure(filename, processes=None):
+    gc.collect()
+    start = time.time()
+    model = meliaeloader.load(filename, processes=processes)
+    elapsed = time.time() - start
+    del model
+    gc.collect()
+    tracemalloc.start()
+    model = meliaeloader.load(filename, processes=processes)
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, elapsed
+
+
+def main():
+    copies = int(sys.argv[1]) if sys.argv[1:] else 10
+    processes = int(sys.argv[2]) if sys.argv[2:] else True
+    directory = tempfile.mkdtemp(prefix='runsnake-bench-')
+    try:
+        filename = os.path.join(directory, 'big.memory')
+        count = write_dump(filename, copies)
+        print('%s objects, %0.1fMB' % (count, os.path.getsize(filename) / 1048576.0))
+        # always use the pool when asked, whatever the size of the dump
+        meliaeloader.MIN_PARALLEL_BYTES = 0
+        for name, pool in (('serial', None), ('parallel', processes)):
+            current, peak, elapsed = measure(filename, pool)
+            print(
+                '%-8s retained %7.1fMB  peak %7.1fMB  load %0.2fs'
+                % (name, current / 1048576.0, peak / 1048576.0, elapsed)
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+#! /usr/bin/env python
+"""Compare serial and process-pool loading of many pstats dumps
+
+bench_parallel.py [count] [functions] [processes]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, time, shutil, tempfile
+from runsnakerun import pstatsloader
+from synthetic import write_dumps
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 64
+    functions = int(sys.argv[2]) if sys.argv[2:] else 5000
+    processes = int(sys.argv[3]) if sys.argv[3:] else True
+    directory = tempfile.mkdtemp(prefix='runsnake-bench-')
+    try:
+        filenames = write_dumps(directory, count=count, functions=functions)
+        serial, expected = timed(pstatsloader.load_pstats, filenames)
+        parallel, result = timed(pstatsloader.load_pstats, filenames, processes)
+        assert sorted(expected.keys()) == sorted(result.keys())
+        print('%s dumps of %s functions' % (count, functions))
+        print('serial:   %0.3fs' % (serial,))
+        print('parallel: %0.3fs (%s processes)' % (parallel, processes))
+        print('speedup:  %0.2fx' % (serial / parallel,))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+"""Time (and measure the memory of) each stage of the pstats loading pipeline
+
+bench_pipeline.py [options] -- see --help
+
+Synthetic profiles (see synthetic.synthetic_stats) are written to disk and
+loaded through PStatsLoader, timing each stage separately:
+
+    load_pstats -- reading (unmarshalling and merging) the dump files
+    rows -- creating the PStatRow objects (or the PStatTable with --columnar)
+    weave -- linking rows to their parents and children
+    find_root -- finding the entry points (strongly connected components)
+    set_entry_points -- creating (PStatGroup.finalize) the run group
+    location -- building the location index (_load_location)
+    location_finalize -- expanding and finalizing the whole location tree
+
+Each stage reports the best of --repeat runs, then a separate (slower)
+run under tracemalloc records the peak memory of each stage.  --output
+saves the results as JSON, --compare reports the change against such a
+file, e.g. one saved before a change:
+
+    bench_pipeline.py --output before.json
+    bench_pipeline.py --compare before.json
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, gc, time, json, shutil, argparse, platform, tempfile, subprocess
+import marshal
+from runsnakerun import pstatsloader, progress
+from synthetic import synthetic_stats
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STAGES = [
+    'load_pstats',
+    'rows',
+    'weave',
+    'find_root',
+    'set_entry_points',
+    'location',
+    'location_finalize',
+]
+
+
+class Marks(object):
+    """Record the time (and traced memory) at which each stage ends"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.times = {}
+        self.peaks = {}
+
+    def mark(self, stage):
+        now = time.time()
+        self.times[stage] = self.times.get(stage, 0) + now - self.last
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.peaks[stage] = max((self.peaks.get(stage, 0), peak))
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self.last = time.time()
+
+
+class TimedLoader(pstatsloader.PStatsLoader):
+    """PStatsLoader which marks the end of each stage of the load"""
+
+    marks = None
+
+    def __init__(self, *filenames, **named):
+        self.marks = named.pop('marks')
+        named['progress'] = progress.Progress(self.on_progress, interval=0)
+        super(TimedLoader, self).__init__(*filenames, **named)
+
+    def on_progress(self, phase, done, total):
+        if phase == 'weave' and not done:
+            self.marks.mark('rows')
+
+    def load(self, stats):
+        # the dumps are streamed, read them all to time the reading alone
+        stats = dict(stats)
+        self.marks.mark('load_pstats')
+        return super(TimedLoader, self).load(stats)
+
+    def find_entry_points(self, rows):
+        if self.columnar:
+            self.marks.mark('rows')
+        else:
+            self.marks.mark('weave')
+        result = super(TimedLoader, self).find_entry_points(rows)
+        self.marks.mark('find_root')
+        return result
+
+    def set_entry_points(self, roots):
+        result = super(TimedLoader, self).set_entry_points(roots)
+        self.marks.mark('set_entry_points')
+        return result
+
+    def _load_location(self):
+        result = super(TimedLoader, self)._load_location()
+        self.marks.mark('location')
+        return result
+
+
+def run(filenames, columnar=False):
+    """Load filenames once, returning the Marks of the stages"""
+    gc.collect()
+    marks = Marks()
+    loader = TimedLoader(*filenames, columnar=columnar, marks=marks)
+    for record in loader.location_tree.descendants():
+        pass
+    marks.mark('location_finalize')
+    marks.rows = len(loader.rows)
+    return marks
+
+
+def git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.STDOUT,
+            )
+            .decode('ascii')
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(options):
+    directory = tempfile.mkdtemp(prefix='runsnake-bench-')
+    try:
+        filenames = []
+        for i in range(options.dumps):
+            filename = os.path.join(directory, 'synthetic-%03d.profile' % (i,))
+            with open(filename, 'wb') as fh:
+                marshal.dump(
+                    synthetic_stats(
+                        options.functions,
+                        options.fanout,
+                        seed=i,
+                        recursion=options.recursion,
+                        cycles=options.cycles,
+                        hubs=options.hubs,
+                    ),
+                    fh,
+                )
+            filenames.append(filename)
+        times = {}
+        for i in range(options.repeat):
+            marks = run(filenames, options.columnar)
+            for stage in STAGES:
+                value = marks.times.get(stage, 0.0)
+                times[stage] = min((times.get(stage, value), value))
+        peaks = {}
+        if tracemalloc is not None:
+            tracemalloc.start()
+            marks = run(filenames, options.columnar)
+            tracemalloc.stop()
+            peaks = marks.peaks
+    finally:
+        shutil.rmtree(directory)
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'parameters': {
+            'functions': options.functions,
+            'fanout': options.fanout,
+            'recursion': options.recursion,
+            'cycles': options.cycles,
+            'hubs': options.hubs,
+            'dumps': options.dumps,
+            'columnar': options.columnar,
+            'repeat': options.repeat,
+        },
+        'rows': marks.rows,
+        'seconds': dict([(stage, times[stage]) for stage in STAGES]),
+        'total_seconds': sum(times.values()),
+        'peak_bytes': dict([(stage, peaks.get(stage, 0)) for stage in STAGES]),
+    }
+
+
+def report(result, baseline=None):
+    print(
+        '%(functions)s functions, fan-out %(fanout)s, recursion %(recursion)s, '
+        'cycles %(cycles)s, hubs %(hubs)s, %(dumps)s dump(s)' % result['parameters']
+    )
+    if baseline is not None:
+        different = dict(
+            [
+                (key, value)
+                for key, value in baseline['parameters'].items()
+                if key != 'repeat' and result['parameters'].get(key) != value
+            ]
+        )
+        if different:
+            print('warning: baseline was run with %s' % (different,))
+    for stage in STAGES + ['total']:
+        if stage == 'total':
+            seconds, peak = result['total_seconds'], max(result['peak_bytes'].values())
+        else:
+            seconds, peak = result['seconds'][stage], result['peak_bytes'][stage]
+        line = '%-18s %8.3fs  peak %8.1fMB' % (stage, seconds, peak / 1048576.0)
+        if baseline is not None:
+            if stage == 'total':
+                before = baseline['total_seconds']
+            else:
+                before = baseline['seconds'].get(stage)
+            if before:
+                line += '  %+6.1f%%' % ((seconds - before) * 100.0 / before,)
+        print(line)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--functions', type=int, default=50000)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument(
+        '--recursion', type=float, default=0.05,
+        help='fraction of functions which call themselves',
+    )
+    parser.add_argument(
+        '--cycles', type=float, default=0.02,
+        help='fraction of functions which call back to an earlier function',
+    )
+    parser.add_argument(
+        '--hubs', type=float, default=0.1,
+        help='fraction of calls made to shared (high fan-in) helpers',
+    )
+    parser.add_argument('--dumps', type=int, default=1, help='number of dump files')
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    return parser
+
+
+def main(argv=None):
+    options = get_parser().parse_args(sys.argv[1:] if argv is None else argv)
+    result = benchmark(options)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as fh:
+            baseline = json.load(fh)
+    report(result, baseline)
+    if options.output:
+        with open(options.output, 'w') as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+"""Time loading a large synthetic profile with and without pruning
+
+bench_prune.py [functions] [threshold]
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, os, time, random, tempfile, shutil, marshal
+from runsnakerun import pstatsloader
+from synthetic import synthetic_stats
+
+
+def skewed_stats(functions, seed=1):
+    """synthetic_stats with heavy-tailed costs, as in real framework profiles
+
+    Most functions cost next to nothing, a few dominate, and the entry point
+    accounts for the whole run.
+    """
+    rng = random.Random(seed)
+    stats = {}
+    total = 0.0
+    for key, (nc, cc, tt, ct, callers) in synthetic_stats(functions, 2).items():
+        scale = rng.paretovariate(1.2) / 1000.0
+        callers = dict(
+            [
+                (caller, (e_nc, e_cc, e_tt * scale, e_ct * scale))
+                for caller, (e_nc, e_cc, e_tt, e_ct) in callers.items()
+            ]
+        )
+        stats[key] = (nc, cc, tt * scale, ct * scale, callers)
+        total += tt * scale
+    root = min(stats, key=lambda key: key[1])
+    nc, cc, tt, ct, callers = stats[root]
+    stats[root] = (nc, cc, tt, total, callers)
+    return stats
+
+
+def main():
+    functions = int(sys.argv[1]) if sys.argv[1:] else 100000
+    threshold = sys.argv[2] if sys.argv[2:] else '0.01%'
+    directory = tempfile.mkdtemp(prefix='runsnake-bench-')
+    try:
+        filename = os.path.join(directory, 'synthetic.profile')
+        with open(filename, 'wb') as fh:
+            marshal.dump(skewed_stats(functions), fh)
+        for option in (None, threshold):
+            start = time.time()
+            loader = pstatsloader.PStatsLoader(filename, threshold=option)
+            loader.location_tree
+            elapsed = time.time() - start
+            print(
+                'threshold %s: %s rows (%s other) loaded in %0.2fs'
+                % (option, len(loader.rows), len(loader.others), elapsed)
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+"""Time the meliae traversals on a long chain and on a wide fan-out graph
+
+bench_traversal.py [nodes]
+
+Compares, for each graph:
+
+    recursive -- the former recursive-generator recurse/find_loops (the
+        latter finding cycles with path scans)
+    dicts -- meliaeloader.recurse/find_loops (explicit stacks, records)
+    dense -- graphs.postorder (dense ids, bitmap) and
+        graphs.cyclic_components (linear-time strongly connected components)
+
+and the time graphs.dominators (Lengauer-Tarjan, for the retained-size
+view) takes on the same graph.
+
+The chain (node i references node i+1, the last node references the
+first) is far deeper than the recursion limit, so the recursive versions
+are expected to fail there.  In the back-reference graph every node of
+each (short) chain also references the head of its chain, the classic
+cycle-per-back-edge search is quadratic (in time and memory) in the
+chain length there, so that graph has a twentieth of the nodes.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, time
+from runsnakerun import meliaeloader, graphs
+
+
+def recursive_recurse(record, index, already_seen):
+    already_seen.add(record['address'])
+    for child in meliaeloader.children(record, index):
+        if child['address'] not in already_seen:
+            for descendant in recursive_recurse(child, index, already_seen):
+                yield descendant
+    yield record
+
+
+def recursive_find_loops(record, index, open, seen):
+    for child in meliaeloader.children(record, index):
+        if child['address'] in open:
+            new = frozenset(open[open.index(child['address']) :])
+            if new not in seen:
+                seen.add(new)
+                yield new
+        elif child['address'] not in seen:
+            seen.add(child['address'])
+            open.append(child['address'])
+            for loop in recursive_find_loops(child, index, open, seen):
+                yield loop
+            open.pop(-1)
+
+
+def chain(count):
+    return [[(i + 1) % count] for i in range(count)]
+
+
+def fanout(count, width=1000):
+    """Root with width children, each with its share of leaves and a back-reference"""
+    edges = [list(range(1, width + 1))]
+    per = (count - width - 1) // width
+    for i in range(width):
+        first = width + 1 + i * per
+        edges.append(list(range(first, first + per)) + [0])
+    edges.extend([[] for i in range(count - len(edges))])
+    return edges
+
+
+def back_references(count, length=200):
+    """Root referencing chains of length nodes, each node referencing its chain's head"""
+    edges = [[]]
+    for head in range(1, count - length + 1, length):
+        edges[0].append(head)
+        for i in range(length - 1):
+            edges.append([head + i + 1, head])
+        edges.append([head])
+    return edges
+
+
+def as_index(edges):
+    return dict(
+        [
+            (address, {'address': address, 'type': 'object', 'refs': refs})
+            for address, refs in enumerate(edges)
+        ]
+    )
+
+
+def timed(function):
+    start = time.time()
+    try:
+        result = function()
+    except RuntimeError as err:  # RecursionError
+        return time.time() - start, 'failed: %s' % (err.__class__.__name__,)
+    return time.time() - start, result
+
+
+def run(name, edges):
+    index = as_index(edges)
+    successors = edges.__getitem__
+    print('%s: %s nodes' % (name, len(edges)))
+    cases = [
+        (
+            'recurse recursive',
+            lambda: len(list(recursive_recurse(index[0], index, set()))),
+        ),
+        ('recurse dicts', lambda: len(list(meliaeloader.recurse(index[0], index)))),
+        (
+            'recurse dense',
+            lambda: len(
+                list(graphs.postorder(0, successors, bytearray(len(edges))))
+            ),
+        ),
+        (
+            'loops recursive',
+            lambda: len(list(recursive_find_loops(index[0], index, [], set()))),
+        ),
+        ('loops dicts', lambda: len(list(meliaeloader.find_loops(index[0], index)))),
+        (
+            'loops dense',
+            lambda: len(graphs.cyclic_components(successors(0), successors)),
+        ),
+        (
+            'dominators dense',
+            lambda: len(graphs.dominators(len(edges), successors, 0)[1]),
+        ),
+    ]
+    for label, function in cases:
+        elapsed, result = timed(function)
+        print('  %-18s %8.3fs  %s' % (label, elapsed, result))
+
+
+def main():
+    count = int(sys.argv[1]) if sys.argv[1:] else 1000000
+    run('chain', chain(count))
+    run('fan-out', fanout(count))
+    run('back-references', back_references(count // 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+"""Time the per-square edge weight lookups of a square map (re)layout
+
+bench_weights.py [functions] [repeats]
+
+Compares computing child_cumulative_time from the edge statistics (as it
+was done on every paint) with reading the weights precomputed in weave.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import sys, time
+from runsnakerun import pstatsloader
+from synthetic import synthetic_stats
+
+
+def computed(parent, child, position):
+    """child_cumulative_time as computed before weights were precomputed"""
+    total = parent.cumulative
+    if total:
+        try:
+            (cc, nc, tt, ct) = child.callers[parent.key]
+        except TypeError as err:
+            ct = child.callers[parent.key]
+        return float(ct) / total
+    return 0
+
+
+def precomputed(parent, child, position):
+    """PStatsAdapter.value's lookup (the position is found in order)"""
+    weights = getattr(parent, 'child_weights', None)
+    if weights is not None:
+        return weights[position]
+    return parent.child_cumulative_time(child)
+
+
+def layout(rows, value, repeats):
+    """Value every (parent, child) square as a layout pass would"""
+    start = time.time()
+    for i in range(repeats):
+        for parent in rows:
+            for position, child in enumerate(parent.children):
+                value(parent, child, position)
+    return time.time() - start
+
+
+def main():
+    functions = int(sys.argv[1]) if sys.argv[1:] else 20000
+    repeats = int(sys.argv[2]) if sys.argv[2:] else 20
+    rows = {}
+    for func, raw in synthetic_stats(functions).items():
+        rows[func] = pstatsloader.PStatRow(func, raw)
+    for row in rows.values():
+        row.weave(rows)
+    rows = list(rows.values())
+    edges = sum([len(row.children) for row in rows])
+    before = layout(rows, computed, repeats)
+    after = layout(rows, precomputed, repeats)
+    print(
+        '%s edges x %s layouts: computed %0.3fs, precomputed %0.3fs (%0.1fx)'
+        % (edges, repeats, before, after, before / (after or 1e-9))
+    )
+
+
+if __name__ == "__main__":
+    main()
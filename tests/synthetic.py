@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+"""Generate synthetic pstats dictionaries/dumps for benchmarking"""
+from __future__ import absolute_import
+from __future__ import print_function
+import random, marshal
+from six.moves import range
+
+
+def function_key(i, modules=50):
+    return ('/usr/lib/python/package%s/module%s.py' % (i % 7, i % modules), i, 'f%s' % i)
+
+
+def synthetic_stats(
+    functions=1000, fanout=4, seed=1, recursion=0.0, cycles=0.0, hubs=0.0
+):
+    """Create a pstats-style dictionary for a random (mostly layered) call graph
+
+    functions -- number of functions in the profile
+    fanout -- average number of callees per function
+    seed -- random seed, the same seed produces the same profile
+    recursion -- fraction of functions which call themselves
+    cycles -- fraction of functions which call back to an earlier function
+        (producing strongly connected components spanning several functions)
+    hubs -- fraction of calls made to a handful of shared helper functions
+        (the last 1% of functions), i.e. the fan-in of the hot helpers
+    """
+    rng = random.Random(seed)
+    keys = [function_key(i) for i in range(functions)]
+    callers = dict([(key, {}) for key in keys])
+    helpers = max((1, functions // 100))
+    for i, key in enumerate(keys[:-1]):
+        for j in range(rng.randint(1, fanout * 2 - 1)):
+            if hubs and rng.random() < hubs:
+                callee = keys[functions - rng.randint(1, min((helpers, functions - i - 1)))]
+            else:
+                callee = keys[rng.randint(i + 1, functions - 1)]
+            nc = rng.randint(1, 100)
+            tt = rng.random() * 0.01
+            callers[callee][key] = (nc, nc, tt, tt * 2)
+    # the extra edges use their own generator so the default graph is stable
+    extra = random.Random(seed + 1)
+    for i, key in enumerate(keys):
+        if recursion and extra.random() < recursion:
+            # recursive calls are not primitive calls
+            nc = extra.randint(1, 100)
+            tt = extra.random() * 0.01
+            callers[key][key] = (nc, 0, tt, tt * 2)
+        if cycles and i and extra.random() < cycles:
+            target = keys[extra.randint(max((0, i - 50)), i - 1)]
+            nc = extra.randint(1, 10)
+            tt = extra.random() * 0.01
+            callers[target][key] = (nc, nc, tt, tt * 2)
+    stats = {}
+    for key in keys:
+        edges = callers[key]
+        nc = sum([edge[0] for edge in edges.values()]) or 1
+        cc = sum([edge[1] for edge in edges.values()]) or 1
+        tt = rng.random() * 0.01
+        ct = tt + sum([edge[3] for edge in edges.values() if edge[1]])
+        stats[key] = (nc, cc, tt, ct, edges)
+    return stats
+
+
+def write_dumps(directory, count=8, functions=1000, fanout=4):
+    """Write count synthetic pstats dump files into directory, return filenames"""
+    import os
+
+    filenames = []
+    for i in range(count):
+        filename = os.path.join(directory, 'synthetic-%03d.profile' % (i,))
+        with open(filename, 'wb') as fh:
+            marshal.dump(synthetic_stats(functions, fanout, seed=i), fh)
+        filenames.append(filename)
+    return filenames
+
+
+def synthetic_collapsed(stacks=100000, functions=1000, fanout=4, seed=1):
+    """Create collapsed-stack lines (a;b;c count) for a random call tree
+
+    Each stack is a random walk from the entry point down a layered call
+    graph (as synthetic_stats), so stacks share prefixes like real sampler
+    output.  Lines are sorted, as the samplers write them.
+    """
+    rng = random.Random(seed)
+    frames = [
+        '%s (%s:%s)' % (name, filename, line)
+        for (filename, line, name) in [function_key(i) for i in range(functions)]
+    ]
+    callees = [
+        sorted(set([rng.randint(i + 1, functions - 1) for j in range(fanout)]))
+        for i in range(functions - 1)
+    ] + [[]]
+    seen = {}
+    for i in range(stacks):
+        current, path = 0, [frames[0]]
+        while callees[current] and rng.random() < 0.9:
+            current = rng.choice(callees[current][:fanout])
+            path.append(frames[current])
+        stack = ';'.join(path)
+        seen[stack] = seen.get(stack, 0) + rng.randint(1, 100)
+    return ['%s %s' % (stack, count) for stack, count in sorted(seen.items())]
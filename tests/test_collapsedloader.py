@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import unittest, os, shutil, tempfile
+from runsnakerun import collapsedloader
+
+SAMPLES = '''main (/srv/app.py:10);handle (/srv/app.py:42);query (/srv/db.py:7) 5
+main (/srv/app.py:10);handle (/srv/app.py:42) 2
+main (/srv/app.py:10);render (/srv/app.py:80);handle (/srv/app.py:42);query (/srv/db.py:7) 3
+main (/srv/app.py:10);fact (/srv/m.py:1);fact (/srv/m.py:1);fact (/srv/m.py:1) 4
+'''
+
+
+def key(name, filename='/srv/app.py', line=1):
+    return (filename, line, name)
+
+
+class CollapsedLoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='runsnake-test-')
+        self.filename = self.write('samples.txt', SAMPLES)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as fh:
+            fh.write(content)
+        return filename
+
+    def test_parse_frame(self):
+        assert collapsedloader.parse_frame('query (/srv/db.py:7)') == (
+            '/srv/db.py',
+            7,
+            'query',
+        )
+        assert collapsedloader.parse_frame('<module> (app.py)') == (
+            'app.py',
+            0,
+            '<module>',
+        )
+        assert collapsedloader.parse_frame('do_syscall_64_[k]') == (
+            '~',
+            0,
+            'do_syscall_64_[k]',
+        )
+
+    def test_is_collapsed(self):
+        assert collapsedloader.is_collapsed(self.filename)
+        here = os.path.dirname(__file__)
+        assert not collapsedloader.is_collapsed(os.path.join(here, 'gallery.profile'))
+
+    def test_context_tree(self):
+        """Do we keep each function's time separate per calling context?"""
+        loader = collapsedloader.Loader(self.filename, interval=0.5)
+        root = loader.get_root('calls')
+        assert root.calls == 14, root.calls
+        assert root.cumulative == 7.0, root.cumulative
+        (main,) = root.children
+        children = dict([(child.name, child) for child in main.children])
+        assert sorted(children) == ['fact', 'handle', 'render'], children
+        handle = children['handle']
+        assert handle.calls == 7 and handle.local == 1.0, handle
+        # the same function called via render is a separate context...
+        (nested,) = children['render'].children
+        assert nested.key == handle.key and nested.calls == 3, nested
+        assert main.child_cumulative_time(handle) == 0.5
+        assert loader.get_rows('calls') is loader.get_rows('functions')
+
+    def test_function_totals(self):
+        """Do we fold the contexts into per-function totals and edges?"""
+        loader = collapsedloader.Loader(self.filename)
+        handle = loader.rows[key('handle', line=42)]
+        assert handle.calls == 10 and handle.local == 2 and handle.cumulative == 10
+        assert sorted(parent.name for parent in handle.parents) == ['main', 'render']
+        assert handle.callers[key('main', line=10)] == (7, 7, 2, 7)
+        # recursion is only counted once per stack
+        fact = loader.rows[key('fact', '/srv/m.py')]
+        assert fact.cumulative == 4 and fact.local == 4, fact
+        assert fact.callers[fact.key] == (4, 4, 4, 4), fact.callers
+        assert loader.get_root('functions').name == 'main'
+        assert loader.get_root('location').cumulative == 14
+
+    def test_malformed(self):
+        filename = self.write('broken.txt', 'main;work 3\nnot a sample line\n\n')
+        loader = collapsedloader.Loader(filename)
+        assert loader.get_root('calls').calls == 3
+        filename = self.write('empty.txt', 'nothing here\n')
+        self.assertRaises(ValueError, collapsedloader.Loader, filename)
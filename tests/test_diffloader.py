@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+import unittest, os, shutil, tempfile, marshal
+from runsnakerun import diffloader
+
+try:
+    from runsnakerun import pstatsadapter
+except ImportError:
+    # the adapters need wxPython and squaremap
+    pstatsadapter = None
+
+
+def write_stats(filename, stats):
+    with open(filename, 'wb') as fh:
+        marshal.dump(stats, fh)
+    return filename
+
+
+def key(name):
+    return ('/srv/app.py', 1, name)
+
+
+class DiffLoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='runsnake-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def diff(self, baseline, candidate):
+        return diffloader.DiffLoader(
+            [write_stats(os.path.join(self.directory, 'base.profile'), baseline)],
+            [write_stats(os.path.join(self.directory, 'cand.profile'), candidate)],
+        )
+
+    def test_deltas(self):
+        """Do we align functions and edges of the two profiles?"""
+        baseline = {
+            key('main'): (1, 1, 0.1, 3.0, {}),
+            key('query'): (4, 4, 2.0, 2.0, {key('main'): (4, 4, 2.0, 2.0)}),
+            key('legacy'): (1, 1, 0.9, 0.9, {key('main'): (1, 1, 0.9, 0.9)}),
+        }
+        candidate = {
+            key('main'): (1, 1, 0.1, 4.5, {}),
+            key('query'): (6, 6, 3.5, 3.5, {key('main'): (6, 6, 3.5, 3.5)}),
+            key('cache'): (2, 2, 0.9, 0.9, {key('main'): (2, 2, 0.9, 0.9)}),
+        }
+        loader = self.diff(baseline, candidate)
+        rows = loader.get_rows('diff')
+        main, query = rows[key('main')], rows[key('query')]
+        assert loader.get_root('diff') is main, loader.get_root('diff')
+        assert abs(query.cumulative_delta - 1.5) < 1e-9, query.cumulative_delta
+        assert query.calls_delta == 2, query.calls_delta
+        assert query.edge_delta(key('main'))[0] == 2
+        legacy, cache = rows[key('legacy')], rows[key('cache')]
+        assert legacy.calls == 0 and legacy.calls_delta == -1
+        assert cache.baseline_calls == 0 and cache.calls_delta == 2
+        # the union of the call graphs
+        assert set(main.children) == set([query, legacy, cache]), main.children
+        assert legacy.relative_delta == -1.0 and cache.relative_delta == 1.0
+
+    @unittest.skipIf(pstatsadapter is None, 'requires wxPython and squaremap')
+    def test_adapter(self):
+        """Do the diff squares add up to the (absolute) deltas of the children?"""
+        baseline = {
+            key('main'): (1, 1, 0.1, 3.0, {}),
+            key('query'): (4, 4, 2.0, 2.0, {key('main'): (4, 4, 2.0, 2.0)}),
+            key('legacy'): (1, 1, 0.9, 0.9, {key('main'): (1, 1, 0.9, 0.9)}),
+        }
+        candidate = {
+            key('main'): (1, 1, 0.1, 4.0, {}),
+            key('query'): (6, 6, 5.0, 5.0, {key('main'): (6, 6, 5.0, 5.0)}),
+            key('legacy'): (1, 1, 1.9, 1.9, {key('main'): (1, 1, 1.9, 1.9)}),
+        }
+        rows = self.diff(baseline, candidate).get_rows('diff')
+        main = rows[key('main')]
+        adapter = pstatsadapter.DiffAdapter()
+        values = sorted([adapter.value(child, main) for child in main.children])
+        assert [round(value, 9) for value in values] == [1.0, 3.0], values
+        total = adapter.children_sum(main.children, main)
+        assert abs(total - 4.0) < 1e-9, total
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
-import unittest
-from runsnakerun import meliaeloader
+import unittest, os, sys, json, shutil, tempfile
+from runsnakerun import meliaeloader, progress, graphs
 from six.moves import range
 
 def records_as_index( records ):
@@ -138,3 +138,204 @@ class MeliaeTests( unittest.TestCase ):
         loop = [x for x in index.values() if x['type'] == '<loop>'][0]
         assert set(loop['parents']) == set([6,7]), loop['parents']
     
+
+    def test_progress( self ):
+        """Do we report the phases of loading a dump?"""
+        phases = []
+        def callback( phase, done, total ):
+            if phase not in phases:
+                phases.append( phase )
+        filename = os.path.join( os.path.dirname( __file__ ), 'dump.memory' )
+        loader = meliaeloader.Loader( filename, progress=progress.Progress( callback ) )
+        loader.get_root( 'memory' )
+        assert phases == ['read','reachability','simplify','group','loops'], phases
+
+    def test_compact( self ):
+        """Does the compact graph model the records of the dump?"""
+        filename = os.path.join( os.path.dirname( __file__ ), 'dump.memory' )
+        raw = dict([
+            (struct['address'], struct)
+            for struct in meliaeloader.read_records( filename )
+        ])
+        root, index = meliaeloader.load( filename )
+        assert abs(root['totsize'] - 944648.915435) < 1e-6, root['totsize']
+        assert len(root['children']) == 69, len(root['children'])
+        assert len(index) == 4582, len(index)
+        assert len(list(index)) == len(index)
+        compressed = 0
+        for record in meliaeloader.iterindex( index ):
+            if record['address'] < 0:
+                continue # synthetic records
+            struct = raw[record['address']]
+            for key in ('type','name','value','len'):
+                assert record.get(key) == struct.get(key), (key, record, struct)
+            if record.get('compressed'):
+                compressed += 1
+                assert record['size'] > struct['size'], (record, struct)
+            else:
+                assert record['size'] == struct['size'], (record, struct)
+            assert abs(record['totsize'] - record['size'] - record['rsize']) < 1e-6
+            for child in record['children']:
+                assert child['address'] in index, (record, child)
+            assert record['index']() is index
+            assert record['root']() is root
+        assert compressed == 104, compressed
+        # the adapter caches values on the records
+        record = root['children'][0]
+        record['contribution'] = 12
+        assert root['children'][0]['contribution'] == 12
+        assert 'contribution' in record and 'contribution' not in root
+
+    def test_parallel( self ):
+        """Does reading in a process pool produce the same model as the serial read?"""
+        filename = os.path.join( os.path.dirname( __file__ ), 'dump.memory' )
+        ranges = meliaeloader.line_ranges( filename, 7 )
+        assert ranges[0][0] == 0 and ranges[-1][1] == os.path.getsize( filename )
+        with open( filename, 'rb' ) as fh:
+            for start, end in ranges:
+                fh.seek( start - 1 if start else 0 )
+                assert not start or fh.read(1) == b'\n', start
+        minimum = meliaeloader.MIN_PARALLEL_BYTES
+        meliaeloader.MIN_PARALLEL_BYTES = 0
+        try:
+            records = list( meliaeloader.read_records( filename ) )
+            assert list( meliaeloader.read_records( filename, processes=3 ) ) == records
+            serial, _ = meliaeloader.load( filename )
+            compact, _ = meliaeloader.load( filename, processes=3 )
+        finally:
+            meliaeloader.MIN_PARALLEL_BYTES = minimum
+        graph, other = serial.graph, compact.graph
+        assert len(graph) == len(other)
+        for name in ('addresses','sizes','lengths','flags','totsize','rsize','ref_offsets','ref_targets'):
+            assert getattr( graph, name ) == getattr( other, name ), name
+        assert graph.values == other.values
+        for id in range( len(graph) ):
+            assert graph.record( id )['type'] == other.record( id )['type']
+            assert graph.parents( id ) == other.parents( id )
+
+    def test_decoders( self ):
+        """Do all of the batch decoders produce the records json does?"""
+        from runsnakerun import _meliaejson
+        import json
+        filename = os.path.join( os.path.dirname( __file__ ), 'dump.memory' )
+        with open( filename, 'rb' ) as fh:
+            lines = [line.strip() for line in fh][:2000] + _meliaejson.SAMPLE[:5]
+        expected = [json.loads( line.decode('utf-8') ) for line in lines]
+        for name, decode in _meliaejson.decoders():
+            assert decode( lines ) == expected, name
+            assert decode( [] ) == [], name
+            # (the regex decoder only asserts the record is complete)
+            self.assertRaises(
+                (ValueError, AssertionError), decode, lines[:3] + [b'{"address": 12,']
+            )
+        name, decode = _meliaejson.fastest()
+        assert name in dict( _meliaejson.decoders() )
+
+    def test_deep( self ):
+        """Can we traverse reference chains deeper than the recursion limit?"""
+        count = sys.getrecursionlimit() * 3
+        edges = [[i + 1] for i in range( count - 1 )] + [[1]]
+        index, shared = records_as_index([
+            {'address': i, 'type': 'object', 'refs': refs} for i, refs in enumerate( edges )
+        ])
+        order = [r['address'] for r in meliaeloader.recurse( index[0], index )]
+        assert order == list( range( count - 1, -1, -1 ) ), order[:10]
+        dense = list( graphs.postorder( 0, edges.__getitem__, bytearray( count ) ) )
+        assert dense == order
+        loops = meliaeloader.find_loops( index[0], index )
+        assert loops == [frozenset( range( 1, count ) )], len( loops )
+        components = graphs.cyclic_components( edges[0], edges.__getitem__ )
+        assert [frozenset( c ) for c in components] == loops
+
+    def test_overlapping_loops( self ):
+        """Do loops sharing records become a single loop record?"""
+        records = [
+            {'size': 10,'type':'moo','address':1,'refs':[4,8]},
+            {'size': 10,'type':'moo','address':4,'refs':[1]},
+            {'size': 10,'type':'moo','address':8,'refs':[1,8]},
+            {'size': 0,'type':'moo','address':5,'refs':[1,4]},
+            {'size': 1,'type':'dict','address':2,'refs':[5]},
+            {'size': 1,'type':'module','address':3,'refs':[2]},
+        ]
+        index,shared = records_as_index( records )
+        meliaeloader.bind_parents( index, shared )
+        meliaeloader.simplify_dicts( index, shared )
+        loops = meliaeloader.find_loops( index[3], index )
+        assert loops == [frozenset([1,4,8])], loops
+        meliaeloader.promote_loops( loops, index, shared )
+        loop = [x for x in index.values() if x['type'] == '<loop>']
+        assert len(loop) == 1, loop
+        loop = loop[0]
+        assert loop['parents'] == [5], loop
+        assert index[5]['refs'] == [loop['address']], index[5]
+        assert index[8]['refs'] == [] and index[8]['parents'] == [loop['address']]
+        meliaeloader.recurse_module( index[3], index, shared )
+        assert loop['totsize'] == 30, loop
+        assert index[3]['totsize'] == 32, index[3]
+
+    def test_dominators( self ):
+        """Are the immediate dominators those of the textbook graph?"""
+        # Lengauer and Tarjan's example, R A B C D E F G H I J K L = 0..12
+        edges = [
+            [1,2,3],[4],[1,4,5],[6,7],[12],[8],[9],[9,10],[5,11],[11],[9],[0,9],[8],
+        ]
+        idom, order = graphs.dominators( len(edges), edges.__getitem__, 0 )
+        assert list(idom) == [-1,0,0,0,0,0,3,3,0,0,7,0,4], idom
+        assert order[0] == 0 and sorted(order) == list(range(len(edges))), order
+        idom, order = graphs.dominators( 3, [[1],[],[1]].__getitem__, 0 )
+        assert list(idom) == [-1,0,-1] and list(order) == [0,1], (idom, order)
+
+    def test_retained( self ):
+        """Is a shared record's size retained by the record dominating it?"""
+        records = [
+            {'size': 10,'type':'moo','address':1,'refs':[4]},
+            {'size': 10,'type':'moo','address':2,'refs':[4]},
+            {'size': 10,'type':'moo','address':4,'refs':[5]},
+            {'size': 5,'type':'moo','address':5,'refs':[]},
+            {'size': 1,'type':'module','address':3,'refs':[1,2]},
+        ]
+        directory = tempfile.mkdtemp( prefix='runsnake-test-' )
+        try:
+            filename = os.path.join( directory, 'small.memory' )
+            with open( filename, 'w' ) as fh:
+                for record in records:
+                    fh.write( json.dumps( record ) + '\n' )
+            loader = meliaeloader.Loader( filename )
+            index = loader.get_rows( 'memory' )
+            assert index[1]['totsize'] == 17.5, index[1]
+            new_root = loader.get_root( 'retained' )
+            new_index = loader.get_rows( 'retained' )
+        finally:
+            shutil.rmtree( directory )
+        assert new_root['totsize'] == 36, new_root
+        assert new_index[1]['totsize'] == 10 and new_index[1]['children'] == []
+        module = new_index[3]
+        assert module['totsize'] == 36 and module['rsize'] == 35, module
+        assert sorted([c['address'] for c in module['children']]) == [1,2,4]
+        assert new_index[4]['parents'] == [3] and new_index[4]['totsize'] == 15
+        assert new_index[5]['parents'] == [4], new_index[5]
+        assert new_index[4]['index']() is new_index and new_index[4]['root']() is new_root
+        # the has-a model is left alone
+        assert index[4]['parents'] == [1,2] and index[1]['totsize'] == 17.5
+
+    def test_retained_compact( self ):
+        """Does the retained model of a dump total the memory of the has-a model?"""
+        filename = os.path.join( os.path.dirname( __file__ ), 'dump.memory' )
+        loader = meliaeloader.Loader( filename )
+        assert loader.ROOTS == ['memory','retained']
+        root = loader.get_root( 'retained' )
+        index = loader.get_rows( 'retained' )
+        assert loader.get_rows( 'memory' ) is not index
+        # everything reachable is retained by the root
+        total = sum([record['size'] for record in loader.get_rows('memory').values()])
+        assert root['totsize'] == total, (root, total)
+        assert len(index) == len(loader.get_rows('memory')), len(index)
+        assert len(list(index)) == len(index)
+        for record in meliaeloader.iterindex( index ):
+            assert record['rsize'] == record['totsize'] - record['size'], record
+            assert len(record.get('parents',())) == (0 if record is root else 1)
+            for child in record['children']:
+                assert child['parents'] == [record['address']], (record, child)
+            assert record['totsize'] == record['size'] + sum(
+                [child['totsize'] for child in record['children']]
+            )
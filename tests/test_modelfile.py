@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+import unittest, os, json, shutil, tempfile
+from runsnakerun import modelfile, pstatsloader, meliaeloader, report
+from test_pstatsloader import write_profile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def row_stats(row):
+    return (row.calls, row.recursive, row.local, row.cumulative)
+
+
+class ModelFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='runsnake-test-')
+        self.profile = write_profile(os.path.join(self.directory, 'test.profile'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, loader, compress):
+        filename = os.path.join(
+            self.directory,
+            'model' + (modelfile.COMPRESSED_EXTENSION if compress else modelfile.EXTENSION),
+        )
+        modelfile.save(loader, filename)
+        assert modelfile.is_model(filename)
+        return modelfile.load(filename)
+
+    def test_pstats(self):
+        """Does a profile model survive a save/load round trip?"""
+        for filenames in ([self.profile], [os.path.join(HERE, 'gallery.profile')]):
+            original = pstatsloader.PStatsLoader(*filenames)
+            for compress in (False, True):
+                loaded = self.round_trip(original, compress)
+                assert isinstance(loaded, modelfile.PStatModelLoader)
+                assert sorted(loaded.rows) == sorted(original.rows)
+                for key, row in original.rows.items():
+                    other = loaded.rows[key]
+                    assert row_stats(other) == row_stats(row), (key, other, row)
+                    assert sorted([c.key for c in other.children]) == sorted(
+                        [c.key for c in row.children]
+                    ), key
+                root = loaded.get_root('functions')
+                assert root.key == original.get_root('functions').key
+                assert root.cumulative == original.get_root('functions').cumulative
+                location = loaded.get_root('location')
+                assert location.cumulative == original.get_root('location').cumulative
+                assert loaded.get_root('context').children
+
+    def test_pstats_pruned(self):
+        """Are the "other" records of a pruned profile preserved?"""
+        original = pstatsloader.PStatsLoader(
+            os.path.join(HERE, 'gallery.profile'), threshold='5%'
+        )
+        assert original.others
+        loaded = self.round_trip(original, False)
+        assert loaded.others == original.others, loaded.others
+
+    def test_memory(self):
+        """Does a memory model survive a save/load round trip?"""
+        original = meliaeloader.Loader(os.path.join(HERE, 'dump.memory'))
+        root = original.get_root('memory')
+        for compress in (False, True):
+            loaded = self.round_trip(original, compress)
+            assert isinstance(loaded, modelfile.MemoryModelLoader)
+            other = loaded.get_root('memory')
+            if not compress and hasattr(memoryview, 'cast'):
+                # the graph's columns are views of the mapped file
+                assert isinstance(loaded.rows.graph.addresses, memoryview)
+                assert isinstance(loaded.rows.graph.ref_targets, memoryview)
+            assert other['totsize'] == root['totsize']
+            assert [c['address'] for c in other['children']] == [
+                c['address'] for c in root['children']
+            ]
+            rows = loaded.get_rows('memory')
+            assert len(rows) == len(original.rows) == len(list(rows))
+            assert sorted(rows) == sorted(
+                [r['address'] for r in meliaeloader.iterindex(original.rows)]
+            )
+            for record in meliaeloader.iterindex(original.rows):
+                copy = rows[record['address']]
+                for key in ('type', 'name', 'size', 'totsize', 'rsize', 'value'):
+                    assert copy.get(key) == record.get(key), (key, copy, record)
+                assert [c['address'] for c in copy['children']] == [
+                    c['address'] for c in record.get('children', ())
+                ]
+                assert len(copy.get('parents', ())) == len(record.get('parents', ()))
+                assert copy['index']() is rows
+
+    def test_report(self):
+        """Does the report of an exported model match that of the dump?"""
+        for name, memory in (('trislam.profile', False), ('dump.memory', True)):
+            filename = os.path.join(self.directory, name + modelfile.EXTENSION)
+            expected = json.loads(
+                report.report(
+                    [os.path.join(HERE, name)],
+                    memory=memory,
+                    format='json',
+                    export=filename,
+                )
+            )
+            result = json.loads(report.report([filename], format='json'))
+            # the report names the file it was produced from
+            result.pop('files', None)
+            expected.pop('files', None)
+            assert result == expected, name
+
+    def test_invalid(self):
+        """Do we refuse files which are not (current) model files?"""
+        assert not modelfile.is_model(self.profile)
+        self.assertRaises(ValueError, modelfile.ModelFile, self.profile)
+        filename = os.path.join(self.directory, 'model.runsnake')
+        modelfile.save(pstatsloader.PStatsLoader(self.profile), filename)
+        with open(filename, 'r+b') as fh:
+            fh.seek(len(modelfile.MAGIC))
+            fh.write(b'\xff\0\0\0')
+        self.assertRaises(ValueError, modelfile.load, filename)
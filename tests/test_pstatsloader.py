@@ -0,0 +1,508 @@
+from __future__ import absolute_import
+import unittest, os, io, sys, shutil, tempfile, cProfile, marshal
+from runsnakerun import pstatsloader, modelcache, progress
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def leaf(count):
+    return sum(range(count))
+
+
+def middle():
+    for i in range(10):
+        leaf(1000)
+    return leaf(10)
+
+
+def top():
+    middle()
+    leaf(5)
+
+
+def write_profile(filename, command='top()'):
+    profiler = cProfile.Profile()
+    profiler.runctx(command, globals(), locals())
+    profiler.dump_stats(filename)
+    return filename
+
+
+def write_stats(filename, stats):
+    with open(filename, 'wb') as fh:
+        marshal.dump(stats, fh)
+    return filename
+
+
+class PStatsLoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='runsnake-test-')
+        self.profile = write_profile(os.path.join(self.directory, 'test.profile'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def find(self, loader, name):
+        return [row for row in loader.rows.values() if row.name == name][0]
+
+    def test_load(self):
+        """Do we build the call graph from a native dump?"""
+        loader = pstatsloader.PStatsLoader(self.profile)
+        assert loader.tree is loader.get_root('functions')
+        middle = self.find(loader, 'middle')
+        leaf = self.find(loader, 'leaf')
+        assert leaf in middle.children, middle.children
+        assert middle in leaf.parents, leaf.parents
+        assert leaf.calls == 12, leaf.calls
+
+    def test_model_cache(self):
+        """Does a second open restore an equivalent model from the cache?"""
+        cache = os.path.join(self.directory, 'cache')
+        os.makedirs(cache)
+        first = pstatsloader.PStatsLoader(self.profile, cache=cache)
+        assert len(os.listdir(cache)) == 1, os.listdir(cache)
+        second = pstatsloader.PStatsLoader(self.profile, cache=cache)
+        assert sorted(first.rows.keys()) == sorted(second.rows.keys())
+        assert second.tree.key == first.tree.key
+        middle = self.find(second, 'middle')
+        leaf = self.find(second, 'leaf')
+        assert leaf in middle.children
+        assert middle in leaf.parents
+        assert leaf.cumulative == self.find(first, 'leaf').cumulative
+        assert second.get_root('location').children
+
+    def test_model_cache_invalidation(self):
+        """Does rewriting the dump replace the stale cache entry?"""
+        cache = os.path.join(self.directory, 'cache')
+        os.makedirs(cache)
+        pstatsloader.PStatsLoader(self.profile, cache=cache)
+        old = os.listdir(cache)
+        write_profile(self.profile, 'leaf(10)')
+        loader = pstatsloader.PStatsLoader(self.profile, cache=cache)
+        assert [row for row in loader.rows.values() if row.name == 'middle'] == []
+        new = os.listdir(cache)
+        assert len(new) == 1 and new != old, (old, new)
+
+    def test_model_cache_digest(self):
+        """Do cache keys digest only the ends of large dumps?"""
+        filename = os.path.join(self.directory, 'large.dump')
+        with open(filename, 'wb') as fh:
+            fh.write(b'a' * 100 + b'b' * 100 + b'c' * 100)
+        full = modelcache.file_digest(filename, sample=None)
+        sampled = modelcache.file_digest(filename, sample=100)
+        assert modelcache.file_digest(filename, sample=150) == full
+        with open(filename, 'r+b') as fh:
+            fh.seek(150)
+            fh.write(b'x')
+        assert modelcache.file_digest(filename, sample=100) == sampled
+        assert modelcache.file_digest(filename, sample=None) != full
+        with open(filename, 'r+b') as fh:
+            fh.seek(250)
+            fh.write(b'x')
+        assert modelcache.file_digest(filename, sample=100) != sampled
+
+    def test_model_cache_prune(self):
+        """Do we discard least-recently-used entries above the size cap?"""
+        cache = os.path.join(self.directory, 'cache')
+        os.makedirs(cache)
+        for i in range(3):
+            modelcache.store(('p%s' % i, 'c'), list(range(1000)), cache)
+            os.utime(modelcache.entry_filename(('p%s' % i, 'c'), cache), (i, i))
+        size = os.path.getsize(modelcache.entry_filename(('p0', 'c'), cache))
+        modelcache.prune(cache, size * 2)
+        assert sorted(os.listdir(cache)) == ['p1-c.model', 'p2-c.model'], os.listdir(
+            cache
+        )
+
+    def test_parallel_load(self):
+        """Does the process-pool merge produce the same stats as pstats?"""
+        filenames = [
+            write_profile(os.path.join(self.directory, '%s.profile' % (i,)))
+            for i in range(4)
+        ]
+        serial = pstatsloader.load_pstats(filenames)
+        parallel = pstatsloader.load_pstats(filenames, processes=2)
+        assert sorted(serial.keys()) == sorted(parallel.keys())
+        for key, (cc, nc, tt, ct, callers) in serial.items():
+            p_cc, p_nc, p_tt, p_ct, p_callers = parallel[key]
+            assert (cc, nc) == (p_cc, p_nc), key
+            assert abs(ct - p_ct) < 1e-9, key
+            assert sorted(callers.keys()) == sorted(p_callers.keys()), key
+
+    def test_foreign_dump(self):
+        """Can we load python2 pstats dumps without a python2 interpreter?"""
+        loader = pstatsloader.PStatsLoader(os.path.join(HERE, 'gallery.profile'))
+        assert len(loader.rows) > 1, loader.rows
+        for key in loader.rows:
+            assert not isinstance(key[0], bytes), key
+
+    def test_foreign_merge(self):
+        """Do native and foreign dumps merge into a single stats dictionary?"""
+        stats = pstatsloader.load_pstats(
+            [os.path.join(HERE, 'gallery.profile'), self.profile]
+        )
+        names = set([key[2] for key in stats])
+        assert 'middle' in names, names
+        assert '<_sre.compile>' in names, names
+
+    def test_marshal_versions(self):
+        """Does the marshal decoder read every marshal format version?"""
+        stats = {
+            ('module.py', 10, 'function'): (
+                2,
+                3,
+                0.25,
+                1.5,
+                {('caller.py', 2, 'caller'): (2, 3, 0.25, 1.5)},
+            ),
+            ('~', 0, '<built-in>'): (1, 1, 0.0, 0.0, {}),
+        }
+        for version in range(marshal.version + 1):
+            reader = pstatsloader.MarshalReader(
+                io.BytesIO(marshal.dumps(stats, version))
+            )
+            assert dict(reader.iter_dict()) == stats, version
+
+    def test_columnar(self):
+        """Do PStatTable views match the PStatRow object model?"""
+        rows = pstatsloader.PStatsLoader(self.profile)
+        table = pstatsloader.PStatsLoader(self.profile, columnar=True)
+        assert sorted(rows.rows.keys()) == sorted(table.rows.keys())
+        for key, row in rows.rows.items():
+            if not isinstance(row, pstatsloader.PStatRow):
+                continue
+            view = table.rows[key]
+            for attribute in (
+                'calls',
+                'recursive',
+                'local',
+                'localPer',
+                'cumulative',
+                'cumulativePer',
+                'directory',
+                'filename',
+                'name',
+                'lineno',
+                'callers',
+            ):
+                assert getattr(row, attribute) == getattr(view, attribute), attribute
+            assert sorted([c.key for c in row.children]) == sorted(
+                [c.key for c in view.children]
+            )
+            for child in row.children:
+                assert row.child_cumulative_time(child) == view.child_cumulative_time(
+                    table.rows[child.key]
+                )
+        assert table.get_root('location').cumulative == rows.location_tree.cumulative
+
+    def test_columnar_cache(self):
+        """Can columnar models be restored from the model cache?"""
+        cache = os.path.join(self.directory, 'cache')
+        os.makedirs(cache)
+        pstatsloader.PStatsLoader(self.profile, cache=cache, columnar=True)
+        loader = pstatsloader.PStatsLoader(self.profile, cache=cache, columnar=True)
+        assert loader.table is not None
+        leaf = self.find(loader, 'leaf')
+        assert self.find(loader, 'middle') in leaf.parents
+
+    def test_lazy_location(self):
+        """Is the location tree only built (and expanded) on demand?"""
+        loader = pstatsloader.PStatsLoader(self.profile)
+        assert 'location' not in loader.roots
+        root = loader.get_root('location')
+        assert not root.expanded
+        leaf = self.find(loader, 'leaf')
+        assert root.cumulative >= leaf.local
+        assert len(loader.get_rows('location')) == len(loader.rows)
+        children = root.children
+        assert root.expanded
+        for child in children:
+            assert root in child.parents
+            assert child.key in loader.get_rows('location')
+        assert abs(sum([c.cumulative for c in children]) - root.cumulative) < 1e-9
+
+    def test_deep_descendants(self):
+        """Can we traverse call chains deeper than the recursion limit?"""
+        depth = sys.getrecursionlimit() * 2
+        keys = [('chain.py', i, 'f%s' % (i,)) for i in range(depth)]
+        stats = {}
+        for i, key in enumerate(keys):
+            callers = {keys[i - 1]: (1, 1, 0.1, 1.0)} if i else {}
+            stats[key] = (1, 1, 0.1, float(depth - i), callers)
+        stats[keys[0]] = (1, 1, 0.1, float(depth), {keys[-1]: (1, 1, 0.1, 1.0)})
+        filename = write_stats(os.path.join(self.directory, 'chain.profile'), stats)
+        for columnar in (False, True):
+            loader = pstatsloader.PStatsLoader(filename, columnar=columnar)
+            first, last = loader.rows[keys[0]], loader.rows[keys[-1]]
+            descendants = first.descendants()
+            assert len(descendants) == depth, len(descendants)
+            assert [row.key for row in descendants[:3]] == keys[1:3] + [keys[3]]
+            assert len(last.ancestors()) == depth
+
+    def test_reachability(self):
+        """Does the reachability index agree with descendants/ancestors?"""
+        for columnar in (False, True):
+            loader = pstatsloader.PStatsLoader(
+                self.profile, columnar=columnar, reachability=True
+            )
+            assert loader.reachability is not None
+            rows = loader.dense_rows()
+            for row in rows:
+                descendants = row.descendants()
+                assert loader.descendant_count(row) == len(descendants), row
+                # synthetic (group) records are not part of the index
+                ancestors = [a for a in row.ancestors() if a in rows]
+                assert loader.ancestor_count(row) == len(ancestors), row
+                assert abs(
+                    loader.descendant_time(row) - sum([d.local for d in descendants])
+                ) < 1e-9
+                for other in rows:
+                    assert loader.reaches(row, other) == (other in descendants)
+
+    def test_threaded_roots(self):
+        """Do we group every thread entry point (and cyclic entries) under the root?"""
+        key = lambda name: ('server.py', 1, name)
+        stats = {
+            key('main'): (1, 1, 0.1, 2.0, {}),
+            key('serve'): (1, 1, 0.1, 1.0, {key('main'): (1, 1, 0.1, 1.0)}),
+            key('bootstrap'): (1, 1, 0.1, 5.0, {}),
+            key('handle'): (
+                2,
+                2,
+                0.2,
+                5.0,
+                {key('bootstrap'): (1, 1, 0.1, 4.0), key('serve'): (1, 1, 0.1, 1.0)},
+            ),
+            # mutually recursive pair without external callers
+            key('ping'): (2, 1, 0.1, 3.0, {key('pong'): (1, 1, 0.1, 3.0)}),
+            key('pong'): (2, 1, 0.1, 2.0, {key('ping'): (1, 1, 0.1, 2.0)}),
+        }
+        filename = write_stats(os.path.join(self.directory, 'threads.profile'), stats)
+        for columnar in (False, True):
+            loader = pstatsloader.PStatsLoader(filename, columnar=columnar)
+            root = loader.tree
+            assert isinstance(root, pstatsloader.PStatGroup), root
+            assert [child.name for child in root.children] == [
+                'bootstrap',
+                'ping',
+                'main',
+            ], root.children
+        del stats[key('bootstrap')], stats[key('ping')], stats[key('pong')]
+        stats[key('handle')] = (1, 1, 0.2, 1.0, {key('serve'): (1, 1, 0.1, 1.0)})
+        filename = write_stats(os.path.join(self.directory, 'single.profile'), stats)
+        loader = pstatsloader.PStatsLoader(filename)
+        assert loader.tree is loader.rows[key('main')], loader.tree
+
+    def test_progress(self):
+        """Do we report load phases and stop when cancelled?"""
+        phases = []
+
+        def callback(phase, done, total):
+            if phase not in phases:
+                phases.append(phase)
+
+        pstatsloader.PStatsLoader(self.profile, progress=progress.Progress(callback))
+        assert phases == ['read', 'weave', 'find root'], phases
+
+        token = progress.Progress()
+
+        def cancel(phase, done, total):
+            if phase == 'weave':
+                token.cancel()
+
+        token.callback = cancel
+        self.assertRaises(
+            progress.Cancelled, pstatsloader.PStatsLoader, self.profile, progress=token
+        )
+
+    def test_update(self):
+        """Do we apply changed snapshots in place, matching a fresh load?"""
+        key = lambda name, filename='app.py': ('/srv/%s' % (filename,), 1, name)
+        first = {
+            key('main'): (1, 1, 0.1, 3.0, {}),
+            key('handle'): (2, 2, 0.5, 2.9, {key('main'): (2, 2, 0.5, 2.9)}),
+            key('query'): (4, 4, 2.4, 2.4, {key('handle'): (4, 4, 2.4, 2.4)}),
+        }
+        second = dict(first)
+        second[key('query')] = (6, 6, 3.0, 3.0, {key('handle'): (6, 6, 3.0, 3.0)})
+        second[key('render')] = (
+            1,
+            1,
+            0.3,
+            0.3,
+            {key('handle'): (1, 1, 0.3, 0.3)},
+        )
+        second[key('handle')] = (3, 3, 0.6, 3.9, {key('main'): (3, 3, 0.6, 3.9)})
+        second[key('main')] = (1, 1, 0.1, 4.0, {})
+        # a new thread entry point, in a new file
+        second[key('worker', 'worker.py')] = (1, 1, 1.0, 1.0, {})
+        third = dict(first)
+
+        def snapshot(loader):
+            return dict(
+                [
+                    (
+                        row.key,
+                        (
+                            row.calls,
+                            row.local,
+                            row.cumulative,
+                            sorted([c.key for c in row.children]),
+                            sorted([p.key for p in row.parents]),
+                        ),
+                    )
+                    for row in loader.rows.values()
+                    if row.calls
+                ]
+            )
+
+        loader = pstatsloader.PStatsLoader(
+            write_stats(os.path.join(self.directory, 'first.profile'), first)
+        )
+        main, query = loader.rows[key('main')], loader.rows[key('query')]
+        assert loader.tree is main
+        location = loader.location_tree
+        for child in location.children:
+            child.children
+        assert loader.update(first) == []
+        for stats in (second, third):
+            changed = loader.update(stats)
+            assert changed, changed
+            expected = pstatsloader.PStatsLoader(
+                write_stats(os.path.join(self.directory, 'expected.profile'), stats)
+            )
+            assert snapshot(loader) == snapshot(expected)
+            assert loader.rows[key('main')] is main
+            assert loader.rows[key('query')] is query
+            assert loader.tree.cumulative == expected.tree.cumulative
+            assert loader.location_tree.cumulative == expected.location_tree.cumulative
+        assert query.calls == 4, query.calls
+        assert loader.tree is main, loader.tree
+
+    def test_prune(self):
+        """Do we collapse cheap functions into exact per-parent other records?"""
+        key = lambda name: ('/srv/app.py', 1, name)
+        stats = {
+            key('main'): (1, 1, 1.5, 10.0, {}),
+            key('work'): (1, 1, 6.0, 6.0, {key('main'): (1, 1, 6.0, 6.0)}),
+            key('log'): (5, 5, 2.0, 2.0, {}),
+        }
+        for i in range(5):
+            tiny = key('tiny%s' % (i,))
+            stats[tiny] = (1, 1, 0.1, 0.5, {key('main'): (1, 1, 0.1, 0.5)})
+            stats[key('log')][4][tiny] = (1, 1, 0.4, 0.4)
+        filename = write_stats(os.path.join(self.directory, 'tiny.profile'), stats)
+        for threshold in (1.0, '10%'):
+            loader = pstatsloader.PStatsLoader(filename, threshold=threshold)
+            assert sorted(loader.rows) == sorted(
+                [key('main'), key('work'), key('log'), key('<other:main>')]
+            ), sorted(loader.rows)
+            main, log = loader.rows[key('main')], loader.rows[key('log')]
+            other = loader.rows[key('<other:main>')]
+            assert isinstance(other, pstatsloader.PStatOther)
+            assert loader.tree is main
+            assert other.parents == [main] and other.calls == 5
+            assert abs(other.cumulative - 2.5) < 1e-9, other.cumulative
+            # the significant function called only from pruned ones...
+            assert log.parents == [other], log.parents
+            assert abs(other.local - 0.5) < 1e-9, other.local
+            assert abs(other.child_cumulative_time(log) - 0.8) < 1e-9
+            shares = [main.child_cumulative_time(c) for c in main.children]
+            assert abs(sum(shares) - 0.85) < 1e-9, shares
+        loader = pstatsloader.PStatsLoader(filename, threshold='0.1%')
+        assert len(loader.rows) == len(stats)
+        # a model restored from the cache still knows its other records
+        cache = os.path.join(self.directory, 'cache')
+        os.makedirs(cache)
+        for i in range(2):
+            loader = pstatsloader.PStatsLoader(filename, threshold=1.0, cache=cache)
+            assert loader.others == frozenset([key('<other:main>')]), loader.others
+
+    def test_child_weights(self):
+        """Are edge fractions precomputed, aligned and kept up to date?"""
+        filename = os.path.join(self.directory, 'test.profile')
+        write_profile(filename)
+
+        def fractions(loader):
+            result = {}
+            for row in loader.dense_rows():
+                for child in row.children:
+                    ct = child.callers[row.key][3]
+                    expected = ct / row.cumulative if row.cumulative else 0
+                    value = row.child_cumulative_time(child)
+                    assert abs(value - expected) < 1e-12, (row, child, value)
+                    result[(row.key, child.key)] = value
+            return result
+
+        loader = pstatsloader.PStatsLoader(filename)
+        for row in loader.rows.values():
+            if isinstance(row, pstatsloader.PStatRow):
+                assert len(row.child_weights) == len(row.children)
+        expected = fractions(loader)
+        assert expected
+        columnar = pstatsloader.PStatsLoader(filename, columnar=True)
+        assert fractions(columnar) == expected
+        cached = pstatsloader.PStatsLoader(filename, cache=self.directory)
+        cached = pstatsloader.PStatsLoader(filename, cache=self.directory)
+        assert fractions(cached) == expected
+        # an update changes the parent's total and the edge...
+        stats = dict(pstatsloader.load_pstats([filename]))
+        key = [key for key in stats if key[2] == 'middle'][0]
+        nc, cc, tt, ct, callers = stats[key]
+        stats[key] = (nc, cc, tt, ct * 2, callers)
+        loader.update(stats)
+        fractions(loader)
+
+    def test_context(self):
+        """Do we unfold shared callees into estimated per-context times?"""
+        key = lambda name: ('/srv/app.py', 1, name)
+        stats = {
+            key('main'): (1, 1, 0.0, 10.0, {}),
+            key('a'): (1, 1, 0.0, 6.0, {key('main'): (1, 1, 0.0, 6.0)}),
+            key('b'): (1, 1, 3.0, 4.0, {key('main'): (1, 1, 3.0, 4.0)}),
+            key('shared'): (
+                4,
+                2,
+                2.0,
+                4.0,
+                {
+                    key('a'): (3, 1, 1.5, 3.0),
+                    key('b'): (1, 1, 0.5, 1.0),
+                    key('shared'): (2, 0, 0.0, 0.5),
+                },
+            ),
+            key('leaf'): (2, 2, 2.0, 2.0, {key('shared'): (2, 2, 2.0, 2.0)}),
+        }
+        filename = write_stats(os.path.join(self.directory, 'shared.profile'), stats)
+        loader = pstatsloader.PStatsLoader(filename)
+        assert 'context' in loader.ROOTS
+        root = loader.get_root('context')
+        assert root.row is loader.tree and root.cumulative == 10.0
+        assert loader.context_count == 1
+        a, b = sorted(root.children, key=lambda context: context.name)
+        assert (a.cumulative, b.cumulative) == (6.0, 4.0)
+        (via_a,) = a.children
+        (via_b,) = b.children
+        assert via_a.key == via_b.key == key('shared')
+        assert (via_a.cumulative, via_b.cumulative) == (3.0, 1.0)
+        assert via_a.calls == 3.0 and via_b.local == 0.5
+        # the recursive edge is not unfolded
+        assert [context.name for context in via_a.children] == ['leaf']
+        assert via_a.children[0].cumulative == 1.5
+        assert via_b.children[0].ancestors() == [
+            loader.rows[key(name)] for name in ('main', 'b', 'shared')
+        ]
+        assert root.child_cumulative_time(a) == 0.6
+        assert loader.context_count == 7
+
+        limited = pstatsloader.PStatsLoader(filename, context_nodes=3)
+        root = limited.get_root('context')
+        assert len(root.children) == 2
+        assert [c.children for c in root.children] == [[], []]
+        shallow = pstatsloader.PStatsLoader(filename, context_depth=1)
+        root = shallow.get_root('context')
+        assert [c.children for c in root.children] == [[], []]
+
+        # updates rebuild the (estimated) contexts
+        stats[key('main')] = (1, 1, 0.0, 11.0, {})
+        loader.update(stats)
+        assert loader.get_root('context').cumulative == 11.0
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+import unittest, os, sys, json, subprocess
+from runsnakerun import report
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class ReportTests(unittest.TestCase):
+    def test_profile_report(self):
+        """Do we produce sorted top-N tables for a profile?"""
+        result = json.loads(
+            report.report([os.path.join(HERE, 'trislam.profile')], limit=3, format='json')
+        )
+        assert result['functions'] == 49, result['functions']
+        assert [table['key'] for table in result['tables']] == [
+            key for key, title in report.PROFILE_TABLES
+        ]
+        for table in result['tables']:
+            values = [row[table['key']] for row in table['rows']]
+            assert len(values) == 3, values
+            assert values == sorted(values, reverse=True), values
+        text = report.report(
+            [os.path.join(HERE, 'trislam.profile')], limit=3, tables=['local']
+        )
+        assert 'end_frame' in text, text
+
+    def test_memory_report(self):
+        """Do we total memory by type and module?"""
+        result = json.loads(
+            report.report(
+                [os.path.join(HERE, 'dump.memory')], memory=True, format='json'
+            )
+        )
+        for table in result['tables']:
+            assert table['rows'], table
+        types = dict([(row['key'], row) for row in result['tables'][0]['rows']])
+        assert types['module']['count'] == 69, types['module']
+
+    def test_headless(self):
+        """Does the report run without importing wx or squaremap?"""
+        script = (
+            'import sys; from runsnakerun import report; '
+            'sys.argv[1:] = ["--report", "-n", "1", %r]; report.dispatch(); '
+            'assert "wx" not in sys.modules and "squaremap" not in sys.modules'
+        ) % (os.path.join(HERE, 'gallery.profile'),)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(HERE), env.get('PYTHONPATH', '')]
+        )
+        output = subprocess.check_output([sys.executable, '-c', script], env=env)
+        assert b'main' in output, output
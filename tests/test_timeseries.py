@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+import unittest, os, shutil, tempfile, marshal
+from runsnakerun import timeseries
+
+
+def key(name):
+    return ('/srv/app.py', 1, name)
+
+
+def minute_stats(minute):
+    """Profile where 'leak' grows every minute and 'steady' does not"""
+    return {
+        key('main'): (1, 1, 0.1, 2.0 + minute, {}),
+        key('steady'): (10, 10, 1.0, 1.0, {key('main'): (10, 10, 1.0, 1.0)}),
+        key('leak'): (
+            minute + 1,
+            minute + 1,
+            0.5 * minute,
+            0.5 * minute,
+            {key('main'): (minute + 1, minute + 1, 0.5 * minute, 0.5 * minute)},
+        ),
+    }
+
+
+class TimeSeriesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='runsnake-test-')
+        self.series = timeseries.TimeSeries(bucket_seconds=60)
+        self.dumps = []
+        # two dumps per minute for five minutes, one delivered out of order
+        for minute in range(5):
+            for half in (0, 30):
+                filename = os.path.join(
+                    self.directory, 'dump-%s-%s.profile' % (minute, half)
+                )
+                with open(filename, 'wb') as fh:
+                    marshal.dump(minute_stats(minute), fh)
+                self.dumps.append((filename, minute * 60 + half))
+        self.dumps.append(self.dumps.pop(1))
+        for filename, timestamp in self.dumps:
+            self.series.add(filename, timestamp)
+
+    def tearDown(self):
+        self.series.close()
+        shutil.rmtree(self.directory)
+
+    def test_series(self):
+        """Do we report the evolution of a function's totals per bucket?"""
+        series = self.series.series(key('leak'))
+        assert [time for time, value in series] == [0, 60, 120, 180, 240]
+        assert [value for time, value in series] == [0.0, 1.0, 2.0, 3.0, 4.0], series
+        calls = self.series.series(key('leak'), 'calls', start=60, stop=180)
+        assert calls == [(60, 4), (120, 6)], calls
+        assert [v for t, v in self.series.series(key('missing'))] == [0] * 5
+
+    def test_growth(self):
+        """Do we find the functions which grew the most?"""
+        growth = self.series.growth(limit=2)
+        assert [k for slope, k in growth] == [key('main'), key('leak')], growth
+        assert abs(growth[1][0] - 1.0) < 1e-9, growth
+        steady = dict([(k, slope) for slope, k in self.series.growth(limit=3)])
+        assert abs(steady[key('steady')]) < 1e-9, steady
+
+    def test_open_window(self):
+        """Can we open a window of buckets as a regular merged model?"""
+        loader = self.series.open_window(60, 180, processes=False)
+        leak = loader.rows[key('leak')]
+        assert leak.calls == 2 * (2 + 3), leak.calls
+        self.assertRaises(ValueError, self.series.open_window, 600, 660)